@@ -1,21 +1,31 @@
-import os
-import re
+import asyncio
+import logging
+import threading
+import time
+from dataclasses import dataclass, field
+from typing import AsyncIterator, Optional
 from dotenv import load_dotenv
 
-from pinecone import Pinecone
-from llama_index.core import Settings, StorageContext, VectorStoreIndex
-from llama_index.embeddings.huggingface import HuggingFaceEmbedding
-from llama_index.core.node_parser import SemanticSplitterNodeParser
-from llama_index.vector_stores.pinecone import PineconeVectorStore
-from together import Together
+from answer_cache import answer_cache, context_fingerprint, history_key
+from app_config import settings
+from context_assembly import AssembledContext, ContextAssembler
+from embeddings import (
+    EMBED_MODEL_NAME,
+    CachedQueryEmbedder,
+    MicroBatchEmbedder,
+    build_embed_model,
+    normalize_query,
+    query_embedding_cache,
+)
+from history import format_message, token_counter
+from llm_client import llm_client
+from reranker import build_reranker
+from retrieval import RetrievedChunk, build_retriever
+from singleflight import SingleFlight
+from timing import StageTimings
 
 load_dotenv()
 
-PINECONE_API_KEY = os.getenv("PINECONE_API_KEY")
-PINECONE_INDEX   = os.getenv("PINECONE_INDEX_NAME", "civbotvect")
-TOGETHER_API_KEY = os.getenv("TOGETHER_API_KEY")
-TOGETHER_MODEL   = os.getenv("TOGETHER_MODEL", "meta-llama/Llama-3.3-70B-Instruct-Turbo-Free")
-
 SYSTEM_PROMPT = (
     "Вы — опытный помощник, специализирующийся на механике Civilization VI. "
     "Для ответа используйте только предоставленную контекстную информацию"
@@ -23,96 +33,295 @@ SYSTEM_PROMPT = (
     "старайся обращаться к пользователю по имени."
 )
 
-embed_model = HuggingFaceEmbedding(model_name="cointegrated/rubert-tiny2")
-splitter = SemanticSplitterNodeParser(
-    buffer_size=2,
-    breakpoint_percentile_threshold=60,
-    embed_model=embed_model,
-)
+WARMUP_QUERY = "Как получить великого учёного?"
 
-Settings.embed_model = embed_model
-Settings.node_parser = splitter
-Settings.llm = None  
+logger = logging.getLogger(__name__)
 
-together = Together(api_key=TOGETHER_API_KEY)
 
-class RAGService:
+class EmbeddingResources:
+    """
+    Модель эмбеддингов и обёртки над ней, общие для процесса.
+
+    Импорт модуля модель не загружает: она создаётся при первом обращении,
+    обычно при сборке RAGService в фоне после старта приложения. load() можно
+    вызвать и заранее — в мастер-процессе gunicorn до fork (PRELOAD_MODELS),
+    тогда воркеры делят веса copy-on-write.
+    """
+
     def __init__(self):
-        pinecone_client = Pinecone(api_key=PINECONE_API_KEY)
-        pc_index = pinecone_client.Index(PINECONE_INDEX)
-        store = PineconeVectorStore(pinecone_index=pc_index)
-        storage_context = StorageContext.from_defaults(vector_store=store)
-        self.index = VectorStoreIndex.from_vector_store(
-            vector_store=store,
-            storage_context=storage_context,
-        )
-        self.query_engine = self.index.as_query_engine(
-            similarity_top_k=5,
-            hybrid=True,            
-            alpha=0.4,              
-            streaming=False,
-            response_mode="compact",
-        )
+        self._lock = threading.Lock()
+        self._model = None
+        self._batcher: Optional[MicroBatchEmbedder] = None
+        self._query_embedder: Optional[CachedQueryEmbedder] = None
+        self.load_seconds: Optional[float] = None
+
+    @property
+    def loaded(self) -> bool:
+        return self._model is not None
+
+    def load(self) -> None:
+        with self._lock:
+            if self._model is not None:
+                return
+            started = time.perf_counter()
+            model = build_embed_model()
+            # эмбеддинги вопросов кешируются: одинаковые вопросы не гоняют модель
+            # повторно, а промахи одновременных запросов считаются одной пачкой
+            self._batcher = MicroBatchEmbedder(
+                model,
+                max_batch_size=settings.EMBED_BATCH_MAX_SIZE,
+                max_wait=settings.EMBED_BATCH_MAX_WAIT_MS / 1000,
+            )
+            self._query_embedder = CachedQueryEmbedder(
+                model, query_embedding_cache, EMBED_MODEL_NAME, batcher=self._batcher
+            )
+            self._model = model
+            self.load_seconds = time.perf_counter() - started
+            logger.info("Embedding model (%s) loaded in %.2fs", settings.EMBED_BACKEND, self.load_seconds)
+
+    @property
+    def query_embedder(self) -> CachedQueryEmbedder:
+        self.load()
+        return self._query_embedder
 
-    async def retrieve_and_generate(self, user_input: str, history: list) -> str:
-        result = self.query_engine.query(user_input)
-        hits = result.source_nodes 
+    def batching_stats(self) -> dict:
+        return self._batcher.stats() if self._batcher is not None else {}
 
-        fragments = []
-        for node in hits:
-            text = node.node.get_content() if hasattr(node.node, "get_content") else str(node.node.text)
 
-            lines = [ln.strip() for ln in text.splitlines()
-                if ln.strip() and not ln.strip().startswith("file_path:")]
+embedding_resources = EmbeddingResources()
 
-            for ln in lines:
-                if ln not in fragments:
-                    fragments.append(ln)
+# Синхронные бэкенды поиска выполняются в пуле потоков; ограничиваем число
+# одновременных запросов, чтобы не забить пул и не блокировать event loop
+retrieval_semaphore = asyncio.Semaphore(settings.RETRIEVAL_MAX_CONCURRENCY)
 
-        context = "\n".join(fragments)[:4000]
+# одинаковые одновременные вопросы ждут один поиск и, если у диалога нет
+# истории, один ответ LLM (singleflight.py)
+retrieval_flight = SingleFlight("retrieval", enabled=settings.COALESCE_REQUESTS)
+generation_flight = SingleFlight("generation", enabled=settings.COALESCE_REQUESTS)
 
-        rerank_prompt = "From the following context fragments, choose the 2 most relevant to the query:\n\n"
-        for i, frag in enumerate(fragments, 1):
-            rerank_prompt += f"{i}. {frag}\n"
-        rerank_prompt += f"\nQuery: {user_input}\nAnswer:"
+@dataclass
+class GeneratedAnswer:
+    text: str
+    # фрагменты базы знаний, попавшие в контекст: [{chunk_id, source}]
+    sources: list = field(default_factory=list)
 
-        rerank_resp = together.chat.completions.create(
-            model=TOGETHER_MODEL,
-            messages=[
-                {"role": "system", "content": SYSTEM_PROMPT},
-                {"role": "user",   "content": rerank_prompt},
-            ],
-            stream=False,
+
+class RAGService:
+    def __init__(self):
+        query_embedder = embedding_resources.query_embedder
+        self.query_embedder = query_embedder
+        self.retriever = build_retriever(
+            settings.VECTOR_BACKEND, query_embedder, settings.RETRIEVAL_TOP_K
+        )
+        self.reranker = build_reranker(
+            settings.RERANK_MODE, query_embedder, llm_client, SYSTEM_PROMPT
+        )
+        self.context_assembler = ContextAssembler(
+            query_embedder,
+            self.reranker,
+            token_counter,
+            mmr_chunks=settings.CONTEXT_MMR_CHUNKS,
+            mmr_lambda=settings.CONTEXT_MMR_LAMBDA,
+            max_tokens=settings.CONTEXT_MAX_TOKENS,
+            rerank_top_k=settings.RERANK_TOP_K,
         )
-        sel = rerank_resp.choices[0].message.content
-        selected_idxs = [int(x) for x in re.findall(r"\b\d+\b", sel)[:2]]
-        best_context = "\n".join(fragments[i-1] for i in selected_idxs if 1 <= i <= len(fragments))
-
-        if history:
-            hist_lines = []
-            for m in history:
-                role = "User" if m.type == "user" else "Assistant"
-                hist_lines.append(f"{role}: {m.text}")
-            history_text = "\n".join(hist_lines)
-        else:
-            history_text = ""
+
+    async def warm_up(self) -> None:
+        """Прогревает соединение с индексом и модель эмбеддингов пробным запросом."""
+        await self.retriever.aretrieve(WARMUP_QUERY)
+
+    async def retrieve(self, user_input: str) -> list[RetrievedChunk]:
+        hits, _ = await retrieval_flight.do(normalize_query(user_input), lambda: self._retrieve(user_input))
+        return hits
+
+    async def _retrieve(self, user_input: str) -> list[RetrievedChunk]:
+        async with retrieval_semaphore:
+            return await self.retriever.aretrieve(user_input)
+
+    def build_messages(
+        self, user_input: str, history: list, context: AssembledContext, summary: str = ""
+    ) -> list[dict]:
+        best_context = context.render()
+
+        history_text = "\n".join(format_message(m) for m in history)
+        # реплики, не вошедшие в окно истории, представлены кратким содержанием
+        summary_block = f"=== Summary ===\n{summary}\n\n" if summary else ""
 
         final_prompt = (
             "=== Context ===\n"
             f"{best_context}\n\n"
+            f"{summary_block}"
             "=== History ===\n"
             f"{history_text}\n\n"
             "=== Query ===\n"
             f"{user_input}\n\n"
             "=== Assistant Answer ===\n"
         )
-        print(final_prompt)
-        resp = together.chat.completions.create(
-            model=TOGETHER_MODEL,
-            messages=[
-                {"role": "system",  "content": SYSTEM_PROMPT},
-                {"role": "user",    "content": final_prompt},
-            ],
-            stream=False,
+        logger.debug("Prompt:\n%s", final_prompt)
+        return [
+            {"role": "system",  "content": SYSTEM_PROMPT},
+            {"role": "user",    "content": final_prompt},
+        ]
+
+    async def _cache_key(self, user_input: str, history: list, hits: list[RetrievedChunk], summary: str):
+        query_embedding = await self.query_embedder.aget_query_embedding(user_input)
+        return (
+            query_embedding,
+            context_fingerprint([hit.id for hit in hits]),
+            history_key(history, user_input, summary),
         )
-        return resp.choices[0].message.content
+
+    async def retrieve_and_generate(
+        self,
+        user_input: str,
+        history: list,
+        summary: str = "",
+        hits: Optional[list[RetrievedChunk]] = None,
+        timings: Optional[StageTimings] = None,
+    ) -> GeneratedAnswer:
+        """
+        Ответ на вопрос с учётом истории.
+
+        hits — уже найденные фрагменты, если поиск запущен заранее параллельно
+        с работой с базой; timings собирает длительности стадий.
+        """
+        timings = timings or StageTimings()
+        if hits is None:
+            hits = await timings.measure("retrieval", self.retrieve(user_input))
+        if history_key(history, user_input, summary):
+            return await self._generate(user_input, history, summary, hits, timings)
+        # без истории ответ зависит только от вопроса и найденных фрагментов:
+        # одновременные одинаковые вопросы разделяют одну генерацию, а
+        # сообщение бота каждый диалог всё равно сохраняет своё
+        started = time.perf_counter()
+        key = (normalize_query(user_input), context_fingerprint([hit.id for hit in hits]))
+        answer, shared = await generation_flight.do(
+            key, lambda: self._generate(user_input, history, summary, hits, timings)
+        )
+        if shared:
+            timings.add("coalesced", time.perf_counter() - started)
+        return GeneratedAnswer(answer.text, list(answer.sources))
+
+    async def _generate(
+        self,
+        user_input: str,
+        history: list,
+        summary: str,
+        hits: list[RetrievedChunk],
+        timings: StageTimings,
+    ) -> GeneratedAnswer:
+        with timings.stage("cache"):
+            key = await self._cache_key(user_input, history, hits, summary)
+            cached = answer_cache.lookup(*key)
+        if cached is not None:
+            return GeneratedAnswer(cached.answer, cached.sources)
+
+        started = time.perf_counter()
+        with timings.stage("context"):
+            context = await self.context_assembler.assemble(user_input, hits)
+            messages = self.build_messages(user_input, history, context, summary)
+        answer = await timings.measure("generation", llm_client.chat(messages))
+        answer_cache.store(*key, answer, time.perf_counter() - started, context.sources)
+        return GeneratedAnswer(answer, context.sources)
+
+    async def stream_generate(
+        self,
+        user_input: str,
+        history: list,
+        summary: str = "",
+        sources: Optional[list] = None,
+        hits: Optional[list[RetrievedChunk]] = None,
+        timings: Optional[StageTimings] = None,
+    ) -> AsyncIterator[str]:
+        """
+        То же, что retrieve_and_generate, но отдаёт ответ по мере генерации токенов.
+
+        Источники ответа дописываются в переданный список sources до первого токена.
+        """
+        timings = timings or StageTimings()
+        if hits is None:
+            hits = await timings.measure("retrieval", self.retrieve(user_input))
+        with timings.stage("cache"):
+            key = await self._cache_key(user_input, history, hits, summary)
+            cached = answer_cache.lookup(*key)
+        if cached is not None:
+            if sources is not None:
+                sources.extend(cached.sources)
+            yield cached.answer
+            return
+
+        started = time.perf_counter()
+        with timings.stage("context"):
+            context = await self.context_assembler.assemble(user_input, hits)
+            messages = self.build_messages(user_input, history, context, summary)
+        if sources is not None:
+            sources.extend(context.sources)
+        parts = []
+        generation_started = time.perf_counter()
+        async for token in llm_client.stream_chat(messages):
+            if not parts:
+                timings.add("first_token", time.perf_counter() - generation_started)
+            parts.append(token)
+            yield token
+        timings.add("generation", time.perf_counter() - generation_started)
+        # в кеш попадают только полностью сгенерированные ответы
+        answer_cache.store(*key, "".join(parts), time.perf_counter() - started, context.sources)
+
+
+class RAGServiceManager:
+    """
+    Держит один прогретый RAGService на процесс.
+
+    Сервис создаётся в фоне после старта приложения (startup.warm_up) и
+    переиспользуется всеми запросами.
+    rebuild() собирает новый экземпляр в фоне и подменяет ссылку только после
+    успешного прогрева, поэтому запросы в процессе обработки дорабатывают на старом.
+    """
+
+    def __init__(self):
+        self._service: RAGService | None = None
+        self._lock = asyncio.Lock()
+        self.warm = False
+        self.built_at: float | None = None
+        self.build_seconds: float | None = None
+        self.last_error: str | None = None
+
+    async def start(self) -> None:
+        try:
+            await self.rebuild()
+        except Exception:
+            # Приложение должно подняться и без индекса: /health покажет ошибку
+            logger.exception("RAGService startup failed")
+
+    async def rebuild(self) -> None:
+        async with self._lock:
+            started = time.perf_counter()
+            try:
+                service = await asyncio.to_thread(RAGService)
+                await service.warm_up()
+            except Exception as exc:
+                self.last_error = repr(exc)
+                raise
+            self._service = service
+            self.warm = True
+            self.built_at = time.time()
+            self.build_seconds = time.perf_counter() - started
+            self.last_error = None
+            logger.info("RAGService ready in %.2fs", self.build_seconds)
+
+    def get(self) -> RAGService:
+        if self._service is None:
+            raise RuntimeError("RAGService is not ready")
+        return self._service
+
+    def status(self) -> dict:
+        return {
+            "warm": self.warm,
+            "rebuilding": self._lock.locked(),
+            "built_at": self.built_at,
+            "build_seconds": self.build_seconds,
+            "last_error": self.last_error,
+        }
+
+
+rag_manager = RAGServiceManager()
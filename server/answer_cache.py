@@ -0,0 +1,139 @@
+import hashlib
+import threading
+import time
+from collections import OrderedDict
+from dataclasses import dataclass, field
+from typing import Optional
+
+import numpy as np
+
+from app_config import settings
+from kb_version import read_kb_version
+
+
+@dataclass
+class CachedAnswer:
+    embedding: np.ndarray
+    answer: str
+    created_at: float
+    generation_seconds: float
+    sources: list = field(default_factory=list)
+
+
+def context_fingerprint(chunk_ids: list[str]) -> str:
+    return hashlib.sha1("\n".join(sorted(chunk_ids)).encode("utf-8")).hexdigest()
+
+
+def history_key(history: list, user_input: str, summary: str = "") -> str:
+    """Ключ предыдущих реплик диалога; текущий вопрос в конце истории не учитывается."""
+    prior = list(history)
+    if prior and prior[-1].type == "user" and prior[-1].text == user_input:
+        prior = prior[:-1]
+    if not prior and not summary:
+        return ""
+    joined = summary + "\n" + "\n".join(f"{m.type}:{m.text}" for m in prior)
+    return hashlib.sha1(joined.encode("utf-8")).hexdigest()
+
+
+class SemanticAnswerCache:
+    """
+    Кеш готовых ответов для почти одинаковых вопросов.
+
+    Ответ переиспользуется, только если совпадает набор найденных фрагментов
+    (отпечаток контекста) и история диалога, а косинусная близость
+    эмбеддингов вопросов не ниже порога. При публикации новой версии базы
+    знаний кеш очищается целиком.
+    """
+
+    def __init__(self, max_entries: int, threshold: float, ttl: float, with_history: bool):
+        self.max_entries = max_entries
+        self.threshold = threshold
+        self.ttl = ttl
+        self.with_history = with_history
+        self._buckets: OrderedDict[tuple[str, str], list[CachedAnswer]] = OrderedDict()
+        self._size = 0
+        self._lock = threading.Lock()
+        self.kb_version = read_kb_version()
+        self.hits = 0
+        self.misses = 0
+        self.invalidations = 0
+        self.saved_seconds = 0.0
+
+    def _check_version(self) -> None:
+        version = read_kb_version()
+        if version != self.kb_version:
+            self._buckets.clear()
+            self._size = 0
+            self.kb_version = version
+            self.invalidations += 1
+
+    def cacheable(self, hist_key: str) -> bool:
+        return self.max_entries > 0 and (self.with_history or not hist_key)
+
+    def lookup(self, query_embedding, context_fp: str, hist_key: str) -> Optional[CachedAnswer]:
+        if not self.cacheable(hist_key):
+            return None
+        query = np.asarray(query_embedding, dtype=np.float32)
+        query = query / max(float(np.linalg.norm(query)), 1e-12)
+        now = time.time()
+        with self._lock:
+            self._check_version()
+            entries = self._buckets.get((context_fp, hist_key))
+            best, best_score = None, self.threshold
+            for entry in entries or ():
+                if now - entry.created_at > self.ttl:
+                    continue
+                score = float(entry.embedding @ query)
+                if score >= best_score:
+                    best, best_score = entry, score
+            if best is None:
+                self.misses += 1
+                return None
+            self._buckets.move_to_end((context_fp, hist_key))
+            self.hits += 1
+            self.saved_seconds += best.generation_seconds
+            return best
+
+    def store(
+        self,
+        query_embedding,
+        context_fp: str,
+        hist_key: str,
+        answer: str,
+        generation_seconds: float,
+        sources: Optional[list] = None,
+    ) -> None:
+        if not self.cacheable(hist_key) or not answer:
+            return
+        query = np.asarray(query_embedding, dtype=np.float32)
+        query = query / max(float(np.linalg.norm(query)), 1e-12)
+        with self._lock:
+            self._check_version()
+            bucket = self._buckets.setdefault((context_fp, hist_key), [])
+            bucket.append(CachedAnswer(query, answer, time.time(), generation_seconds, list(sources or [])))
+            self._buckets.move_to_end((context_fp, hist_key))
+            self._size += 1
+            while self._size > self.max_entries and self._buckets:
+                _, evicted = self._buckets.popitem(last=False)
+                self._size -= len(evicted)
+
+    def stats(self) -> dict:
+        with self._lock:
+            lookups = self.hits + self.misses
+            return {
+                "entries": self._size,
+                "kb_version": self.kb_version,
+                "hits": self.hits,
+                "misses": self.misses,
+                "hit_rate": self.hits / lookups if lookups else 0.0,
+                "invalidations": self.invalidations,
+                "saved_seconds": round(self.saved_seconds, 3),
+            }
+
+
+answer_cache = SemanticAnswerCache(
+    max_entries=settings.ANSWER_CACHE_SIZE,
+    threshold=settings.ANSWER_CACHE_THRESHOLD,
+    ttl=settings.ANSWER_CACHE_TTL,
+    with_history=settings.ANSWER_CACHE_WITH_HISTORY,
+)
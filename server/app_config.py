@@ -1,5 +1,6 @@
 from pydantic_settings import BaseSettings
 import os
+from typing import Optional
 from pydantic import Extra
 from dotenv import load_dotenv
 
@@ -11,7 +12,93 @@ class Settings(BaseSettings):
     SECRET_KEY: str = "your-256-bit-secret"
     ALGORITHM: str = "HS256"
     ACCESS_TOKEN_EXPIRE_MINUTES: int = 30
+    # кеш пользователей для проверки токена и пул потоков для bcrypt
+    USER_CACHE_SIZE: int = 10000
+    USER_CACHE_TTL_SECONDS: float = 300
+    BCRYPT_MAX_WORKERS: int = 4
     CHAT_MODEL_NAME: str = "tinkoff-ai/ruDialoGpt3-medium"
+    PINECONE_API_KEY: Optional[str] = None
+    PINECONE_INDEX_NAME: str = "civbotvect"
+    # где хранится база знаний: pinecone | local (memory-mapped матрица на диске) | pgvector
+    VECTOR_BACKEND: str = "pinecone"
+    LOCAL_INDEX_DIR: str = "Knowledge_Base_Operator/local_index"
+    RETRIEVAL_TOP_K: int = 5
+    # размер списка кандидатов HNSW при поиске в pgvector (точность против скорости)
+    PGVECTOR_EF_SEARCH: int = 40
+    TOGETHER_API_KEY: Optional[str] = None
+    TOGETHER_MODEL: str = "meta-llama/Llama-3.3-70B-Instruct-Turbo-Free"
+    TOGETHER_BASE_URL: str = "https://api.together.xyz/v1"
+    # таймауты одного HTTP-запроса и дедлайн всего вызова LLM вместе с повторами
+    LLM_TIMEOUT_SECONDS: float = 60.0
+    LLM_CONNECT_TIMEOUT_SECONDS: float = 5.0
+    LLM_DEADLINE_SECONDS: float = 120.0
+    LLM_MAX_RETRIES: int = 3
+    # сколько генераций одновременно держит один воркер и размер пула соединений
+    LLM_MAX_CONCURRENCY: int = 32
+    LLM_POOL_SIZE: int = 32
+    # фоновые генерации (POST .../messages?mode=async): воркеров на процесс,
+    # ожидающих задач, незавершённых задач одного пользователя и сколько
+    # секунд хранится результат
+    JOB_WORKERS: int = 8
+    JOB_QUEUE_SIZE: int = 100
+    JOB_MAX_PER_USER: int = 3
+    JOB_RESULT_TTL: float = 600
+    # сколько поисков по индексу одновременно выполняется в пуле потоков
+    RETRIEVAL_MAX_CONCURRENCY: int = 8
+    # модель эмбеддингов: torch (HuggingFace) | onnx (квантованная int8, см. embeddings.py)
+    EMBED_BACKEND: str = "torch"
+    ONNX_MODEL_DIR: str = "models/rubert-tiny2-onnx"
+    ONNX_THREADS: int = 1
+    # микробатчинг эмбеддингов вопросов: размер пачки и ожидание попутчиков (мс)
+    EMBED_BATCH_MAX_SIZE: int = 32
+    EMBED_BATCH_MAX_WAIT_MS: float = 5
+    # загрузить модель эмбеддингов и токенизатор при импорте приложения, а не в
+    # фоне после старта: под gunicorn --preload воркеры делят веса copy-on-write
+    PRELOAD_MODELS: bool = False
+    # кеш эмбеддингов вопросов: размер, время жизни (с) и каталог для дискового уровня
+    QUERY_EMBED_CACHE_SIZE: int = 2048
+    QUERY_EMBED_CACHE_TTL: float = 24 * 3600
+    QUERY_EMBED_CACHE_DIR: Optional[str] = None
+    # файл с версией опубликованной базы знаний (пишет knowledge_base_updater)
+    KB_VERSION_FILE: str = "Knowledge_Base_Operator/kb_version"
+    # манифест инкрементальной загрузки (хеши документов и id фрагментов)
+    KB_MANIFEST_FILE: str = "Knowledge_Base_Operator/kb_manifest_{backend}.json"
+    # кеш ответов на почти одинаковые вопросы; 0 отключает кеш
+    ANSWER_CACHE_SIZE: int = 1000
+    ANSWER_CACHE_THRESHOLD: float = 0.95
+    ANSWER_CACHE_TTL: float = 7 * 24 * 3600
+    # кешировать ли ответы в диалогах с историей (ключ включает историю)
+    ANSWER_CACHE_WITH_HISTORY: bool = False
+    # объединять одинаковые одновременные вопросы: поиск — всегда, генерацию —
+    # только в диалогах без истории
+    COALESCE_REQUESTS: bool = True
+    # история диалога в промпте: сообщений из базы, бюджет токенов, краткое
+    # содержание старых реплик (длина в токенах и сообщений за одно обновление)
+    HISTORY_MAX_MESSAGES: int = 20
+    HISTORY_MAX_TOKENS: int = 1500
+    HISTORY_SUMMARY_MAX_TOKENS: int = 300
+    HISTORY_SUMMARY_BATCH: int = 40
+    # токенизатор модели для подсчёта токенов: путь к tokenizer.json или имя на
+    # HuggingFace Hub; без него число токенов оценивается по длине текста
+    LLM_TOKENIZER: Optional[str] = None
+    # сборка контекста: фрагментов после MMR, баланс релевантности и
+    # разнообразия (1 — только релевантность) и бюджет контекста в токенах
+    CONTEXT_MMR_CHUNKS: int = 3
+    CONTEXT_MMR_LAMBDA: float = 0.7
+    CONTEXT_MAX_TOKENS: int = 1200
+    # наблюдаемость: уровень логов, SQL в лог (дорого, только для отладки),
+    # эндпоинт /metrics, заголовок с id запроса и порог медленного запроса (с)
+    LOG_LEVEL: str = "INFO"
+    SQL_ECHO: bool = False
+    METRICS_ENABLED: bool = True
+    REQUEST_ID_HEADER: str = "X-Request-ID"
+    SLOW_REQUEST_SECONDS: float = 2.0
+    # ранжирование фрагментов: embedding | cross_encoder | llm | none
+    RERANK_MODE: str = "embedding"
+    RERANK_TOP_K: int = 2
+    RERANK_CROSS_ENCODER_MODEL: str = "DiTy/cross-encoder-russian-msmarco"
+    # токен для служебных эндпоинтов (/rag/reload); если не задан, они закрыты
+    ADMIN_TOKEN: Optional[str] = None
     
 
     class Config:
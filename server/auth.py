@@ -1,10 +1,21 @@
-from jose import JWTError, jwt
+import asyncio
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from typing import Optional
+
+from cachetools import TTLCache
+from jose import jwt
 from passlib.context import CryptContext
 from datetime import datetime, timedelta
 from app_config import settings
 
 pwd_context = CryptContext(schemes=["bcrypt"], deprecated="auto")
 
+# bcrypt специально медленный (~200 мс на хеш): считаем его в отдельном
+# ограниченном пуле, чтобы всплеск логинов не останавливал event loop
+# и не занимал общий пул потоков
+_bcrypt_pool = ThreadPoolExecutor(max_workers=settings.BCRYPT_MAX_WORKERS, thread_name_prefix="bcrypt")
+
 
 def verify_password(plain_password, hashed_password):
     return pwd_context.verify(plain_password, hashed_password)
@@ -14,8 +25,60 @@ def get_password_hash(password):
     return pwd_context.hash(password)
 
 
+async def averify_password(plain_password, hashed_password) -> bool:
+    loop = asyncio.get_running_loop()
+    return await loop.run_in_executor(_bcrypt_pool, verify_password, plain_password, hashed_password)
+
+
+async def aget_password_hash(password) -> str:
+    loop = asyncio.get_running_loop()
+    return await loop.run_in_executor(_bcrypt_pool, get_password_hash, password)
+
+
 def create_access_token(data: dict):
     to_encode = data.copy()
     expire = datetime.utcnow() + timedelta(minutes=settings.ACCESS_TOKEN_EXPIRE_MINUTES)
     to_encode.update({"exp": expire})
     return jwt.encode(to_encode, settings.SECRET_KEY, algorithm=settings.ALGORITHM)
+
+
+def decode_access_token(token: str) -> dict:
+    """Проверяет подпись и срок действия токена; бросает JWTError."""
+    return jwt.decode(token, settings.SECRET_KEY, algorithms=[settings.ALGORITHM])
+
+
+class UserCache:
+    """
+    Кеш пользователей по user_id из токена (TTL, ограниченный размер).
+
+    Хранит отсоединённые от сессии объекты User только для чтения.
+    Изменения и удаление пользователя через ORM сбрасывают запись
+    (см. models.py), а TTL ограничивает устаревание в остальных случаях.
+    """
+
+    def __init__(self, max_size: int, ttl: float):
+        self._items = TTLCache(maxsize=max_size, ttl=ttl)
+        self._lock = threading.Lock()
+
+    def get(self, user_id: int):
+        with self._lock:
+            return self._items.get(user_id)
+
+    def set(self, user) -> None:
+        with self._lock:
+            self._items[user.user_id] = user
+
+    def invalidate(self, user_id: Optional[int]) -> None:
+        with self._lock:
+            self._items.pop(user_id, None)
+
+    def clear(self) -> None:
+        with self._lock:
+            self._items.clear()
+
+    def stats(self) -> dict:
+        with self._lock:
+            return {"size": len(self._items)}
+
+
+user_cache = UserCache(settings.USER_CACHE_SIZE, settings.USER_CACHE_TTL_SECONDS)
@@ -0,0 +1,169 @@
+"""
+Локальные заменители Together и Pinecone для нагрузочных тестов.
+
+Один сервер отвечает за оба API:
+    POST /v1/chat/completions — OpenAI-совместимый чат (обычный и потоковый),
+        первый токен через --llm-ttft-ms, дальше --llm-tokens-per-sec;
+    GET  /indexes/{name}      — описание индекса (control plane Pinecone),
+        host указывает на этот же сервер;
+    POST /query               — поиск (data plane Pinecone) по фрагментам
+        data_civ6_ru со случайными векторами, задержка --search-latency-ms.
+
+Вектора случайные, поэтому найденные фрагменты не связаны с вопросом:
+сервер нужен для замера задержек и пропускной способности, а не качества.
+Запуск: python -m bench.fakes --port 9100
+"""
+import argparse
+import asyncio
+import glob
+import json
+import os
+import time
+
+import numpy as np
+import uvicorn
+from fastapi import FastAPI, Request
+from fastapi.responses import JSONResponse, StreamingResponse
+from llama_index.core.schema import TextNode
+from llama_index.core.vector_stores.utils import node_to_metadata_dict
+
+SERVER_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+CORPUS_DIR = os.path.join(SERVER_DIR, "Knowledge_Base_Operator", "data_civ6_ru")
+ANSWER_WORDS = (
+    "Чтобы получить великого учёного, стройте кампусы и библиотеки, "
+    "выбирайте научные политики и не забывайте про эврики."
+).split()
+
+
+def load_corpus(chunk_chars: int) -> list[TextNode]:
+    """Строки корпуса, склеенные во фрагменты примерно по chunk_chars символов."""
+    nodes = []
+    for path in sorted(glob.glob(os.path.join(CORPUS_DIR, "**", "*.txt"), recursive=True)):
+        name = os.path.basename(path)
+        with open(path, encoding="utf-8") as f:
+            lines = [line.strip() for line in f if line.strip()]
+        chunk: list[str] = []
+        for line in lines + [None]:
+            if chunk and (line is None or sum(map(len, chunk)) + len(line) > chunk_chars):
+                nodes.append(TextNode(id_=f"{name}:{len(nodes)}", text="\n".join(chunk), metadata={"file_name": name}))
+                chunk = []
+            if line is not None:
+                chunk.append(line)
+    if not nodes:
+        nodes = [TextNode(id_=f"stub:{i}", text=f"Фрагмент базы знаний номер {i}.") for i in range(100)]
+    return nodes
+
+
+def answer_tokens(count: int) -> list[str]:
+    return [ANSWER_WORDS[i % len(ANSWER_WORDS)] + " " for i in range(count)]
+
+
+def build_app(args) -> FastAPI:
+    app = FastAPI()
+    nodes = load_corpus(args.chunk_chars)
+    rng = np.random.default_rng(0)
+    vectors = rng.standard_normal((len(nodes), args.dim)).astype(np.float32)
+    vectors /= np.linalg.norm(vectors, axis=1, keepdims=True)
+    metadata = [node_to_metadata_dict(node, remove_text=False, flat_metadata=False) for node in nodes]
+    stats = {"chat": 0, "stream": 0, "query": 0}
+
+    @app.get("/indexes/{name}")
+    async def describe_index(name: str, request: Request):
+        return {
+            "name": name,
+            "dimension": args.dim,
+            "metric": "cosine",
+            "host": f"http://{request.url.netloc}",
+            "spec": {"serverless": {"cloud": "aws", "region": "us-east-1"}},
+            "status": {"ready": True, "state": "Ready"},
+            "vector_type": "dense",
+            "deletion_protection": "disabled",
+        }
+
+    @app.post("/query")
+    async def query(request: Request):
+        body = await request.json()
+        stats["query"] += 1
+        await asyncio.sleep(args.search_latency_ms / 1000)
+        top_k = int(body.get("topK", 5))
+        query_vec = np.asarray(body.get("vector") or np.zeros(args.dim), dtype=np.float32)
+        scores = vectors @ query_vec
+        order = np.argsort(-scores)[:top_k]
+        return {
+            "matches": [
+                {
+                    "id": nodes[i].node_id,
+                    "score": float(scores[i]),
+                    "values": vectors[i].tolist() if body.get("includeValues") else [],
+                    "metadata": metadata[i],
+                }
+                for i in order
+            ],
+            "namespace": body.get("namespace", ""),
+            "usage": {"readUnits": 1},
+        }
+
+    @app.post("/v1/chat/completions")
+    async def chat_completions(request: Request):
+        body = await request.json()
+        prompt_tokens = sum(len(m.get("content", "")) for m in body.get("messages", [])) // 4
+        tokens = answer_tokens(args.answer_tokens)
+        usage = {
+            "prompt_tokens": prompt_tokens,
+            "completion_tokens": len(tokens),
+            "total_tokens": prompt_tokens + len(tokens),
+        }
+        delay = 1 / args.llm_tokens_per_sec if args.llm_tokens_per_sec > 0 else 0.0
+        if not body.get("stream"):
+            stats["chat"] += 1
+            await asyncio.sleep(args.llm_ttft_ms / 1000 + delay * len(tokens))
+            return {
+                "id": "bench",
+                "object": "chat.completion",
+                "created": int(time.time()),
+                "model": body.get("model"),
+                "choices": [{"index": 0, "message": {"role": "assistant", "content": "".join(tokens)}, "finish_reason": "stop"}],
+                "usage": usage,
+            }
+
+        stats["stream"] += 1
+
+        async def events():
+            await asyncio.sleep(args.llm_ttft_ms / 1000)
+            for i, token in enumerate(tokens):
+                if i:
+                    await asyncio.sleep(delay)
+                chunk = {"choices": [{"index": 0, "delta": {"content": token}}]}
+                yield f"data: {json.dumps(chunk, ensure_ascii=False)}\n\n"
+            yield f"data: {json.dumps({'choices': [], 'usage': usage})}\n\n"
+            yield "data: [DONE]\n\n"
+
+        return StreamingResponse(events(), media_type="text/event-stream")
+
+    @app.get("/stats")
+    async def get_stats():
+        return JSONResponse(stats)
+
+    return app
+
+
+def add_arguments(parser: argparse.ArgumentParser) -> None:
+    parser.add_argument("--llm-ttft-ms", type=float, default=300, help="задержка до первого токена")
+    parser.add_argument("--llm-tokens-per-sec", type=float, default=60, help="скорость генерации")
+    parser.add_argument("--answer-tokens", type=int, default=80, help="длина ответа в токенах")
+    parser.add_argument("--search-latency-ms", type=float, default=30, help="задержка поиска Pinecone")
+    parser.add_argument("--chunk-chars", type=int, default=500, help="размер фрагмента корпуса в символах")
+    parser.add_argument("--dim", type=int, default=312, help="размерность векторов (rubert-tiny2 — 312)")
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description="Заменители Together и Pinecone для нагрузочных тестов")
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=9100)
+    add_arguments(parser)
+    args = parser.parse_args()
+    uvicorn.run(build_app(args), host=args.host, port=args.port, log_level="warning")
+
+
+if __name__ == "__main__":
+    main()
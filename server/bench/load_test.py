@@ -0,0 +1,336 @@
+"""
+Нагрузочный тест сервера без внешних API.
+
+Поднимает bench.fakes вместо Together и Pinecone, создаёт схему в одноразовой
+базе (SQLite во временном каталоге или --database-url), запускает uvicorn
+main:app с настройками на заменители и на каждом уровне конкурентности гоняет
+виртуальных пользователей: регистрация, вход, новый диалог, несколько реплик
+(обычных и потоковых), чтение истории и списка диалогов.
+
+По каждому эндпоинту считаются p50/p95/p99, запросы в секунду и доля ошибок;
+результат пишется в JSON вместе с коммитом и параметрами запуска, --compare
+печатает разницу с прошлым прогоном.
+
+    python -m bench.load_test --levels 1,8,32 --duration 30
+    python -m bench.load_test --compare bench/results/load-<коммит>.json
+"""
+import argparse
+import asyncio
+import json
+import os
+import random
+import subprocess
+import sys
+import tempfile
+import time
+import uuid
+from collections import defaultdict
+from typing import Optional
+
+import httpx
+import numpy as np
+
+from bench.fakes import add_arguments
+from bench.report import SERVER_DIR, run_meta, write_report
+
+PASSWORD = "bench-password"
+QUESTIONS = [
+    "Как получить великого учёного?",
+    "Чем полезен район кампус?",
+    "Как быстрее развить религию?",
+    "Какие чудеса света лучше строить в начале?",
+    "Как работает лояльность городов?",
+    "Как победить по науке?",
+    "Что дают городам-государствам посланники?",
+    "Как увеличить производство в городе?",
+]
+
+
+class Recorder:
+    def __init__(self):
+        self.samples: dict[str, list[float]] = defaultdict(list)
+        self.errors: dict[str, int] = defaultdict(int)
+
+    def add(self, endpoint: str, seconds: float, ok: bool) -> None:
+        self.samples[endpoint].append(seconds)
+        if not ok:
+            self.errors[endpoint] += 1
+
+    def summary(self, elapsed: float) -> dict:
+        def describe(samples: list[float], errors: int) -> dict:
+            values = np.asarray(samples) * 1000
+            return {
+                "count": len(samples),
+                "errors": errors,
+                "error_rate": errors / len(samples) if samples else 0.0,
+                "rps": len(samples) / elapsed if elapsed else 0.0,
+                "mean_ms": float(values.mean()) if len(values) else None,
+                "p50_ms": float(np.percentile(values, 50)) if len(values) else None,
+                "p95_ms": float(np.percentile(values, 95)) if len(values) else None,
+                "p99_ms": float(np.percentile(values, 99)) if len(values) else None,
+            }
+
+        endpoints = {name: describe(samples, self.errors[name]) for name, samples in sorted(self.samples.items())}
+        # первый токен — часть потокового запроса, в общий итог не входит
+        requests = [name for name in self.samples if name != "stream first token"]
+        total = describe(
+            [s for name in requests for s in self.samples[name]],
+            sum(self.errors[name] for name in requests),
+        )
+        return {"endpoints": endpoints, "total": total}
+
+
+class VirtualUser:
+    def __init__(self, client: httpx.AsyncClient, recorder: Recorder, args, run_id: str, number: int):
+        self.client = client
+        self.recorder = recorder
+        self.args = args
+        # имя пользователя ограничено 20 символами
+        self.prefix = f"b{run_id}{number}"
+        self.iteration = 0
+        self.rng = random.Random(number)
+
+    async def request(self, endpoint: str, method: str, url: str, **kwargs) -> Optional[httpx.Response]:
+        started = time.perf_counter()
+        try:
+            resp = await self.client.request(method, url, **kwargs)
+        except httpx.HTTPError:
+            self.recorder.add(endpoint, time.perf_counter() - started, False)
+            return None
+        self.recorder.add(endpoint, time.perf_counter() - started, resp.status_code < 400)
+        return resp if resp.status_code < 400 else None
+
+    async def stream(self, url: str, headers: dict, body: dict) -> bool:
+        started = time.perf_counter()
+        first_token = None
+        ok = False
+        try:
+            async with self.client.stream("POST", url, json=body, headers=headers) as resp:
+                async for line in resp.aiter_lines():
+                    if line == "event: token" and first_token is None:
+                        first_token = time.perf_counter() - started
+                    elif line in ("event: done", "event: error"):
+                        ok = line == "event: done" and resp.status_code < 400
+                ok = ok and resp.status_code < 400
+        except httpx.HTTPError:
+            ok = False
+        self.recorder.add("POST /dialogs/{id}/messages/stream", time.perf_counter() - started, ok)
+        if first_token is not None:
+            self.recorder.add("stream first token", first_token, True)
+        return ok
+
+    async def scenario(self) -> bool:
+        self.iteration += 1
+        name = f"{self.prefix}i{self.iteration}"
+        resp = await self.request(
+            "POST /register", "POST", "/register",
+            json={"email": f"{name}@example.com", "password": PASSWORD, "name": name},
+        )
+        if resp is None:
+            return False
+        resp = await self.request("POST /login", "POST", "/login", data={"username": name, "password": PASSWORD})
+        if resp is None:
+            return False
+        headers = {"Authorization": f"Bearer {resp.json()['access_token']}"}
+        resp = await self.request(
+            "POST /dialogs", "POST", "/dialogs", json={"user_id": 0, "name": "bench"}, headers=headers
+        )
+        if resp is None:
+            return False
+        dialog_id = resp.json()["dialog_id"]
+        for _ in range(self.args.turns):
+            body = {"text": self.rng.choice(QUESTIONS), "dialog_id": dialog_id}
+            if self.rng.random() < self.args.stream_share:
+                await self.stream(f"/dialogs/{dialog_id}/messages/stream", headers, body)
+            else:
+                await self.request(
+                    "POST /dialogs/{id}/messages", "POST", f"/dialogs/{dialog_id}/messages",
+                    json=body, headers=headers,
+                )
+            await asyncio.sleep(self.args.think_time)
+        await self.request("GET /dialogs/{id}/messages", "GET", f"/dialogs/{dialog_id}/messages", headers=headers)
+        await self.request("GET /dialogs", "GET", "/dialogs", headers=headers)
+        return True
+
+    async def run(self, deadline: float) -> None:
+        while time.perf_counter() < deadline:
+            if not await self.scenario():
+                # без паузы упавший сценарий забьёт отчёт тысячами мгновенных ошибок
+                await asyncio.sleep(0.5)
+
+
+async def run_level(base_url: str, args, concurrency: int, run_id: str) -> dict:
+    recorder = Recorder()
+    limits = httpx.Limits(max_connections=concurrency * 2, max_keepalive_connections=concurrency * 2)
+    async with httpx.AsyncClient(base_url=base_url, timeout=args.request_timeout, limits=limits) as client:
+        started = time.perf_counter()
+        deadline = started + args.duration
+        users = [VirtualUser(client, recorder, args, f"{run_id}c{concurrency}u", n) for n in range(concurrency)]
+        await asyncio.gather(*(user.run(deadline) for user in users))
+        elapsed = time.perf_counter() - started
+    return {"concurrency": concurrency, "elapsed": elapsed, **recorder.summary(elapsed)}
+
+
+async def create_schema(database_url: str) -> None:
+    from sqlalchemy.ext.asyncio import create_async_engine
+
+    import models  # noqa: F401 — регистрирует таблицы в Base.metadata
+    from database import Base
+
+    engine = create_async_engine(database_url.replace("postgresql://", "postgresql+asyncpg://"))
+    async with engine.begin() as conn:
+        await conn.run_sync(Base.metadata.create_all)
+    await engine.dispose()
+
+
+def wait_ready(url: str, process: subprocess.Popen, timeout: float) -> None:
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        if process.poll() is not None:
+            raise RuntimeError(f"Процесс {process.args} завершился с кодом {process.returncode}")
+        try:
+            if httpx.get(url, timeout=2).status_code == 200:
+                return
+        except httpx.HTTPError:
+            pass
+        time.sleep(0.5)
+    raise RuntimeError(f"{url} не ответил за {timeout:.0f}s")
+
+
+def print_level(level: dict) -> None:
+    print(f"\nКонкурентность {level['concurrency']} ({level['elapsed']:.1f}s)")
+    print(f"{'эндпоинт':<38}{'запросов':>9}{'rps':>8}{'ошибок':>8}{'p50':>9}{'p95':>9}{'p99':>9}")
+    rows = list(level["endpoints"].items()) + [("итого", level["total"])]
+    for name, stats in rows:
+        if not stats["count"]:
+            continue
+        print(
+            f"{name:<38}{stats['count']:>9}{stats['rps']:>8.1f}{stats['error_rate']:>7.1%}"
+            f"{stats['p50_ms']:>9.0f}{stats['p95_ms']:>9.0f}{stats['p99_ms']:>9.0f}"
+        )
+
+
+def compare(previous_path: str, current: dict) -> None:
+    with open(previous_path, encoding="utf-8") as f:
+        previous = json.load(f)
+    before = {level["concurrency"]: level for level in previous["levels"]}
+    print(f"\nСравнение с {previous['meta'].get('commit', '')[:10]} ({previous_path}):")
+    for level in current["levels"]:
+        old = before.get(level["concurrency"])
+        if old is None:
+            continue
+        for name, stats in list(level["endpoints"].items()) + [("итого", level["total"])]:
+            old_stats = old["total"] if name == "итого" else old["endpoints"].get(name)
+            if not old_stats or not old_stats["count"] or not stats["count"]:
+                continue
+            print(
+                f"  c={level['concurrency']:<4}{name:<38}"
+                f"p95 {old_stats['p95_ms']:.0f} -> {stats['p95_ms']:.0f} ms "
+                f"({(stats['p95_ms'] / old_stats['p95_ms'] - 1):+.0%}), "
+                f"rps {old_stats['rps']:.1f} -> {stats['rps']:.1f}"
+            )
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description="Нагрузочный тест сервера CivBot с заменителями внешних API")
+    parser.add_argument("--levels", default="1,4,16", help="уровни конкурентности через запятую")
+    parser.add_argument("--duration", type=float, default=30, help="секунд на уровень")
+    parser.add_argument("--turns", type=int, default=3, help="реплик в диалоге за сценарий")
+    parser.add_argument("--stream-share", type=float, default=0.5, help="доля потоковых реплик")
+    parser.add_argument("--think-time", type=float, default=0.0, help="пауза между репликами, с")
+    parser.add_argument("--request-timeout", type=float, default=120)
+    parser.add_argument("--database-url", help="одноразовая база PostgreSQL; по умолчанию SQLite во временном каталоге")
+    parser.add_argument("--workers", type=int, default=1, help="воркеров uvicorn")
+    parser.add_argument("--app-port", type=int, default=8100)
+    parser.add_argument("--fakes-port", type=int, default=9100)
+    parser.add_argument("--answer-cache", action="store_true", help="не отключать кеш ответов")
+    parser.add_argument("--coalesce", action="store_true", help="не отключать объединение одинаковых вопросов")
+    parser.add_argument("--startup-timeout", type=float, default=300)
+    parser.add_argument("--out", help="файл результата; по умолчанию bench/results/load-<коммит>-<время>.json")
+    parser.add_argument("--compare", help="прошлый результат для сравнения")
+    add_arguments(parser)
+    args = parser.parse_args()
+    levels = [int(level) for level in args.levels.split(",")]
+
+    tmp = tempfile.TemporaryDirectory(prefix="civbot-bench-")
+    database_url = args.database_url or f"sqlite+aiosqlite:///{os.path.join(tmp.name, 'bench.db')}"
+    fakes_url = f"http://127.0.0.1:{args.fakes_port}"
+    app_url = f"http://127.0.0.1:{args.app_port}"
+    env = {
+        **os.environ,
+        "DATABASE_URL": database_url,
+        "TOGETHER_BASE_URL": f"{fakes_url}/v1",
+        "TOGETHER_API_KEY": "bench",
+        "VECTOR_BACKEND": "pinecone",
+        "PINECONE_API_KEY": "bench",
+        "PINECONE_CONTROLLER_HOST": fakes_url,
+        "LOG_LEVEL": "WARNING",
+        "SLOW_REQUEST_SECONDS": "inf",
+    }
+    if not args.answer_cache:
+        env["ANSWER_CACHE_SIZE"] = "0"
+    # вопросов в сценарии немного, и объединение скрыло бы стоимость генерации
+    if not args.coalesce:
+        env["COALESCE_REQUESTS"] = "false"
+    fake_args = [
+        "--llm-ttft-ms", str(args.llm_ttft_ms),
+        "--llm-tokens-per-sec", str(args.llm_tokens_per_sec),
+        "--answer-tokens", str(args.answer_tokens),
+        "--search-latency-ms", str(args.search_latency_ms),
+        "--chunk-chars", str(args.chunk_chars),
+        "--dim", str(args.dim),
+    ]
+
+    os.environ["DATABASE_URL"] = database_url
+    asyncio.run(create_schema(database_url))
+
+    processes = []
+    try:
+        fakes = subprocess.Popen(
+            [sys.executable, "-m", "bench.fakes", "--port", str(args.fakes_port), *fake_args], cwd=SERVER_DIR
+        )
+        processes.append(fakes)
+        wait_ready(f"{fakes_url}/stats", fakes, args.startup_timeout)
+        app = subprocess.Popen(
+            [
+                sys.executable, "-m", "uvicorn", "main:app",
+                "--host", "127.0.0.1", "--port", str(args.app_port),
+                "--workers", str(args.workers), "--log-level", "warning",
+            ],
+            cwd=SERVER_DIR,
+            env=env,
+        )
+        processes.append(app)
+        print("Ожидание прогрева сервера...")
+        wait_ready(f"{app_url}/health", app, args.startup_timeout)
+
+        run_id = uuid.uuid4().hex[:4]
+        results = []
+        for concurrency in levels:
+            level = asyncio.run(run_level(app_url, args, concurrency, run_id))
+            print_level(level)
+            results.append(level)
+    finally:
+        for process in reversed(processes):
+            process.terminate()
+            try:
+                process.wait(timeout=10)
+            except subprocess.TimeoutExpired:
+                process.kill()
+        tmp.cleanup()
+
+    report = {
+        "meta": {
+            **run_meta(args, exclude=("database_url", "out", "compare")),
+            "database": "postgresql" if args.database_url else "sqlite",
+        },
+        "levels": results,
+    }
+    out = write_report("load", report, args.out)
+    print(f"\nРезультат: {out}")
+    if args.compare:
+        compare(args.compare, report)
+
+
+if __name__ == "__main__":
+    main()
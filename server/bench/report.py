@@ -0,0 +1,37 @@
+"""Общее для отчётов бенчмарков: коммит, параметры запуска и файл результата."""
+import json
+import os
+import subprocess
+import time
+from typing import Optional
+
+SERVER_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+RESULTS_DIR = os.path.join(SERVER_DIR, "bench", "results")
+
+
+def git_commit() -> dict:
+    def git(*cmd: str) -> str:
+        try:
+            return subprocess.run(["git", *cmd], cwd=SERVER_DIR, capture_output=True, text=True).stdout.strip()
+        except OSError:
+            return ""
+
+    return {"commit": git("rev-parse", "HEAD"), "dirty": bool(git("status", "--porcelain", "--", "."))}
+
+
+def run_meta(args, exclude: tuple[str, ...] = ()) -> dict:
+    return {
+        **git_commit(),
+        "timestamp": time.strftime("%Y-%m-%dT%H:%M:%S"),
+        "args": {key: value for key, value in vars(args).items() if key not in exclude},
+    }
+
+
+def write_report(kind: str, report: dict, out: Optional[str] = None) -> str:
+    """Пишет отчёт в out или в bench/results/<kind>-<коммит>-<время>.json."""
+    commit = report["meta"].get("commit", "")[:10] or "nogit"
+    out = out or os.path.join(RESULTS_DIR, f"{kind}-{commit}-{time.strftime('%Y%m%d-%H%M%S')}.json")
+    os.makedirs(os.path.dirname(os.path.abspath(out)), exist_ok=True)
+    with open(out, "w", encoding="utf-8") as f:
+        json.dump(report, f, ensure_ascii=False, indent=2)
+    return out
@@ -0,0 +1,224 @@
+"""
+Оценка качества и скорости поиска по базе знаний.
+
+Золотой набор bench/golden_ru.jsonl — вопросы и дословные отрывки корпуса,
+которые на них отвечают. Для каждого порога разбиения корпус один раз
+разбивается и индексируется в локальное хранилище (как knowledge_base_updater
+с VECTOR_BACKEND=local), затем каждая конфигурация (порог, top_k, реранкер)
+прогоняет набор по тому же пути, что и сервер: эмбеддинг вопроса, поиск,
+отбор по MMR, реранкинг и укладка контекста в бюджет.
+
+В таблице:
+    recall@k — доля отрывков, найденных среди top_k фрагментов поиска;
+    MRR      — средний обратный ранг первого подходящего фрагмента;
+    ctx      — доля отрывков, доживших до собранного контекста;
+    токены   — средний размер контекста в токенах (меняющаяся часть промпта);
+    задержки стадий — медианы по вопросам, мс.
+
+    python -m bench.retrieval_eval
+    python -m bench.retrieval_eval --thresholds 60,90 --top-k 3,5,10 --rerank none,embedding,cross_encoder
+
+alpha гибридного поиска Pinecone здесь не оценивается: локальный индекс
+только плотный.
+"""
+import argparse
+import asyncio
+import itertools
+import json
+import os
+import re
+import tempfile
+import time
+from dataclasses import dataclass
+
+import numpy as np
+
+from app_config import settings
+from bench.report import SERVER_DIR, run_meta, write_report
+from context_assembly import ContextAssembler
+from embeddings import EMBED_MODEL_NAME, CachedQueryEmbedder, QueryEmbeddingCache, build_embed_model
+from history import token_counter
+from knowledge_base_updater import DATA_DIR, MemoizingEmbedding, chunk_id
+from local_store import StoredChunk, write_store
+from reranker import build_reranker
+from retrieval import LocalRetriever
+
+GOLDEN_SET = os.path.join(SERVER_DIR, "bench", "golden_ru.jsonl")
+STAGES = ("embedding", "search", "mmr", "rerank", "total")
+
+
+@dataclass
+class GoldenItem:
+    question: str
+    relevant: list[str]
+
+
+def normalize(text: str) -> str:
+    return re.sub(r"\s+", " ", text).casefold().replace("ё", "е").strip()
+
+
+def load_golden(path: str) -> list[GoldenItem]:
+    with open(path, encoding="utf-8") as f:
+        return [GoldenItem(**json.loads(line)) for line in f if line.strip()]
+
+
+def build_index(embed_model: MemoizingEmbedding, threshold: float, store_dir: str) -> int:
+    """Разбивает корпус с заданным порогом и записывает локальное хранилище."""
+    from llama_index.core import SimpleDirectoryReader
+    from llama_index.core.node_parser import SemanticSplitterNodeParser
+
+    data_dir = os.path.join(SERVER_DIR, DATA_DIR)
+    splitter = SemanticSplitterNodeParser(
+        embed_model=embed_model, buffer_size=2, breakpoint_percentile_threshold=threshold
+    )
+    documents = SimpleDirectoryReader(input_dir=data_dir, recursive=True).load_data()
+    chunks, seen = [], set()
+    for node in splitter.get_nodes_from_documents(documents, show_progress=False):
+        text = node.get_content()
+        doc_key = os.path.relpath(node.metadata.get("file_path", ""), data_dir)
+        cid = chunk_id(doc_key, text)
+        if cid not in seen:
+            seen.add(cid)
+            chunks.append(StoredChunk(id=cid, text=text, metadata={"file_name": node.metadata.get("file_name", "")}))
+    write_store(store_dir, chunks, embed_model.embed_chunks([chunk.text for chunk in chunks]), EMBED_MODEL_NAME)
+    return len(chunks)
+
+
+class TimedReranker:
+    """Реранкер с замером времени последнего вызова."""
+
+    def __init__(self, inner):
+        self.inner = inner
+        self.last = 0.0
+
+    async def rerank(self, query: str, fragments: list[str], top_k: int):
+        started = time.perf_counter()
+        try:
+            return await self.inner.rerank(query, fragments, top_k)
+        finally:
+            self.last = time.perf_counter() - started
+
+
+async def evaluate(embed_model, store_dir: str, top_k: int, rerank_mode: str, golden: list[GoldenItem], args) -> dict:
+    embedder = CachedQueryEmbedder(embed_model, QueryEmbeddingCache(4096, 3600), EMBED_MODEL_NAME)
+    retriever = LocalRetriever(embedder, top_k, store_dir)
+    system_prompt = ""
+    if rerank_mode == "llm":
+        from LLM_model import SYSTEM_PROMPT as system_prompt
+    from llm_client import llm_client
+
+    reranker = TimedReranker(build_reranker(rerank_mode, embedder, llm_client, system_prompt))
+    assembler = ContextAssembler(
+        embedder,
+        reranker,
+        token_counter,
+        mmr_chunks=args.mmr_chunks,
+        mmr_lambda=settings.CONTEXT_MMR_LAMBDA,
+        max_tokens=settings.CONTEXT_MAX_TOKENS,
+        rerank_top_k=args.rerank_top_k,
+    )
+    # прогон без замеров: кеши эмбеддингов фрагментов прогреваются, как на
+    # работающем сервере, а кеш вопросов сбрасывается, чтобы их эмбеддинг
+    # в замере считался заново
+    for item in golden:
+        query_embedding = await embedder.aget_query_embedding(item.question)
+        await assembler.assemble(item.question, retriever.search(item.question, query_embedding))
+    embedder.cache = QueryEmbeddingCache(4096, 3600)
+
+    recall, reciprocal, context_recall, tokens = [], [], [], []
+    latency = {stage: [] for stage in STAGES}
+    for item in golden:
+        started = time.perf_counter()
+        query_embedding = await embedder.aget_query_embedding(item.question)
+        embedded = time.perf_counter()
+        hits = await asyncio.to_thread(retriever.search, item.question, query_embedding)
+        searched = time.perf_counter()
+        context = await assembler.assemble(item.question, hits)
+        finished = time.perf_counter()
+
+        relevant = [normalize(passage) for passage in item.relevant]
+        texts = [normalize(hit.text) for hit in hits]
+        recall.append(np.mean([any(passage in text for text in texts) for passage in relevant]))
+        ranks = [rank for rank, text in enumerate(texts, 1) if any(passage in text for passage in relevant)]
+        reciprocal.append(1 / ranks[0] if ranks else 0.0)
+        rendered = normalize(context.render())
+        context_recall.append(np.mean([passage in rendered for passage in relevant]))
+        tokens.append(context.tokens)
+
+        latency["embedding"].append(embedded - started)
+        latency["search"].append(searched - embedded)
+        latency["rerank"].append(reranker.last)
+        latency["mmr"].append(finished - searched - reranker.last)
+        latency["total"].append(finished - started)
+
+    return {
+        "top_k": top_k,
+        "rerank": rerank_mode,
+        "recall_at_k": float(np.mean(recall)),
+        "mrr": float(np.mean(reciprocal)),
+        "context_recall": float(np.mean(context_recall)),
+        "context_tokens": float(np.mean(tokens)),
+        "latency_p50_ms": {stage: float(np.median(values) * 1000) for stage, values in latency.items()},
+        "latency_p95_ms": {stage: float(np.percentile(values, 95) * 1000) for stage, values in latency.items()},
+    }
+
+
+def print_table(results: list[dict]) -> None:
+    header = (
+        f"{'порог':>6}{'фрагм.':>7}{'top_k':>6} {'реранкер':<14}{'recall@k':>9}{'MRR':>7}{'ctx':>7}{'токены':>8}"
+        + "".join(f"{stage:>10}" for stage in STAGES)
+    )
+    print(header)
+    print("-" * len(header))
+    for row in results:
+        print(
+            f"{row['threshold']:>6g}{row['chunks']:>7}{row['top_k']:>6} {row['rerank']:<14}"
+            f"{row['recall_at_k']:>9.3f}{row['mrr']:>7.3f}{row['context_recall']:>7.3f}{row['context_tokens']:>8.0f}"
+            + "".join(f"{row['latency_p50_ms'][stage]:>10.1f}" for stage in STAGES)
+        )
+    print("задержки — медианы, мс, кеши фрагментов прогреты")
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description="Оценка качества и скорости поиска по базе знаний")
+    parser.add_argument("--golden", default=GOLDEN_SET, help="золотой набор в формате jsonl")
+    parser.add_argument("--thresholds", default="60,90", help="breakpoint_percentile_threshold разбивателя")
+    parser.add_argument("--top-k", default="3,5,10", help="similarity_top_k поиска")
+    parser.add_argument("--rerank", default="none,embedding", help="none | embedding | cross_encoder | llm")
+    parser.add_argument("--rerank-top-k", type=int, default=settings.RERANK_TOP_K)
+    parser.add_argument("--mmr-chunks", type=int, default=settings.CONTEXT_MMR_CHUNKS)
+    parser.add_argument("--embed-backend", default=None, help="torch | onnx, по умолчанию EMBED_BACKEND")
+    parser.add_argument("--out", help="файл результата; по умолчанию bench/results/retrieval-<коммит>-<время>.json")
+    args = parser.parse_args()
+
+    golden = load_golden(args.golden)
+    token_counter.load()
+    # память эмбеддингов нужна только разбивателю (оба порога эмбеддят одни
+    # и те же группы предложений); поиск идёт через модель напрямую
+    embed_model = build_embed_model(args.embed_backend)
+    indexing_model = MemoizingEmbedding(inner=embed_model)
+    results = []
+    with tempfile.TemporaryDirectory(prefix="civbot-eval-") as tmp:
+        for threshold in [float(value) for value in args.thresholds.split(",")]:
+            store_dir = os.path.join(tmp, f"t{threshold:g}")
+            started = time.perf_counter()
+            chunks = build_index(indexing_model, threshold, store_dir)
+            print(f"Порог {threshold:g}: {chunks} фрагментов, индекс за {time.perf_counter() - started:.1f}s")
+            configs = itertools.product(
+                [int(value) for value in args.top_k.split(",")], args.rerank.split(",")
+            )
+            for top_k, rerank_mode in configs:
+                row = asyncio.run(evaluate(embed_model, store_dir, top_k, rerank_mode, golden, args))
+                results.append({"threshold": threshold, "chunks": chunks, **row})
+
+    print()
+    print_table(results)
+    report = {
+        "meta": {**run_meta(args, exclude=("out",)), "questions": len(golden)},
+        "results": results,
+    }
+    print(f"\nРезультат: {write_report('retrieval', report, args.out)}")
+
+
+if __name__ == "__main__":
+    main()
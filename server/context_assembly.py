@@ -0,0 +1,177 @@
+"""
+Сборка контекста промпта из найденных фрагментов базы знаний.
+
+Сначала из найденных фрагментов по MMR (maximal marginal relevance)
+отбираются самые релевантные и при этом непохожие друг на друга, чтобы
+пересказы одного и того же не вытесняли остальное. Затем их строки
+дедуплицируются, ранжируются реранкером (RERANK_MODE) и укладываются в
+бюджет CONTEXT_MAX_TOKENS вместе с источником каждой строки. Размер
+контекста, а с ним и время генерации, ограничены сверху.
+"""
+import asyncio
+import re
+import threading
+from collections import OrderedDict
+from dataclasses import dataclass, field
+
+import numpy as np
+
+from metrics import track_stage
+from retrieval import RetrievedChunk
+
+
+@dataclass
+class ContextFragment:
+    text: str
+    chunk_id: str
+    source: str
+    score: float = 0.0
+
+
+@dataclass
+class AssembledContext:
+    fragments: list[ContextFragment] = field(default_factory=list)
+    tokens: int = 0
+
+    def render(self) -> str:
+        return "\n".join(
+            f"[{frag.source}] {frag.text}" if frag.source else frag.text
+            for frag in self.fragments
+        )
+
+    @property
+    def sources(self) -> list[dict]:
+        seen = {}
+        for frag in self.fragments:
+            seen.setdefault(frag.chunk_id, {"chunk_id": frag.chunk_id, "source": frag.source})
+        return list(seen.values())
+
+
+def mmr(query_vec: np.ndarray, vectors: np.ndarray, k: int, lambda_mult: float) -> list[int]:
+    """Индексы k строк vectors в порядке отбора по MMR."""
+    if len(vectors) == 0 or k <= 0:
+        return []
+    unit = vectors / np.maximum(np.linalg.norm(vectors, axis=1, keepdims=True), 1e-12)
+    query = query_vec / max(float(np.linalg.norm(query_vec)), 1e-12)
+    relevance = unit @ query
+    similarity = unit @ unit.T
+    selected = [int(np.argmax(relevance))]
+    # максимальная близость каждого кандидата к уже отобранным
+    redundancy = similarity[selected[0]].copy()
+    while len(selected) < min(k, len(vectors)):
+        scores = lambda_mult * relevance - (1 - lambda_mult) * redundancy
+        scores[selected] = -np.inf
+        best = int(np.argmax(scores))
+        selected.append(best)
+        redundancy = np.maximum(redundancy, similarity[best])
+    return selected
+
+
+def fragment_key(text: str) -> str:
+    return re.sub(r"\s+", " ", text).strip().casefold()
+
+
+class ContextAssembler:
+    def __init__(
+        self,
+        embed_model,
+        reranker,
+        token_counter,
+        mmr_chunks: int,
+        mmr_lambda: float,
+        max_tokens: int,
+        rerank_top_k: int,
+        cache_size: int = 10000,
+    ):
+        self.embed_model = embed_model
+        self.reranker = reranker
+        self.token_counter = token_counter
+        self.mmr_chunks = mmr_chunks
+        self.mmr_lambda = mmr_lambda
+        self.max_tokens = max_tokens
+        self.rerank_top_k = rerank_top_k
+        self.cache_size = cache_size
+        self._vectors: OrderedDict[str, np.ndarray] = OrderedDict()
+        self._lock = threading.Lock()
+
+    def _chunk_matrix(self, hits: list[RetrievedChunk]) -> np.ndarray:
+        # локальное хранилище отдаёт эмбеддинги вместе с фрагментами,
+        # для остальных бэкендов они считаются один раз и кешируются по id
+        vectors: dict[str, np.ndarray] = {}
+        with self._lock:
+            for hit in hits:
+                if hit.embedding is not None:
+                    vectors[hit.id] = np.asarray(hit.embedding, dtype=np.float32)
+                elif hit.id in self._vectors:
+                    self._vectors.move_to_end(hit.id)
+                    vectors[hit.id] = self._vectors[hit.id]
+        missing = [hit for hit in hits if hit.id not in vectors]
+        if missing:
+            embedded = self.embed_model.get_text_embedding_batch([hit.text for hit in missing])
+            with self._lock:
+                for hit, vec in zip(missing, embedded):
+                    vectors[hit.id] = self._vectors[hit.id] = np.asarray(vec, dtype=np.float32)
+                while len(self._vectors) > self.cache_size:
+                    self._vectors.popitem(last=False)
+        return np.vstack([vectors[hit.id] for hit in hits])
+
+    async def select_chunks(self, query: str, hits: list[RetrievedChunk]) -> list[RetrievedChunk]:
+        unique, seen = [], set()
+        for hit in hits:
+            key = fragment_key(hit.text)
+            if key and key not in seen:
+                seen.add(key)
+                unique.append(hit)
+        if len(unique) <= 1:
+            return unique
+        query_vec = np.asarray(await self.embed_model.aget_query_embedding(query), dtype=np.float32)
+        matrix = await asyncio.to_thread(self._chunk_matrix, unique)
+        return [unique[i] for i in mmr(query_vec, matrix, self.mmr_chunks, self.mmr_lambda)]
+
+    @staticmethod
+    def split_fragments(chunks: list[RetrievedChunk]) -> list[ContextFragment]:
+        fragments, seen = [], set()
+        for chunk in chunks:
+            source = chunk.metadata.get("file_name", "")
+            for line in chunk.text.splitlines():
+                line = line.strip()
+                if not line or line.startswith("file_path:"):
+                    continue
+                key = fragment_key(line)
+                if key in seen:
+                    continue
+                seen.add(key)
+                fragments.append(ContextFragment(line, chunk.id, source))
+        return fragments
+
+    def pack(self, ranked: list[ContextFragment]) -> AssembledContext:
+        """Укладывает фрагменты в порядке ранга в бюджет токенов."""
+        context = AssembledContext()
+        for frag in ranked:
+            remaining = self.max_tokens - context.tokens
+            if remaining <= 0:
+                break
+            tokens = self.token_counter.count(frag.text)
+            if tokens > remaining:
+                if context.fragments:
+                    # следующий, более короткий фрагмент ещё может поместиться
+                    continue
+                # самый релевантный фрагмент длиннее бюджета: обрезаем его
+                frag.text = frag.text[: max(1, len(frag.text) * remaining // tokens)]
+                tokens = self.token_counter.count(frag.text)
+            context.fragments.append(frag)
+            context.tokens += tokens
+        return context
+
+    async def assemble(self, query: str, hits: list[RetrievedChunk]) -> AssembledContext:
+        chunks = await self.select_chunks(query, hits)
+        fragments = self.split_fragments(chunks)
+        by_text = {frag.text: frag for frag in fragments}
+        with track_stage("rerank"):
+            selected = await self.reranker.rerank(query, list(by_text), self.rerank_top_k)
+        ranked = []
+        for scored in selected:
+            frag = by_text[scored.text]
+            frag.score = scored.score
+            ranked.append(frag)
+        return self.pack(ranked)
@@ -1,14 +1,15 @@
+from datetime import datetime
 from typing import List, Optional
 
-from sqlalchemy import select, delete
+from sqlalchemy import select, delete, func, insert, tuple_, update
 from sqlalchemy.exc import IntegrityError
 from fastapi import FastAPI, Depends, HTTPException
 from sqlalchemy.ext.asyncio import AsyncSession
-from sqlalchemy.orm import selectinload
+from sqlalchemy.orm import aliased, selectinload
 
 import models
 import schemas
-from auth import get_password_hash
+from auth import aget_password_hash
 
 
 
@@ -18,6 +19,10 @@ async def get_user_by_email(db: AsyncSession, email: str) -> Optional[models.Use
     return result.scalar_one_or_none()
 
 
+async def get_user_by_id(db: AsyncSession, user_id: int) -> Optional[models.User]:
+    return await db.get(models.User, user_id)
+
+
 async def get_user_by_name(db: AsyncSession, name: str) -> Optional[models.User]:
     stmt = select(models.User).where(models.User.name == name)
     result = await db.execute(stmt)
@@ -25,7 +30,7 @@ async def get_user_by_name(db: AsyncSession, name: str) -> Optional[models.User]
 
 
 async def create_user(db: AsyncSession, user_in: schemas.UserCreate) -> models.User:
-    hashed_password = get_password_hash(user_in.password)
+    hashed_password = await aget_password_hash(user_in.password)
     db_user = models.User(
         email=user_in.email,
         password_hash=hashed_password,
@@ -41,8 +46,40 @@ async def create_user(db: AsyncSession, user_in: schemas.UserCreate) -> models.U
     return db_user
 
 
-async def get_dialogs_by_user(db: AsyncSession, user_id: int) -> List[models.Dialog]:
-    stmt = select(models.Dialog).where(models.Dialog.user_id == user_id).order_by(models.Dialog.created_at)
+def keyset(
+    stmt,
+    created_col,
+    id_col,
+    limit: Optional[int],
+    after: Optional[tuple[datetime, int]],
+    desc: bool = False
+):
+    """
+    Сортировка по (created_at, id) и выборка строк строго после курсора after.
+
+    desc=True — от новых к старым: «после курсора» тогда значит «раньше него»,
+    и PostgreSQL читает тот же составной индекс в обратном направлении.
+    """
+    key = tuple_(created_col, id_col)
+    if after is not None:
+        stmt = stmt.where(key < tuple_(*after) if desc else key > tuple_(*after))
+    stmt = stmt.order_by(created_col.desc(), id_col.desc()) if desc else stmt.order_by(created_col, id_col)
+    if limit is not None:
+        stmt = stmt.limit(limit)
+    return stmt
+
+
+async def get_dialogs_by_user(
+    db: AsyncSession,
+    user_id: int,
+    limit: Optional[int] = None,
+    after: Optional[tuple[datetime, int]] = None,
+    desc: bool = False
+) -> List[models.Dialog]:
+    stmt = keyset(
+        select(models.Dialog).where(models.Dialog.user_id == user_id),
+        models.Dialog.created_at, models.Dialog.dialog_id, limit, after, desc
+    )
     result = await db.execute(stmt)
     return result.scalars().all()
 
@@ -61,32 +98,151 @@ async def create_dialog(db: AsyncSession, user_id: int, name: str) -> models.Dia
     return db_dialog
 
 
-async def get_messages_by_dialog(db: AsyncSession, dialog_id: int) -> List[models.Message]:
+async def get_messages_by_dialog(
+    db: AsyncSession,
+    dialog_id: int,
+    limit: Optional[int] = None,
+    after: Optional[tuple[datetime, int]] = None,
+    desc: bool = False
+) -> List[models.Message]:
+    stmt = keyset(
+        select(models.Message).where(models.Message.dialog_id == dialog_id),
+        models.Message.created_at, models.Message.message_id, limit, after, desc
+    )
+    result = await db.execute(stmt)
+    return result.scalars().all()
+
+
+async def get_messages_between(
+    db: AsyncSession,
+    dialog_id: int,
+    after_id: int,
+    before_id: int,
+    limit: int
+) -> List[models.Message]:
     stmt = (
         select(models.Message)
-        .where(models.Message.dialog_id == dialog_id)
-        .order_by(models.Message.created_at)
+        .where(
+            (models.Message.dialog_id == dialog_id) &
+            (models.Message.message_id > after_id) &
+            (models.Message.message_id < before_id)
+        )
+        .order_by(models.Message.message_id)
+        .limit(limit)
     )
     result = await db.execute(stmt)
     return result.scalars().all()
 
 
+async def update_dialog_summary(
+    db: AsyncSession,
+    dialog_id: int,
+    summary: str,
+    until_id: int,
+    previous_until_id: int
+) -> bool:
+    # обновляем, только если содержание не менялось с момента чтения
+    stmt = (
+        update(models.Dialog)
+        .where(
+            (models.Dialog.dialog_id == dialog_id) &
+            (func.coalesce(models.Dialog.summary_until_id, 0) == previous_until_id)
+        )
+        .values(summary=summary, summary_until_id=until_id)
+    )
+    result = await db.execute(stmt)
+    await db.commit()
+    return result.rowcount == 1
+
+
 async def create_message(
     db: AsyncSession,
     msg_in: schemas.MessageCreate,
-    is_bot: bool = False
+    user_id: int,
+    is_bot: bool = False,
+    sources: Optional[list] = None
 ) -> models.Message:
-    db_msg = models.Message(
-        dialog_id=msg_in.dialog_id,
-        text=msg_in.text,
-        type="bot" if is_bot else "user",
+    # RETURNING вместо refresh: одна команда вместо INSERT + SELECT
+    stmt = (
+        insert(models.Message)
+        .values(
+            dialog_id=msg_in.dialog_id,
+            user_id=user_id,
+            text=msg_in.text,
+            type="bot" if is_bot else "user",
+            sources=sources,
+        )
+        .returning(models.Message)
     )
-    db.add(db_msg)
+    db_msg = (await db.execute(stmt)).scalar_one()
     await db.commit()
-    await db.refresh(db_msg)
     return db_msg
 
 
+async def load_turn(
+    db: AsyncSession,
+    dialog_id: int,
+    user_id: int,
+    history_limit: int
+) -> tuple[models.Dialog, List[models.Message]]:
+    """
+    Диалог и его последние history_limit сообщений одним запросом.
+
+    Заодно проверяет, что диалог принадлежит пользователю. Транзакция чтения
+    сразу завершается: на время генерации ответа соединение возвращается в пул.
+    """
+    recent = (
+        select(models.Message)
+        .where(models.Message.dialog_id == dialog_id)
+        .order_by(models.Message.created_at.desc(), models.Message.message_id.desc())
+        .limit(history_limit)
+        .subquery()
+    )
+    message = aliased(models.Message, recent)
+    stmt = (
+        select(models.Dialog, message)
+        .outerjoin(recent, recent.c.dialog_id == models.Dialog.dialog_id)
+        .where(models.Dialog.dialog_id == dialog_id)
+        .order_by(recent.c.created_at, recent.c.message_id)
+    )
+    rows = (await db.execute(stmt)).all()
+    await db.commit()
+    if not rows:
+        raise HTTPException(status_code=404, detail="Dialog not found")
+    dialog = rows[0][0]
+    if dialog.user_id != user_id:
+        raise HTTPException(status_code=403, detail="Access denied")
+    return dialog, [row[1] for row in rows if row[1] is not None]
+
+
+async def save_turn(
+    db: AsyncSession,
+    dialog_id: int,
+    user_id: int,
+    user_text: str,
+    bot_text: str,
+    sources: Optional[list] = None
+) -> tuple[models.Message, models.Message]:
+    """Вопрос и ответ одной командой INSERT ... RETURNING в одной транзакции."""
+    stmt = (
+        insert(models.Message)
+        .values([
+            {"dialog_id": dialog_id, "user_id": user_id, "type": "user", "text": user_text, "sources": None},
+            {"dialog_id": dialog_id, "user_id": user_id, "type": "bot", "text": bot_text, "sources": sources},
+        ])
+        .returning(models.Message)
+    )
+    try:
+        saved = (await db.execute(stmt)).scalars().all()
+        await db.commit()
+    except IntegrityError:
+        # диалог удалили, пока генерировался ответ
+        await db.rollback()
+        raise HTTPException(status_code=404, detail="Dialog not found")
+    saved = sorted(saved, key=lambda m: m.message_id)
+    return saved[0], saved[1]
+
+
 async def get_user_review(
     db: AsyncSession,
     message_id: int,
@@ -142,17 +298,71 @@ async def get_dialog_share(db: AsyncSession, share_id: int) -> Optional[models.D
     return result.scalar_one_or_none()
 
 
-async def get_messages_by_user(db: AsyncSession, user_id: int) -> list[models.Message]:
-    stmt = (
-        select(models.Message)
-        .join(models.Dialog, models.Message.dialog_id == models.Dialog.dialog_id)
-        .where(models.Dialog.user_id == user_id)
-        .order_by(models.Message.created_at)
+async def get_messages_by_user(
+    db: AsyncSession,
+    user_id: int,
+    limit: Optional[int] = None,
+    after: Optional[tuple[datetime, int]] = None,
+    desc: bool = False
+) -> list[models.Message]:
+    stmt = keyset(
+        # messages.user_id денормализован, чтобы выборка шла по индексу
+        # ix_messages_user_created без соединения с dialogs
+        select(models.Message).where(models.Message.user_id == user_id),
+        models.Message.created_at, models.Message.message_id, limit, after, desc
     )
     result = await db.execute(stmt)
     return result.scalars().all()
 
 
+def _export_filter(stmt, dialog_id: Optional[int], user_id: Optional[int]):
+    stmt = stmt.select_from(models.Message).join(
+        models.Dialog, models.Message.dialog_id == models.Dialog.dialog_id
+    )
+    if dialog_id is not None:
+        return stmt.where(models.Message.dialog_id == dialog_id)
+    return stmt.where(models.Dialog.user_id == user_id)
+
+
+def export_rows_stmt(dialog_id: Optional[int] = None, user_id: Optional[int] = None):
+    """Сообщения диалога или всех диалогов пользователя для экспорта (только нужные колонки)."""
+    stmt = _export_filter(
+        select(
+            models.Message.dialog_id,
+            models.Dialog.name.label("dialog_name"),
+            models.Message.message_id,
+            models.Message.type,
+            models.Message.text,
+            models.Message.created_at,
+        ),
+        dialog_id,
+        user_id,
+    )
+    return stmt.order_by(
+        models.Dialog.created_at,
+        models.Dialog.dialog_id,
+        models.Message.created_at,
+        models.Message.message_id,
+    )
+
+
+def export_state_stmt(dialog_id: Optional[int] = None, user_id: Optional[int] = None):
+    """
+    Время и id последнего сообщения, время последней правки и число
+    сообщений — основа ETag экспорта.
+    """
+    return _export_filter(
+        select(
+            func.max(models.Message.created_at),
+            func.max(models.Message.message_id),
+            func.max(models.Message.updated_at),
+            func.count(models.Message.message_id),
+        ),
+        dialog_id,
+        user_id,
+    )
+
+
 async def get_message_by_id(
     db: AsyncSession,
     message_id: int
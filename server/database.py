@@ -2,6 +2,7 @@ from sqlalchemy.ext.asyncio import create_async_engine
 from sqlalchemy.ext.asyncio import AsyncSession, async_sessionmaker
 from sqlalchemy.orm import declarative_base
 from app_config import settings
+from metrics import instrument_engine
 
 
 # Асинхронный URL: добавляем +asyncpg
@@ -12,8 +13,10 @@ ASYNC_DATABASE_URL = settings.DATABASE_URL.replace(
 # создаём асинхронный движок
 engine = create_async_engine(
     ASYNC_DATABASE_URL,
-    echo=True,  # включить SQL-логирование при желании
+    echo=settings.SQL_ECHO,  # SQL-логирование только для отладки
 )
+# длительность каждого запроса уходит в civbot_db_query_seconds
+instrument_engine(engine)
 
 # фабрика асинхронных сессий
 async_session = async_sessionmaker(
@@ -0,0 +1,405 @@
+import argparse
+import asyncio
+import json
+import os
+import re
+import sys
+import threading
+import time
+from collections import OrderedDict
+from typing import Optional
+
+import numpy as np
+from llama_index.core.embeddings import BaseEmbedding
+from pydantic import PrivateAttr
+
+from app_config import settings
+
+EMBED_MODEL_NAME = "cointegrated/rubert-tiny2"
+ONNX_MODEL_FILE = "model.int8.onnx"
+
+
+def normalize_query(text: str) -> str:
+    """Ключ кеша: регистр и пробелы не влияют на смысл вопроса."""
+    return re.sub(r"\s+", " ", text).strip().lower()
+
+
+class QueryEmbeddingCache:
+    """
+    LRU-кеш эмбеддингов запросов с TTL и счётчиками попаданий.
+
+    Второй уровень (необязательный) — diskcache на диске: переживает
+    перезапуск и общий для всех воркеров на машине. Асинхронный код зовёт
+    aget/aset: память проверяется сразу, а диск — в пуле потоков, чтобы
+    SQLite diskcache не блокировал event loop.
+    """
+
+    def __init__(self, max_size: int, ttl: float, disk_dir: Optional[str] = None):
+        self.max_size = max_size
+        self.ttl = ttl
+        self._items: OrderedDict[str, tuple[float, list[float]]] = OrderedDict()
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.disk_hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self._disk = None
+        if disk_dir:
+            import diskcache
+
+            self._disk = diskcache.Cache(disk_dir)
+
+    def get(self, key: str) -> Optional[list[float]]:
+        vec = self._get_memory(key)
+        if vec is None and self._disk is not None:
+            vec = self._get_disk(key)
+        return self._count_miss(vec)
+
+    async def aget(self, key: str) -> Optional[list[float]]:
+        """Как get, но запрос к диску (SQLite diskcache) идёт в пуле потоков."""
+        vec = self._get_memory(key)
+        if vec is None and self._disk is not None:
+            vec = await asyncio.to_thread(self._get_disk, key)
+        return self._count_miss(vec)
+
+    def set(self, key: str, vec: list[float]) -> None:
+        self._put_memory(key, vec)
+        if self._disk is not None:
+            self._disk.set(key, vec, expire=self.ttl)
+
+    async def aset(self, key: str, vec: list[float]) -> None:
+        self._put_memory(key, vec)
+        if self._disk is not None:
+            await asyncio.to_thread(self._disk.set, key, vec, expire=self.ttl)
+
+    def _get_memory(self, key: str) -> Optional[list[float]]:
+        now = time.monotonic()
+        with self._lock:
+            item = self._items.get(key)
+            if item is not None:
+                expires_at, vec = item
+                if expires_at > now:
+                    self._items.move_to_end(key)
+                    self.hits += 1
+                    return vec
+                del self._items[key]
+        return None
+
+    def _get_disk(self, key: str) -> Optional[list[float]]:
+        vec = self._disk.get(key)
+        if vec is not None:
+            self._put_memory(key, vec)
+            with self._lock:
+                self.disk_hits += 1
+        return vec
+
+    def _count_miss(self, vec: Optional[list[float]]) -> Optional[list[float]]:
+        if vec is None:
+            with self._lock:
+                self.misses += 1
+        return vec
+
+    def _put_memory(self, key: str, vec: list[float]) -> None:
+        with self._lock:
+            self._items[key] = (time.monotonic() + self.ttl, vec)
+            self._items.move_to_end(key)
+            while len(self._items) > self.max_size:
+                self._items.popitem(last=False)
+                self.evictions += 1
+
+    def stats(self) -> dict:
+        with self._lock:
+            lookups = self.hits + self.disk_hits + self.misses
+            return {
+                "size": len(self._items),
+                "hits": self.hits,
+                "disk_hits": self.disk_hits,
+                "misses": self.misses,
+                "evictions": self.evictions,
+                "hit_rate": (self.hits + self.disk_hits) / lookups if lookups else 0.0,
+            }
+
+
+class MicroBatchEmbedder:
+    """
+    Общий для всех запросов процесса эмбеддер с микробатчингом.
+
+    Вопросы, пришедшие в пределах max_wait от самого раннего из ожидающих,
+    собираются в одну пачку (не больше max_batch_size) и проходят через модель
+    одним вызовом в пуле потоков; каждый вызывающий получает свой вектор.
+    Пока модель считает пачку, следующая копится, поэтому под нагрузкой
+    пачки растут сами, а одиночный запрос ждёт не дольше max_wait.
+    """
+
+    def __init__(self, embed_model, max_batch_size: int, max_wait: float):
+        self.embed_model = embed_model
+        self.max_batch_size = max(1, max_batch_size)
+        self.max_wait = max(0.0, max_wait)
+        self._pending: list[tuple[str, float, asyncio.Future]] = []
+        self._worker: Optional[asyncio.Task] = None
+        self._full: Optional[asyncio.Event] = None
+        self.batches = 0
+        self.items = 0
+        self.max_seen = 0
+
+    async def embed(self, text: str) -> list[float]:
+        loop = asyncio.get_running_loop()
+        future = loop.create_future()
+        self._pending.append((text, time.monotonic(), future))
+        if self._worker is None or self._worker.done():
+            self._full = asyncio.Event()
+            self._worker = loop.create_task(self._run())
+        if len(self._pending) >= self.max_batch_size:
+            self._full.set()
+        return await future
+
+    async def _run(self) -> None:
+        while self._pending:
+            delay = self._pending[0][1] + self.max_wait - time.monotonic()
+            if delay > 0 and len(self._pending) < self.max_batch_size:
+                try:
+                    await asyncio.wait_for(self._full.wait(), delay)
+                except asyncio.TimeoutError:
+                    pass
+            self._full.clear()
+            batch = self._pending[:self.max_batch_size]
+            del self._pending[:self.max_batch_size]
+            await self._embed_batch(batch)
+
+    async def _embed_batch(self, batch: list[tuple[str, float, asyncio.Future]]) -> None:
+        # отменённые вызывающие (клиент отключился) не занимают место в пачке
+        batch = [item for item in batch if not item[2].done()]
+        if not batch:
+            return
+        texts = list(dict.fromkeys(text for text, _, _ in batch))
+        try:
+            # у rubert-tiny2 нет инструкций для запросов: эмбеддинг вопроса
+            # совпадает с эмбеддингом текста, поэтому можно считать пачкой
+            vectors = await asyncio.to_thread(self.embed_model.get_text_embedding_batch, texts)
+        except Exception as exc:
+            for _, _, future in batch:
+                if not future.done():
+                    future.set_exception(exc)
+            return
+        by_text = dict(zip(texts, vectors))
+        for text, _, future in batch:
+            if not future.done():
+                future.set_result(list(by_text[text]))
+        self.batches += 1
+        self.items += len(batch)
+        self.max_seen = max(self.max_seen, len(batch))
+
+    def stats(self) -> dict:
+        return {
+            "batches": self.batches,
+            "items": self.items,
+            "avg_batch": self.items / self.batches if self.batches else 0.0,
+            "max_batch": self.max_seen,
+            "pending": len(self._pending),
+        }
+
+
+class CachedQueryEmbedder:
+    """
+    Обёртка над моделью эмбеддингов: повторные вопросы не проходят через модель.
+
+    Промахи кеша из асинхронного кода идут через MicroBatchEmbedder, если он
+    задан. Эмбеддинги текстов (фрагментов базы знаний) передаются модели как есть.
+    """
+
+    def __init__(self, embed_model, cache: QueryEmbeddingCache, model_name: str,
+                 batcher: Optional[MicroBatchEmbedder] = None):
+        self.embed_model = embed_model
+        self.cache = cache
+        self.model_name = model_name
+        self.batcher = batcher
+
+    def get_query_embedding(self, query: str) -> list[float]:
+        normalized = normalize_query(query)
+        key = f"{self.model_name}:{normalized}"
+        vec = self.cache.get(key)
+        if vec is None:
+            vec = list(self.embed_model.get_query_embedding(normalized))
+            self.cache.set(key, vec)
+        return vec
+
+    async def aget_query_embedding(self, query: str) -> list[float]:
+        if self.batcher is None:
+            return await asyncio.to_thread(self.get_query_embedding, query)
+        normalized = normalize_query(query)
+        key = f"{self.model_name}:{normalized}"
+        vec = await self.cache.aget(key)
+        if vec is None:
+            vec = await self.batcher.embed(normalized)
+            await self.cache.aset(key, vec)
+        return vec
+
+    def get_text_embedding_batch(self, texts: list[str], **kwargs) -> list[list[float]]:
+        return self.embed_model.get_text_embedding_batch(texts, **kwargs)
+
+
+class OnnxEmbedding(BaseEmbedding):
+    """
+    rubert-tiny2, экспортированный в ONNX и квантованный в int8.
+
+    Не тянет torch в процесс сервера: нужен только onnxruntime и токенизатор
+    из tokenizers. Пулинг берётся из конфигурации sentence-transformers,
+    сохранённой при экспорте, поэтому векторы совпадают с HuggingFaceEmbedding.
+    """
+
+    model_dir: str
+    max_length: int = 512
+    _session = PrivateAttr()
+    _tokenizer = PrivateAttr()
+    _pooling = PrivateAttr()
+    _input_names = PrivateAttr()
+
+    def __init__(self, model_dir: str, threads: int = 1, **kwargs):
+        super().__init__(model_dir=model_dir, model_name=EMBED_MODEL_NAME, **kwargs)
+        import onnxruntime as ort
+        from tokenizers import Tokenizer
+
+        options = ort.SessionOptions()
+        options.intra_op_num_threads = threads
+        options.inter_op_num_threads = 1
+        self._session = ort.InferenceSession(
+            os.path.join(model_dir, ONNX_MODEL_FILE),
+            sess_options=options,
+            providers=["CPUExecutionProvider"],
+        )
+        self._input_names = {i.name for i in self._session.get_inputs()}
+        self._tokenizer = Tokenizer.from_file(os.path.join(model_dir, "tokenizer.json"))
+        self._tokenizer.enable_truncation(max_length=self.max_length)
+        self._tokenizer.enable_padding()
+        with open(os.path.join(model_dir, "pooling.json"), encoding="utf-8") as f:
+            self._pooling = json.load(f)
+
+    @classmethod
+    def class_name(cls) -> str:
+        return "OnnxEmbedding"
+
+    def _encode(self, texts: list[str]) -> list[list[float]]:
+        encodings = self._tokenizer.encode_batch(texts)
+        feeds = {
+            "input_ids": np.array([e.ids for e in encodings], dtype=np.int64),
+            "attention_mask": np.array([e.attention_mask for e in encodings], dtype=np.int64),
+            "token_type_ids": np.array([e.type_ids for e in encodings], dtype=np.int64),
+        }
+        hidden = self._session.run(None, {k: v for k, v in feeds.items() if k in self._input_names})[0]
+        if self._pooling.get("pooling_mode_cls_token"):
+            pooled = hidden[:, 0]
+        else:
+            mask = feeds["attention_mask"][..., None].astype(np.float32)
+            pooled = (hidden * mask).sum(axis=1) / np.maximum(mask.sum(axis=1), 1e-9)
+        pooled = pooled / np.maximum(np.linalg.norm(pooled, axis=1, keepdims=True), 1e-12)
+        return pooled.astype(np.float32).tolist()
+
+    def _get_query_embedding(self, query: str) -> list[float]:
+        return self._encode([query])[0]
+
+    async def _aget_query_embedding(self, query: str) -> list[float]:
+        return self._get_query_embedding(query)
+
+    def _get_text_embedding(self, text: str) -> list[float]:
+        return self._encode([text])[0]
+
+    def _get_text_embeddings(self, texts: list[str]) -> list[list[float]]:
+        return self._encode(texts)
+
+
+def build_embed_model(backend: Optional[str] = None):
+    """Модель эмбеддингов по EMBED_BACKEND: torch (HuggingFace) или onnx (int8)."""
+    backend = backend or settings.EMBED_BACKEND
+    if backend == "onnx":
+        from local_store import resolve_store_dir
+
+        return OnnxEmbedding(resolve_store_dir(settings.ONNX_MODEL_DIR), threads=settings.ONNX_THREADS)
+    if backend == "torch":
+        from llama_index.embeddings.huggingface import HuggingFaceEmbedding
+
+        return HuggingFaceEmbedding(model_name=EMBED_MODEL_NAME)
+    raise ValueError(f"Unknown EMBED_BACKEND: {backend!r}")
+
+
+def export_onnx(out_dir: str) -> None:
+    """Экспортирует rubert-tiny2 в ONNX и квантует веса в int8 (нужны torch и transformers)."""
+    import torch
+    from huggingface_hub import snapshot_download
+    from onnxruntime.quantization import QuantType, quantize_dynamic
+    from transformers import AutoModel, AutoTokenizer
+
+    os.makedirs(out_dir, exist_ok=True)
+    snapshot = snapshot_download(EMBED_MODEL_NAME)
+    pooling = {"pooling_mode_cls_token": False, "pooling_mode_mean_tokens": True}
+    pooling_config = os.path.join(snapshot, "1_Pooling", "config.json")
+    if os.path.exists(pooling_config):
+        with open(pooling_config, encoding="utf-8") as f:
+            pooling = json.load(f)
+    with open(os.path.join(out_dir, "pooling.json"), "w", encoding="utf-8") as f:
+        json.dump(pooling, f, indent=1)
+
+    tokenizer = AutoTokenizer.from_pretrained(snapshot)
+    tokenizer.backend_tokenizer.save(os.path.join(out_dir, "tokenizer.json"))
+    model = AutoModel.from_pretrained(snapshot).eval()
+    sample = tokenizer(["пример"], return_tensors="pt")
+    names = ["input_ids", "attention_mask", "token_type_ids"]
+    fp32_path = os.path.join(out_dir, "model.fp32.onnx")
+    with torch.no_grad():
+        torch.onnx.export(
+            model,
+            tuple(sample[name] for name in names),
+            fp32_path,
+            input_names=names,
+            output_names=["last_hidden_state"],
+            dynamic_axes={name: {0: "batch", 1: "sequence"} for name in names + ["last_hidden_state"]},
+            opset_version=17,
+        )
+    quantize_dynamic(fp32_path, os.path.join(out_dir, ONNX_MODEL_FILE), weight_type=QuantType.QInt8)
+    os.remove(fp32_path)
+    print(f"Модель сохранена в {out_dir}")
+
+
+def check_parity(model_dir: str, corpus_path: str, min_cosine: float = 0.99, limit: int = 200) -> bool:
+    """Сравнивает эмбеддинги ONNX и HuggingFace на строках корпуса."""
+    with open(corpus_path, encoding="utf-8") as f:
+        texts = [line.strip() for line in f if line.strip()][:limit]
+    texts += ["Как получить великого учёного?", "Какие бонусы даёт район Кампус?"]
+    reference = np.asarray(build_embed_model("torch").get_text_embedding_batch(texts), dtype=np.float32)
+    onnx = OnnxEmbedding(model_dir)
+    candidate = np.asarray(onnx.get_text_embedding_batch(texts), dtype=np.float32)
+    queries = np.asarray([onnx.get_query_embedding(t) for t in texts[-2:]], dtype=np.float32)
+    cosines = np.concatenate([
+        (reference * candidate).sum(axis=1),
+        (reference[-2:] * queries).sum(axis=1),
+    ])
+    print(f"Текстов: {len(texts)}, косинус: мин {cosines.min():.4f}, средний {cosines.mean():.4f}")
+    return bool(cosines.min() >= min_cosine)
+
+
+query_embedding_cache = QueryEmbeddingCache(
+    max_size=settings.QUERY_EMBED_CACHE_SIZE,
+    ttl=settings.QUERY_EMBED_CACHE_TTL,
+    disk_dir=settings.QUERY_EMBED_CACHE_DIR,
+)
+
+
+if __name__ == "__main__":
+    from local_store import resolve_store_dir
+
+    parser = argparse.ArgumentParser(description="ONNX-бэкенд эмбеддингов rubert-tiny2")
+    sub = parser.add_subparsers(dest="command", required=True)
+    export = sub.add_parser("export-onnx", help="экспортировать и квантовать модель")
+    export.add_argument("--out", default=resolve_store_dir(settings.ONNX_MODEL_DIR))
+    parity = sub.add_parser("check-parity", help="сравнить с HuggingFaceEmbedding (косинус >= 0.99)")
+    parity.add_argument("--model-dir", default=resolve_store_dir(settings.ONNX_MODEL_DIR))
+    parity.add_argument(
+        "--corpus",
+        default=resolve_store_dir("Knowledge_Base_Operator/data_civ6_ru/Sid Meier’s Civilization VI.txt"),
+    )
+    parity.add_argument("--min-cosine", type=float, default=0.99)
+    args = parser.parse_args()
+
+    if args.command == "export-onnx":
+        export_onnx(args.out)
+    else:
+        sys.exit(0 if check_parity(args.model_dir, args.corpus, args.min_cosine) else 1)
@@ -0,0 +1,176 @@
+"""
+Экспорт диалогов в .txt, .html и .jsonl.
+
+Сообщения читаются из серверного курсора пачками по EXPORT_BATCH_SIZE и
+сразу отдаются клиенту частями ответа, поэтому память не растёт с длиной
+истории. ETag строится по последнему сообщению (время, id), времени последней
+правки и числу сообщений: повторный запрос с If-None-Match получает 304 без
+выгрузки, а новое, удалённое или отредактированное сообщение меняет тег.
+"""
+import hashlib
+import html
+import json
+from datetime import datetime
+from typing import AsyncIterator, Optional
+
+from fastapi import Request, Response
+from fastapi.responses import StreamingResponse
+
+import crud
+from database import async_session
+
+EXPORT_BATCH_SIZE = 500
+
+MEDIA_TYPES = {
+    "txt": "text/plain; charset=utf-8",
+    "html": "text/html; charset=utf-8",
+    "jsonl": "application/x-ndjson; charset=utf-8",
+}
+
+ROLE_NAMES = {"user": "Пользователь", "bot": "CivBot"}
+
+
+def role_name(message_type: str) -> str:
+    return ROLE_NAMES.get(message_type, message_type)
+
+
+def format_time(value: Optional[datetime]) -> str:
+    return value.strftime("%Y-%m-%d %H:%M:%S") if value else ""
+
+
+class TxtRenderer:
+    def head(self, title: str) -> str:
+        return f"{title}\n\n"
+
+    def dialog(self, name: str, first: bool) -> str:
+        return ("" if first else "\n") + f"=== {name} ===\n\n"
+
+    def message(self, row) -> str:
+        return f"[{format_time(row.created_at)}] {role_name(row.type)}:\n{row.text}\n\n"
+
+    def tail(self) -> str:
+        return ""
+
+
+class HtmlRenderer:
+    def head(self, title: str) -> str:
+        return (
+            "<!DOCTYPE html>\n<html lang=\"ru\">\n<head>\n<meta charset=\"utf-8\">\n"
+            f"<title>{html.escape(title)}</title>\n"
+            "<style>body{font-family:sans-serif;max-width:50em;margin:auto}"
+            ".message{margin:1em 0}.user .role{color:#1a5fb4}.bot .role{color:#26a269}"
+            ".text{white-space:pre-wrap}.time{color:#888;font-size:.8em}</style>\n"
+            f"</head>\n<body>\n<h1>{html.escape(title)}</h1>\n"
+        )
+
+    def dialog(self, name: str, first: bool) -> str:
+        return f"<h2>{html.escape(name)}</h2>\n"
+
+    def message(self, row) -> str:
+        return (
+            f"<div class=\"message {html.escape(row.type or '')}\">"
+            f"<span class=\"role\">{html.escape(role_name(row.type))}</span> "
+            f"<span class=\"time\">{format_time(row.created_at)}</span>"
+            f"<div class=\"text\">{html.escape(row.text or '')}</div></div>\n"
+        )
+
+    def tail(self) -> str:
+        return "</body>\n</html>\n"
+
+
+class JsonlRenderer:
+    def head(self, title: str) -> str:
+        return ""
+
+    def dialog(self, name: str, first: bool) -> str:
+        return ""
+
+    def message(self, row) -> str:
+        return json.dumps(
+            {
+                "dialog_id": row.dialog_id,
+                "dialog_name": row.dialog_name,
+                "message_id": row.message_id,
+                "type": row.type,
+                "text": row.text,
+                "created_at": row.created_at.isoformat() if row.created_at else None,
+            },
+            ensure_ascii=False,
+        ) + "\n"
+
+    def tail(self) -> str:
+        return ""
+
+
+RENDERERS = {"txt": TxtRenderer, "html": HtmlRenderer, "jsonl": JsonlRenderer}
+
+
+def export_etag(scope: str, fmt: str, state) -> str:
+    last_at, last_id, edited_at, count = state
+    raw = (
+        f"{scope}:{fmt}:{last_at.isoformat() if last_at else ''}:{last_id or 0}:"
+        f"{edited_at.isoformat() if edited_at else ''}:{count}"
+    )
+    return 'W/"' + hashlib.sha1(raw.encode("utf-8")).hexdigest() + '"'
+
+
+def etag_matches(request: Request, etag: str) -> bool:
+    header = request.headers.get("if-none-match")
+    if not header:
+        return False
+    tags = {tag.strip() for tag in header.split(",")}
+    # сравнение слабое: W/"x" и "x" считаются одним тегом
+    return "*" in tags or etag in tags or etag[2:] in tags
+
+
+async def render_rows(stmt, fmt: str, title: str) -> AsyncIterator[str]:
+    renderer = RENDERERS[fmt]()
+    yield renderer.head(title)
+    current_dialog = None
+    # сессия запроса к этому моменту уже закрыта: поток открывает свою
+    async with async_session() as db:
+        result = await db.stream(stmt.execution_options(yield_per=EXPORT_BATCH_SIZE))
+        async for rows in result.partitions():
+            parts = []
+            for row in rows:
+                if row.dialog_id != current_dialog:
+                    parts.append(renderer.dialog(row.dialog_name or f"Диалог {row.dialog_id}", current_dialog is None))
+                    current_dialog = row.dialog_id
+                parts.append(renderer.message(row))
+            yield "".join(parts)
+    yield renderer.tail()
+
+
+async def export_response(request: Request, db, scope: str, stmt, state_stmt, fmt: str, title: str, filename: str):
+    etag = export_etag(scope, fmt, (await db.execute(state_stmt)).one())
+    headers = {"ETag": etag, "Cache-Control": "private, no-cache"}
+    if etag_matches(request, etag):
+        return Response(status_code=304, headers=headers)
+    headers["Content-Disposition"] = f'attachment; filename="{filename}.{fmt}"'
+    return StreamingResponse(render_rows(stmt, fmt, title), media_type=MEDIA_TYPES[fmt], headers=headers)
+
+
+async def export_dialog(request: Request, db, dialog, fmt: str):
+    return await export_response(
+        request,
+        db,
+        f"dialog:{dialog.dialog_id}",
+        crud.export_rows_stmt(dialog_id=dialog.dialog_id),
+        crud.export_state_stmt(dialog_id=dialog.dialog_id),
+        fmt,
+        dialog.name or f"Диалог {dialog.dialog_id}",
+        f"dialog_{dialog.dialog_id}",
+    )
+
+
+async def export_user_dialogs(request: Request, db, user, fmt: str):
+    return await export_response(
+        request,
+        db,
+        f"user:{user.user_id}",
+        crud.export_rows_stmt(user_id=user.user_id),
+        crud.export_state_stmt(user_id=user.user_id),
+        fmt,
+        f"Диалоги CivBot — {user.name or user.email}",
+        "civbot_dialogs",
+    )
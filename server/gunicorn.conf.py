@@ -0,0 +1,28 @@
+"""
+Запуск нескольких воркеров с общей моделью эмбеддингов:
+
+    gunicorn -c gunicorn.conf.py main:app
+
+preload_app импортирует приложение в мастере до fork, а PRELOAD_MODELS
+загружает при импорте модель и токенизатор. Воркеры получают готовые веса
+copy-on-write, а не грузят каждый свою копию; индекс и прогрев поднимаются
+уже в воркере (lifespan). С EMBED_BACKEND=onnx оставьте ONNX_THREADS=1:
+пул потоков ONNX Runtime, созданный до fork, в воркерах не работает.
+"""
+import gc
+import os
+
+os.environ.setdefault("PRELOAD_MODELS", "true")
+
+bind = os.getenv("BIND", "0.0.0.0:8000")
+workers = int(os.getenv("WEB_CONCURRENCY", "2"))
+worker_class = "uvicorn.workers.UvicornWorker"
+preload_app = True
+timeout = 120
+graceful_timeout = 30
+
+
+def pre_fork(server, worker):
+    # объекты мастера уходят из-под сборщика мусора: его проходы иначе
+    # трогают их заголовки и копируют общие страницы в каждый воркер
+    gc.freeze()
@@ -0,0 +1,192 @@
+"""
+История диалога для промпта.
+
+Из базы читаются только последние HISTORY_MAX_MESSAGES сообщений, а в промпт
+попадает их хвост, укладывающийся в HISTORY_MAX_TOKENS токенов модели. Всё,
+что старше, сворачивается в краткое содержание Dialog.summary: оно
+обновляется в фоне и дописывается только репликами, вышедшими из окна
+после прошлого обновления. Поэтому размер промпта и объём чтения из базы
+не зависят от длины диалога.
+"""
+import asyncio
+import logging
+import os
+import threading
+from dataclasses import dataclass, field
+from typing import Optional
+
+import crud
+import models
+from app_config import settings
+from database import async_session
+from llm_client import LLMError, llm_client
+
+logger = logging.getLogger(__name__)
+
+SUMMARY_PROMPT = (
+    "Ты ведёшь краткое содержание диалога пользователя с помощником по "
+    "Civilization VI. Сохраняй имя пользователя, его цели, важные факты и "
+    "уже данные ответы. Пиши по-русски, сжато, без вступлений."
+)
+
+
+@dataclass
+class DialogHistory:
+    messages: list = field(default_factory=list)
+    summary: str = ""
+
+
+class TokenCounter:
+    """
+    Подсчёт токенов токенизатором модели (tokenizers).
+
+    name — путь к tokenizer.json или имя репозитория на HuggingFace Hub.
+    Если токенизатор не задан или не загрузился, число токенов оценивается
+    по длине текста.
+    """
+
+    def __init__(self, name: Optional[str], chars_per_token: float = 3.0):
+        self.name = name
+        self.chars_per_token = chars_per_token
+        self._tokenizer = None
+        self._loaded = False
+        self._lock = threading.Lock()
+
+    def load(self) -> None:
+        with self._lock:
+            if self._loaded:
+                return
+            self._loaded = True
+            if not self.name:
+                return
+            try:
+                from tokenizers import Tokenizer
+
+                if os.path.exists(self.name):
+                    self._tokenizer = Tokenizer.from_file(self.name)
+                else:
+                    self._tokenizer = Tokenizer.from_pretrained(self.name)
+            except Exception:
+                logger.warning("Tokenizer %r is unavailable, estimating tokens by length", self.name, exc_info=True)
+
+    def count(self, text: str) -> int:
+        if not self._loaded:
+            self.load()
+        if self._tokenizer is not None:
+            return len(self._tokenizer.encode(text, add_special_tokens=False).ids)
+        return int(len(text) / self.chars_per_token) + 1
+
+
+def format_message(message) -> str:
+    role = "User" if message.type == "user" else "Assistant"
+    return f"{role}: {message.text}"
+
+
+class HistoryManager:
+    def __init__(
+        self,
+        counter: TokenCounter,
+        max_messages: int,
+        max_tokens: int,
+        summary_max_tokens: int,
+        summary_batch: int,
+    ):
+        self.counter = counter
+        self.max_messages = max_messages
+        self.max_tokens = max_tokens
+        self.summary_max_tokens = summary_max_tokens
+        self.summary_batch = summary_batch
+        self._summarizing: set[int] = set()
+        self._tasks: set[asyncio.Task] = set()
+
+    def select(self, dialog: models.Dialog, recent: list) -> DialogHistory:
+        """
+        Последние реплики в пределах бюджета токенов и краткое содержание остального.
+
+        recent — последние сообщения диалога в хронологическом порядке (см.
+        crud.load_turn), последним может идти ещё не сохранённый текущий вопрос;
+        самое новое сообщение попадает в историю всегда.
+        """
+        kept, used = [], 0
+        for message in reversed(recent):
+            tokens = self.counter.count(format_message(message))
+            if kept and used + tokens > self.max_tokens:
+                break
+            kept.append(message)
+            used += tokens
+        kept.reverse()
+
+        # в окно влезло не всё или в базе могут быть более старые сообщения
+        stored = [m.message_id for m in recent if m.message_id is not None]
+        if stored and (len(kept) < len(recent) or len(stored) >= self.max_messages):
+            kept_ids = [m.message_id for m in kept if m.message_id is not None]
+            before_id = kept_ids[0] if kept_ids else stored[-1] + 1
+            if before_id > (dialog.summary_until_id or 0):
+                self.schedule_summary(dialog.dialog_id, before_id)
+        return DialogHistory(messages=kept, summary=dialog.summary or "")
+
+    def schedule_summary(self, dialog_id: int, before_id: int) -> None:
+        # один фоновый пересказ на диалог; следующий ход догонит остальное
+        if dialog_id in self._summarizing:
+            return
+        self._summarizing.add(dialog_id)
+        task = asyncio.create_task(self._summarize(dialog_id, before_id))
+        self._tasks.add(task)
+        task.add_done_callback(self._tasks.discard)
+
+    async def _summarize(self, dialog_id: int, before_id: int) -> None:
+        try:
+            await self.update_summary(dialog_id, before_id)
+        except LLMError as exc:
+            logger.warning("Dialog %s summary update failed: %r", dialog_id, exc)
+        except Exception:
+            logger.exception("Dialog %s summary update failed", dialog_id)
+        finally:
+            self._summarizing.discard(dialog_id)
+
+    async def update_summary(self, dialog_id: int, before_id: int) -> bool:
+        """Дописывает в краткое содержание реплики, вышедшие из окна истории."""
+        # сессия запроса к этому моменту может быть уже закрыта, открываем свою;
+        # на время обращения к LLM соединение с базой не держим
+        async with async_session() as db:
+            dialog = await crud.get_dialog_by_id(db, dialog_id)
+            if dialog is None:
+                return False
+            until_id = dialog.summary_until_id or 0
+            messages = await crud.get_messages_between(
+                db, dialog_id, after_id=until_id, before_id=before_id, limit=self.summary_batch
+            )
+        if not messages:
+            return False
+        lines = "\n".join(format_message(m) for m in messages)
+        summary = await llm_client.chat(
+            [
+                {"role": "system", "content": SUMMARY_PROMPT},
+                {
+                    "role": "user",
+                    "content": (
+                        f"Текущее краткое содержание:\n{dialog.summary or '(пусто)'}\n\n"
+                        f"Новые реплики:\n{lines}\n\n"
+                        "Обнови краткое содержание с учётом новых реплик."
+                    ),
+                },
+            ],
+            max_tokens=self.summary_max_tokens,
+            temperature=0.2,
+        )
+        async with async_session() as db:
+            # если другой воркер успел обновить содержание, эта попытка не записывается
+            return await crud.update_dialog_summary(
+                db, dialog_id, summary.strip(), messages[-1].message_id, previous_until_id=until_id
+            )
+
+
+token_counter = TokenCounter(settings.LLM_TOKENIZER)
+
+history_manager = HistoryManager(
+    token_counter,
+    max_messages=settings.HISTORY_MAX_MESSAGES,
+    max_tokens=settings.HISTORY_MAX_TOKENS,
+    summary_max_tokens=settings.HISTORY_SUMMARY_MAX_TOKENS,
+    summary_batch=settings.HISTORY_SUMMARY_BATCH,
+)
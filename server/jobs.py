@@ -0,0 +1,215 @@
+"""
+Очередь фоновых генераций.
+
+POST /dialogs/{dialog_id}/messages?mode=async ставит ход диалога в очередь и
+сразу отвечает 202 с id задачи, а ограниченный пул воркеров (JOB_WORKERS
+корутин на процесс) выполняет поиск и генерацию. Клиент опрашивает
+GET /jobs/{job_id} или подписывается на GET /jobs/{job_id}/events (SSE).
+
+Очередь ограничена: сверх JOB_QUEUE_SIZE ожидающих задач или JOB_MAX_PER_USER
+незавершённых задач одного пользователя новые задачи отклоняются (429 с
+Retry-After), и перегрузка не превращается в кучу таймаутов. Воркеры
+обходят пользователей по кругу, так что пользователь с длинной очередью
+задерживает остальных не больше чем на одну свою задачу за круг.
+
+Задачи живут в памяти процесса и удаляются через JOB_RESULT_TTL секунд после
+завершения; сам ответ, как и в синхронном режиме, сохраняется в диалог.
+"""
+import asyncio
+import logging
+import math
+import time
+import uuid
+from collections import OrderedDict, deque
+from dataclasses import dataclass, field
+from typing import Awaitable, Callable, Optional
+
+from app_config import settings
+
+logger = logging.getLogger(__name__)
+
+QUEUED = "queued"
+RUNNING = "running"
+DONE = "done"
+FAILED = "failed"
+
+
+class JobRejected(Exception):
+    """Очередь переполнена; retry_after — оценка, когда повторить (с)."""
+
+    def __init__(self, detail: str, retry_after: int):
+        super().__init__(detail)
+        self.detail = detail
+        self.retry_after = retry_after
+
+
+@dataclass(eq=False)
+class Job:
+    user_id: int
+    dialog_id: int
+    run: Callable[["Job"], Awaitable[dict]] = field(repr=False)
+    id: str = field(default_factory=lambda: uuid.uuid4().hex)
+    status: str = QUEUED
+    created_at: float = field(default_factory=time.time)
+    started_at: Optional[float] = None
+    finished_at: Optional[float] = None
+    result: Optional[dict] = None
+    error: Optional[str] = None
+    _changed: asyncio.Event = field(default_factory=asyncio.Event, repr=False)
+
+    @property
+    def finished(self) -> bool:
+        return self.status in (DONE, FAILED)
+
+    def _set_status(self, status: str) -> None:
+        self.status = status
+        changed, self._changed = self._changed, asyncio.Event()
+        changed.set()
+
+    async def wait_changed(self, seen: str, timeout: float) -> bool:
+        """Ждёт, пока статус перестанет быть seen; False — если истёк timeout."""
+        if self.status != seen:
+            return True
+        try:
+            await asyncio.wait_for(self._changed.wait(), timeout)
+        except asyncio.TimeoutError:
+            return False
+        return True
+
+
+class JobQueue:
+    def __init__(self, workers: int, max_queued: int, max_per_user: int, result_ttl: float):
+        self.workers = workers
+        self.max_queued = max_queued
+        self.max_per_user = max_per_user
+        self.result_ttl = result_ttl
+        self._jobs: dict[str, Job] = {}
+        # ожидающие задачи по пользователям; порядок ключей — очередь обхода
+        self._pending: OrderedDict[int, deque[Job]] = OrderedDict()
+        self._unfinished: dict[int, int] = {}
+        self._finished: deque[Job] = deque()
+        self._available = asyncio.Semaphore(0)
+        self._tasks: list[asyncio.Task] = []
+        self.queued = 0
+        self.running = 0
+        self.submitted = 0
+        self.rejected = 0
+        self.completed = 0
+        self.failed = 0
+        # скользящее среднее длительности задачи — для Retry-After
+        self.avg_seconds = 5.0
+
+    def start(self) -> None:
+        self._tasks = [asyncio.create_task(self._worker()) for _ in range(self.workers)]
+
+    async def stop(self) -> None:
+        for task in self._tasks:
+            task.cancel()
+        await asyncio.gather(*self._tasks, return_exceptions=True)
+        self._tasks = []
+        for jobs in self._pending.values():
+            for job in jobs:
+                self._finish(job, FAILED, error="Server is shutting down")
+        self._pending.clear()
+        self.queued = 0
+
+    def retry_after(self) -> int:
+        return max(1, math.ceil(self.avg_seconds * (self.queued / max(self.workers, 1) + 1)))
+
+    def submit(self, user_id: int, dialog_id: int, run: Callable[[Job], Awaitable[dict]]) -> Job:
+        self._purge()
+        if self.queued >= self.max_queued:
+            self.rejected += 1
+            raise JobRejected("Server is busy", self.retry_after())
+        if self._unfinished.get(user_id, 0) >= self.max_per_user:
+            self.rejected += 1
+            raise JobRejected("Too many pending jobs", self.retry_after())
+        job = Job(user_id=user_id, dialog_id=dialog_id, run=run)
+        self._jobs[job.id] = job
+        self._pending.setdefault(user_id, deque()).append(job)
+        self._unfinished[user_id] = self._unfinished.get(user_id, 0) + 1
+        self.queued += 1
+        self.submitted += 1
+        self._available.release()
+        return job
+
+    def get(self, job_id: str) -> Optional[Job]:
+        self._purge()
+        return self._jobs.get(job_id)
+
+    def _next(self) -> Job:
+        user_id, jobs = next(iter(self._pending.items()))
+        job = jobs.popleft()
+        if jobs:
+            self._pending.move_to_end(user_id)
+        else:
+            del self._pending[user_id]
+        self.queued -= 1
+        return job
+
+    def _finish(self, job: Job, status: str, result: Optional[dict] = None, error: Optional[str] = None) -> None:
+        job.result = result
+        job.error = error
+        job.finished_at = time.time()
+        job._set_status(status)
+        self._finished.append(job)
+        left = self._unfinished.get(job.user_id, 1) - 1
+        if left:
+            self._unfinished[job.user_id] = left
+        else:
+            self._unfinished.pop(job.user_id, None)
+        if status == DONE:
+            self.completed += 1
+        else:
+            self.failed += 1
+
+    def _purge(self) -> None:
+        deadline = time.time() - self.result_ttl
+        while self._finished and self._finished[0].finished_at < deadline:
+            self._jobs.pop(self._finished.popleft().id, None)
+
+    async def _worker(self) -> None:
+        while True:
+            await self._available.acquire()
+            job = self._next()
+            job.started_at = time.time()
+            job._set_status(RUNNING)
+            self.running += 1
+            started = time.perf_counter()
+            try:
+                result = await job.run(job)
+            except asyncio.CancelledError:
+                self._finish(job, FAILED, error="Server is shutting down")
+                raise
+            except Exception as exc:
+                # HTTPException несёт понятную клиенту причину, остальное — в лог
+                detail = getattr(exc, "detail", None)
+                if detail is None:
+                    logger.exception("Job %s failed", job.id)
+                self._finish(job, FAILED, error=str(detail or "Internal error"))
+            else:
+                self._finish(job, DONE, result=result)
+            finally:
+                self.running -= 1
+                self.avg_seconds = 0.9 * self.avg_seconds + 0.1 * (time.perf_counter() - started)
+
+    def stats(self) -> dict:
+        return {
+            "workers": self.workers,
+            "queued": self.queued,
+            "running": self.running,
+            "users_waiting": len(self._pending),
+            "submitted": self.submitted,
+            "rejected": self.rejected,
+            "completed": self.completed,
+            "failed": self.failed,
+            "avg_seconds": round(self.avg_seconds, 3),
+        }
+
+
+job_queue = JobQueue(
+    workers=settings.JOB_WORKERS,
+    max_queued=settings.JOB_QUEUE_SIZE,
+    max_per_user=settings.JOB_MAX_PER_USER,
+    result_ttl=settings.JOB_RESULT_TTL,
+)
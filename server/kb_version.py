@@ -0,0 +1,43 @@
+"""
+Версия опубликованной базы знаний.
+
+knowledge_base_updater записывает новую версию после каждой загрузки,
+кеши ответов сравнивают её со своей и сбрасываются при изменении.
+Файл читается заново только при изменении mtime, так что проверка дешёвая.
+"""
+import os
+import time
+from typing import Optional
+
+from app_config import settings
+from local_store import resolve_store_dir
+
+_cached: tuple[float, Optional[str]] = (-1.0, None)
+
+
+def version_file() -> str:
+    return resolve_store_dir(settings.KB_VERSION_FILE)
+
+
+def publish_kb_version(version: Optional[str] = None) -> str:
+    version = version or f"kb-{time.time_ns()}"
+    path = version_file()
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    tmp = path + ".tmp"
+    with open(tmp, "w", encoding="utf-8") as f:
+        f.write(version)
+    os.replace(tmp, path)
+    return version
+
+
+def read_kb_version() -> Optional[str]:
+    global _cached
+    path = version_file()
+    try:
+        mtime = os.stat(path).st_mtime
+    except FileNotFoundError:
+        return None
+    if mtime != _cached[0]:
+        with open(path, encoding="utf-8") as f:
+            _cached = (mtime, f.read().strip() or None)
+    return _cached[1]
@@ -0,0 +1,173 @@
+"""
+Запись изменений базы знаний в выбранный бэкенд (см. VECTOR_BACKEND).
+
+Все писатели принимают одни и те же операции: upsert новых фрагментов,
+delete устаревших по id и finish в конце прогона. Удаления и вставки
+отправляются пачками, чтобы не упираться в лимиты запросов.
+"""
+import numpy as np
+
+from app_config import settings
+from local_store import LocalVectorStore, StoredChunk, current_version, resolve_store_dir, write_store
+
+DELETE_BATCH_SIZE = 1000
+
+
+def batched(items: list, size: int):
+    for start in range(0, len(items), size):
+        yield items[start:start + size]
+
+
+class KBWriter:
+    def upsert(self, chunks: list[StoredChunk], embeddings) -> None:
+        raise NotImplementedError
+
+    def delete(self, chunk_ids: list[str]) -> None:
+        raise NotImplementedError
+
+    def finish(self) -> None:
+        pass
+
+    def abort(self) -> None:
+        pass
+
+
+class LocalWriter(KBWriter):
+    """Собирает новую версию локального хранилища из текущей и изменений."""
+
+    def __init__(self, embed_model_name: str, full: bool = False):
+        self.store_dir = resolve_store_dir(settings.LOCAL_INDEX_DIR)
+        self.embed_model_name = embed_model_name
+        self.chunks: dict[str, StoredChunk] = {}
+        self.vectors: dict[str, np.ndarray] = {}
+        if not full and current_version(self.store_dir):
+            store = LocalVectorStore(self.store_dir)
+            for i, chunk in enumerate(store.chunks):
+                self.chunks[chunk.id] = chunk
+                self.vectors[chunk.id] = np.array(store.embeddings[i])
+        self.changed = full
+
+    def upsert(self, chunks, embeddings) -> None:
+        for chunk, vec in zip(chunks, embeddings):
+            self.chunks[chunk.id] = chunk
+            self.vectors[chunk.id] = np.asarray(vec, dtype=np.float32)
+            self.changed = True
+
+    def delete(self, chunk_ids) -> None:
+        for chunk_id in chunk_ids:
+            if self.chunks.pop(chunk_id, None) is not None:
+                self.vectors.pop(chunk_id)
+                self.changed = True
+
+    def finish(self) -> None:
+        if not self.changed:
+            return
+        ids = list(self.chunks)
+        dim = next(iter(self.vectors.values())).shape[0] if ids else 0
+        matrix = np.vstack([self.vectors[i] for i in ids]) if ids else np.zeros((0, dim), np.float32)
+        self.version = write_store(
+            self.store_dir, [self.chunks[i] for i in ids], matrix, self.embed_model_name
+        )
+
+
+class PgVectorWriter(KBWriter):
+    """
+    Все изменения прогона применяются в одной транзакции PostgreSQL.
+
+    При полной пересборке таблица не очищается (TRUNCATE держал бы
+    эксклюзивную блокировку и останавливал поиск на весь прогон): новые
+    фрагменты пишутся поверх старых, а в finish() удаляются строки, которых
+    нет среди записанных.
+    """
+
+    def __init__(self, full: bool = False):
+        import pgvector_store
+
+        self.pgvector_store = pgvector_store
+        self.conn = pgvector_store.connect()
+        self.full = full
+        self.written: set[str] = set()
+
+    def upsert(self, chunks, embeddings) -> None:
+        self.pgvector_store.copy_upsert(self.conn, chunks, embeddings)
+        if self.full:
+            self.written.update(chunk.id for chunk in chunks)
+
+    def delete(self, chunk_ids) -> None:
+        with self.conn.cursor() as cur:
+            for batch in batched(list(chunk_ids), DELETE_BATCH_SIZE):
+                cur.execute("DELETE FROM kb_chunks WHERE chunk_id = ANY(%s)", (batch,))
+
+    def finish(self) -> None:
+        if self.full:
+            with self.conn.cursor() as cur:
+                cur.execute("DELETE FROM kb_chunks WHERE chunk_id <> ALL(%s)", (list(self.written),))
+        self.conn.commit()
+        self.conn.close()
+
+    def abort(self) -> None:
+        self.conn.rollback()
+        self.conn.close()
+
+
+class PineconeWriter(KBWriter):
+    """
+    Upsert через PineconeVectorStore (совместимый с ним формат метаданных).
+
+    При полной пересборке индекс не очищается заранее: новые фрагменты
+    записываются поверх старых, а в finish() удаляются только id, которых нет
+    среди записанных. Пока идёт загрузка (и если она упала), чат продолжает
+    искать по прежнему содержимому индекса.
+    """
+
+    def __init__(self, full: bool = False):
+        from pinecone import Pinecone
+        from llama_index.vector_stores.pinecone import PineconeVectorStore
+
+        if not settings.PINECONE_API_KEY:
+            raise ValueError("API ключ для Pinecone должен быть установлен")
+        pinecone_client = Pinecone(api_key=settings.PINECONE_API_KEY)
+        self.index = pinecone_client.Index(settings.PINECONE_INDEX_NAME)
+        self.store = PineconeVectorStore(pinecone_index=self.index)
+        self.full = full
+        self.written: set[str] = set()
+
+    def upsert(self, chunks, embeddings) -> None:
+        from llama_index.core.schema import TextNode
+
+        nodes = [
+            TextNode(
+                id_=chunk.id,
+                text=chunk.text,
+                metadata=chunk.metadata,
+                embedding=[float(x) for x in vec],
+            )
+            for chunk, vec in zip(chunks, embeddings)
+        ]
+        self.store.add(nodes)
+        if self.full:
+            self.written.update(chunk.id for chunk in chunks)
+
+    def delete(self, chunk_ids) -> None:
+        for batch in batched(list(chunk_ids), DELETE_BATCH_SIZE):
+            self.index.delete(ids=batch)
+
+    def finish(self) -> None:
+        if not self.full:
+            return
+        # Index.list перечисляет id страницами (serverless-индексы)
+        orphaned = [
+            chunk_id for page in self.index.list() for chunk_id in page if chunk_id not in self.written
+        ]
+        if orphaned:
+            self.delete(orphaned)
+
+
+def build_writer(backend: str, embed_model_name: str, full: bool = False) -> KBWriter:
+    if backend == "local":
+        return LocalWriter(embed_model_name, full)
+    if backend == "pgvector":
+        return PgVectorWriter(full)
+    if backend == "pinecone":
+        return PineconeWriter(full)
+    raise ValueError(f"Unknown VECTOR_BACKEND: {backend!r}")
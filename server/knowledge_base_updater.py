@@ -1,51 +1,265 @@
+"""
+Инкрементальное обновление базы знаний.
+
+Для каждого документа в манифесте хранится хеш содержимого и id его
+фрагментов; id фрагмента — хеш пути документа и текста фрагмента. При
+запуске заново разбираются только новые и изменённые документы, в хранилище
+отправляются только фрагменты, которых ещё нет, а исчезнувшие удаляются.
+Прогон без изменений не загружает модель и завершается за секунды.
+
+Документы разбиваются и эмбеддятся пулом процессов (по документу на
+воркер), готовые фрагменты записываются в хранилище пачками, не дожидаясь
+остальных документов.
+
+    python knowledge_base_updater.py [--full] [--backend local] [--dry-run] [--workers N]
+"""
+import argparse
+import hashlib
+import json
 import os
-from pinecone import Pinecone
-from llama_index.core import (
-    SimpleDirectoryReader,
-    StorageContext,
-    VectorStoreIndex,
-    Settings,
-)
-from llama_index.vector_stores.pinecone import PineconeVectorStore
-from llama_index.core.node_parser import SemanticSplitterNodeParser
-from llama_index.embeddings.huggingface import HuggingFaceEmbedding
+import time
+from concurrent.futures import ProcessPoolExecutor, as_completed
+
+import numpy as np
 from dotenv import load_dotenv
 
+from app_config import settings
+from kb_version import publish_kb_version
+from kb_writers import build_writer
+from local_store import StoredChunk, resolve_store_dir
+
 load_dotenv()
 
-PINECONE_API_KEY = os.getenv("PINECONE_API_KEY")
-INDEX_NAME = "civbotvect"
+EMBED_MODEL_NAME = "cointegrated/rubert-tiny2"
+DATA_DIR = "Knowledge_Base_Operator/data_civ6_ru"
+SPLITTER_PARAMS = {"buffer_size": 2, "breakpoint_percentile_threshold": 90}
+MANIFEST_VERSION = 1
+UPSERT_BATCH_SIZE = 256
+
+
+def file_hash(path: str) -> str:
+    digest = hashlib.sha256()
+    with open(path, "rb") as f:
+        for block in iter(lambda: f.read(1 << 20), b""):
+            digest.update(block)
+    # параметры разбиения входят в хеш: их изменение пересобирает документы
+    digest.update(json.dumps(SPLITTER_PARAMS, sort_keys=True).encode("utf-8"))
+    return digest.hexdigest()
+
+
+def chunk_id(doc_key: str, text: str) -> str:
+    return hashlib.sha256(f"{doc_key}\0{text}".encode("utf-8")).hexdigest()[:32]
+
+
+def scan_documents(data_dir: str) -> dict[str, str]:
+    """Относительный путь документа -> хеш содержимого."""
+    docs = {}
+    for root, _, files in os.walk(data_dir):
+        for name in sorted(files):
+            if name.startswith("."):
+                continue
+            path = os.path.join(root, name)
+            docs[os.path.relpath(path, data_dir)] = file_hash(path)
+    return docs
+
+
+def load_manifest(path: str, backend: str) -> dict:
+    empty = {"version": MANIFEST_VERSION, "backend": backend, "embed_model": EMBED_MODEL_NAME, "documents": {}}
+    try:
+        with open(path, encoding="utf-8") as f:
+            manifest = json.load(f)
+    except FileNotFoundError:
+        return empty
+    # другой бэкенд или модель: старые id ничего не говорят о содержимом хранилища
+    if (
+        manifest.get("version") != MANIFEST_VERSION
+        or manifest.get("backend") != backend
+        or manifest.get("embed_model") != EMBED_MODEL_NAME
+    ):
+        return empty
+    return manifest
+
+
+def save_manifest(path: str, manifest: dict) -> None:
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    tmp = path + ".tmp"
+    with open(tmp, "w", encoding="utf-8") as f:
+        json.dump(manifest, f, ensure_ascii=False, indent=1)
+    os.replace(tmp, path)
+
 
-def ingest_data():
-    if not PINECONE_API_KEY:
-        raise ValueError("API ключ для Pinecone должен быть установлен")
-    print("Настройка модели эмбеддингов для русского языка...")
+_worker_embed_model = None
 
-    Settings.embed_model = HuggingFaceEmbedding(model_name="cointegrated/rubert-tiny2")
 
-    # Инициализируем Pinecone
-    pinecone = Pinecone(api_key=PINECONE_API_KEY)
-    pinecone_index = pinecone.Index(INDEX_NAME)
+def _init_worker(batch_size: int) -> None:
+    global _worker_embed_model
+    from llama_index.embeddings.huggingface import HuggingFaceEmbedding
 
-    # Оборачиваем индекс в VectorStore от LlamaIndex
-    vector_store = PineconeVectorStore(pinecone_index=pinecone_index)
-    storage_context = StorageContext.from_defaults(vector_store=vector_store)
+    try:
+        import torch
 
-    # Загружаем документы
-    documents = SimpleDirectoryReader("data_civ6_ru").load_data()
+        # параллелизм даёт пул процессов; потоки torch внутри воркера только мешают
+        torch.set_num_threads(1)
+    except ImportError:
+        pass
+    _worker_embed_model = HuggingFaceEmbedding(model_name=EMBED_MODEL_NAME, embed_batch_size=batch_size)
 
-    splitter = SemanticSplitterNodeParser(
-        buffer_size=2,
-        breakpoint_percentile_threshold=90,
-        embed_model=Settings.embed_model,
+
+def _process_document(data_dir: str, doc_key: str, known_ids: set[str], embed: bool):
+    """Разбивает документ и эмбеддит фрагменты, которых ещё нет в хранилище."""
+    from llama_index.core import SimpleDirectoryReader
+    from llama_index.core.node_parser import SemanticSplitterNodeParser
+
+    splitter = SemanticSplitterNodeParser(embed_model=_worker_embed_model, **SPLITTER_PARAMS)
+    documents = SimpleDirectoryReader(input_files=[os.path.join(data_dir, doc_key)]).load_data()
+    nodes = splitter.get_nodes_from_documents(documents, show_progress=False)
+    chunks, seen = [], set()
+    for node in nodes:
+        text = node.get_content()
+        cid = chunk_id(doc_key, text)
+        if cid in seen:
+            continue
+        seen.add(cid)
+        metadata = {"file_name": node.metadata.get("file_name", os.path.basename(doc_key)), "doc_key": doc_key}
+        chunks.append(StoredChunk(id=cid, text=text, metadata=metadata))
+
+    new_chunks = [chunk for chunk in chunks if chunk.id not in known_ids]
+    embeddings = None
+    if embed and new_chunks:
+        vectors = _worker_embed_model.get_text_embedding_batch([chunk.text for chunk in new_chunks])
+        embeddings = np.asarray(vectors, dtype=np.float32)
+    return doc_key, chunks, new_chunks, embeddings
+
+
+def process_documents(
+    data_dir: str,
+    doc_keys: list[str],
+    known_ids: dict[str, set[str]],
+    workers: int,
+    batch_size: int,
+    embed: bool = True,
+):
+    """
+    Отдаёт результаты по документам по мере готовности.
+
+    Документы распределяются по пулу процессов (по модели в каждом), поэтому
+    запись готовых фрагментов идёт, пока остальные документы ещё разбиваются.
+    Единица параллелизма — документ: один большой документ разбирает один
+    воркер, и ускорение заметно, только когда изменённых документов много.
+    """
+    if not doc_keys:
+        # только удаления: модель не нужна
+        return
+    if workers <= 1 or len(doc_keys) <= 1:
+        _init_worker(batch_size)
+        for key in doc_keys:
+            yield _process_document(data_dir, key, known_ids.get(key, set()), embed)
+        return
+    with ProcessPoolExecutor(
+        max_workers=min(workers, len(doc_keys)),
+        initializer=_init_worker,
+        initargs=(batch_size,),
+    ) as pool:
+        futures = [
+            pool.submit(_process_document, data_dir, key, known_ids.get(key, set()), embed)
+            for key in doc_keys
+        ]
+        for future in as_completed(futures):
+            yield future.result()
+
+
+def ingest_data(
+    backend: str,
+    data_dir: str,
+    full: bool = False,
+    dry_run: bool = False,
+    workers: int = 1,
+    batch_size: int = 64,
+) -> dict:
+    started = time.perf_counter()
+    manifest_path = resolve_store_dir(settings.KB_MANIFEST_FILE.format(backend=backend))
+    manifest = load_manifest(manifest_path, backend)
+    if not manifest["documents"]:
+        # без манифеста неизвестно, что уже лежит в хранилище: пересобираем целиком
+        full = True
+    if full:
+        manifest["documents"] = {}
+    old_docs = manifest["documents"]
+
+    current = scan_documents(data_dir)
+    changed = [key for key, digest in current.items() if old_docs.get(key, {}).get("hash") != digest]
+    removed = [key for key in old_docs if key not in current]
+    print(f"Документов: {len(current)}, изменено/новых: {len(changed)}, удалено: {len(removed)}")
+
+    if not changed and not removed and not full:
+        print(f"Изменений нет ({time.perf_counter() - started:.2f}s)")
+        return {"upserted": 0, "deleted": 0}
+
+    new_docs = {key: value for key, value in old_docs.items() if key not in removed}
+    known_ids = {key: set(old_docs.get(key, {}).get("chunks", [])) for key in changed}
+    stats = {"upserted": 0, "deleted": 0}
+
+    writer = None if dry_run else build_writer(backend, EMBED_MODEL_NAME, full=full)
+    try:
+        stale = [cid for key in removed for cid in old_docs[key]["chunks"]]
+        if changed:
+            print(f"Разбиение и эмбеддинги: воркеров {workers}, размер пачки {batch_size}")
+        for key, chunks, new_chunks, embeddings in process_documents(
+            data_dir, changed, known_ids, workers, batch_size, embed=not dry_run
+        ):
+            new_ids = [chunk.id for chunk in chunks]
+            stale.extend(known_ids[key] - set(new_ids))
+            new_docs[key] = {"hash": current[key], "chunks": new_ids}
+            stats["upserted"] += len(new_chunks)
+            if writer is not None and new_chunks:
+                for start in range(0, len(new_chunks), UPSERT_BATCH_SIZE):
+                    writer.upsert(
+                        new_chunks[start:start + UPSERT_BATCH_SIZE],
+                        embeddings[start:start + UPSERT_BATCH_SIZE],
+                    )
+        stats["deleted"] = len(stale)
+        if writer is not None:
+            if stale:
+                writer.delete(stale)
+            writer.finish()
+    except Exception:
+        if writer is not None:
+            writer.abort()
+        raise
+
+    elapsed = time.perf_counter() - started
+    print(
+        f"Фрагментов загружено: {stats['upserted']}, удалено: {stats['deleted']}, "
+        f"скорость: {stats['upserted'] / max(elapsed, 1e-9):.1f} фрагм./с"
     )
+    if dry_run:
+        return stats
+
+    manifest["documents"] = new_docs
+    save_manifest(manifest_path, manifest)
+    version = publish_kb_version(getattr(writer, "version", None))
+    print(f"Готово за {elapsed:.2f}s, версия базы знаний: {version}")
+    return stats
+
 
-    index = VectorStoreIndex.from_documents(
-        documents,
-        storage_context=storage_context,
-        transformations=[splitter],
-        show_progress=True,
+def main() -> None:
+    parser = argparse.ArgumentParser(description="Обновление базы знаний CivBot")
+    parser.add_argument("--backend", default=settings.VECTOR_BACKEND, choices=["pinecone", "local", "pgvector"])
+    parser.add_argument("--data-dir", default=resolve_store_dir(DATA_DIR))
+    parser.add_argument("--full", action="store_true", help="игнорировать манифест и перезалить всё")
+    parser.add_argument("--dry-run", action="store_true", help="только показать, что изменится")
+    parser.add_argument("--workers", type=int, default=os.cpu_count() or 1, help="процессов для разбиения и эмбеддингов")
+    parser.add_argument("--batch-size", type=int, default=64, help="текстов в одном проходе модели")
+    args = parser.parse_args()
+    ingest_data(
+        args.backend,
+        args.data_dir,
+        full=args.full,
+        dry_run=args.dry_run,
+        workers=args.workers,
+        batch_size=args.batch_size,
     )
 
 
-ingest_data()
+if __name__ == "__main__":
+    main()
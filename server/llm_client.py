@@ -0,0 +1,229 @@
+import asyncio
+import json
+import logging
+import random
+from typing import AsyncIterator, Optional
+
+import httpx
+
+from app_config import settings
+from metrics import count_llm_tokens
+
+logger = logging.getLogger(__name__)
+
+RETRY_STATUSES = {408, 409, 425, 429, 500, 502, 503, 504}
+
+
+class LLMError(Exception):
+    """Ошибка обращения к LLM после исчерпания повторов или дедлайна."""
+
+
+class AsyncLLMClient:
+    """
+    Асинхронный клиент chat completions (OpenAI-совместимый API Together).
+
+    Один пул keep-alive соединений на процесс, дедлайн на весь вызов
+    (включая повторы), ограниченное число повторов с экспоненциальной
+    задержкой и jitter, семафор на число одновременных генераций.
+    """
+
+    def __init__(
+        self,
+        base_url: str,
+        api_key: Optional[str],
+        model: str,
+        timeout: float,
+        connect_timeout: float,
+        max_retries: int,
+        max_concurrency: int,
+        pool_size: int,
+    ):
+        self.base_url = base_url.rstrip("/")
+        self.api_key = api_key
+        self.model = model
+        self.timeout = timeout
+        self.connect_timeout = connect_timeout
+        self.max_retries = max_retries
+        self.pool_size = pool_size
+        self._semaphore = asyncio.Semaphore(max_concurrency)
+        self._client: Optional[httpx.AsyncClient] = None
+
+    @property
+    def client(self) -> httpx.AsyncClient:
+        if self._client is None or self._client.is_closed:
+            self._client = httpx.AsyncClient(
+                base_url=self.base_url,
+                headers={"Authorization": f"Bearer {self.api_key}"},
+                timeout=httpx.Timeout(self.timeout, connect=self.connect_timeout),
+                limits=httpx.Limits(
+                    max_connections=self.pool_size,
+                    max_keepalive_connections=self.pool_size,
+                    keepalive_expiry=60,
+                ),
+            )
+        return self._client
+
+    async def aclose(self) -> None:
+        if self._client is not None:
+            await self._client.aclose()
+            self._client = None
+
+    def _backoff(self, attempt: int, retry_after: Optional[str]) -> float:
+        if retry_after:
+            try:
+                return min(float(retry_after), 30.0)
+            except ValueError:
+                pass
+        # full jitter: случайная пауза в пределах экспоненциального окна
+        return random.uniform(0, min(8.0, 0.5 * 2 ** attempt))
+
+    async def _post_with_retries(self, payload: dict) -> dict:
+        attempt = 0
+        while True:
+            retry_after = None
+            try:
+                resp = await self.client.post("/chat/completions", json=payload)
+                if resp.status_code not in RETRY_STATUSES:
+                    resp.raise_for_status()
+                    try:
+                        return resp.json()
+                    except ValueError as exc:
+                        raise LLMError("LLM returned invalid JSON") from exc
+                retry_after = resp.headers.get("retry-after")
+                error: Exception = LLMError(f"LLM returned HTTP {resp.status_code}")
+            except httpx.HTTPStatusError as exc:
+                raise LLMError(f"LLM returned HTTP {exc.response.status_code}") from exc
+            except httpx.TransportError as exc:
+                error = exc
+            if attempt >= self.max_retries:
+                raise LLMError(f"LLM request failed after {attempt + 1} attempts: {error!r}")
+            delay = self._backoff(attempt, retry_after)
+            logger.warning("LLM call failed (%r), retry %d in %.2fs", error, attempt + 1, delay)
+            await asyncio.sleep(delay)
+            attempt += 1
+
+    async def chat(
+        self,
+        messages: list[dict],
+        model: Optional[str] = None,
+        deadline: Optional[float] = None,
+        **params,
+    ) -> str:
+        payload = {"model": model or self.model, "messages": messages, "stream": False, **params}
+
+        async def call() -> dict:
+            # ожидание свободного слота тоже входит в дедлайн
+            async with self._semaphore:
+                return await self._post_with_retries(payload)
+
+        try:
+            data = await asyncio.wait_for(call(), timeout=deadline or settings.LLM_DEADLINE_SECONDS)
+        except asyncio.TimeoutError as exc:
+            raise LLMError("LLM deadline exceeded") from exc
+        try:
+            content = data["choices"][0]["message"]["content"]
+            usage = data.get("usage") or {}
+        except (KeyError, IndexError, TypeError, AttributeError) as exc:
+            raise LLMError("LLM returned an unexpected response") from exc
+        count_llm_tokens(usage.get("prompt_tokens", 0), usage.get("completion_tokens", 0))
+        return content
+
+    async def stream_chat(
+        self,
+        messages: list[dict],
+        model: Optional[str] = None,
+        deadline: Optional[float] = None,
+        **params,
+    ) -> AsyncIterator[str]:
+        """
+        Отдаёт токены ответа по мере генерации (SSE-поток API).
+
+        Повторы возможны только до первого полученного токена: после этого
+        обрыв соединения пробрасывается вызывающему как LLMError. Дедлайн,
+        как и в chat(), ограничивает весь вызов с ожиданием слота и повторами;
+        время, пока вызывающий обрабатывает токен, в него тоже входит.
+        """
+        payload = {"model": model or self.model, "messages": messages, "stream": True, **params}
+        loop = asyncio.get_running_loop()
+        expires = loop.time() + (deadline or settings.LLM_DEADLINE_SECONDS)
+
+        async def until_deadline(awaitable):
+            # ожидания ответа API ограничены дедлайном; yield внутрь не попадает
+            try:
+                return await asyncio.wait_for(awaitable, timeout=max(expires - loop.time(), 0))
+            except asyncio.TimeoutError as exc:
+                raise LLMError("LLM deadline exceeded") from exc
+
+        await until_deadline(self._semaphore.acquire())
+        try:
+            attempt = 0
+            while True:
+                retry_after = None
+                received = False
+                try:
+                    request = self.client.build_request("POST", "/chat/completions", json=payload)
+                    resp = await until_deadline(self.client.send(request, stream=True))
+                    try:
+                        if resp.status_code in RETRY_STATUSES:
+                            retry_after = resp.headers.get("retry-after")
+                            error: Exception = LLMError(f"LLM returned HTTP {resp.status_code}")
+                        else:
+                            resp.raise_for_status()
+                            usage, chunks = {}, 0
+                            lines = resp.aiter_lines()
+                            while True:
+                                line = await until_deadline(anext(lines, None))
+                                if line is None:
+                                    break
+                                if not line.startswith("data:"):
+                                    continue
+                                data = line[5:].strip()
+                                if data == "[DONE]":
+                                    break
+                                try:
+                                    chunk = json.loads(data)
+                                    # usage приходит в последнем событии, если API его отдаёт
+                                    usage = chunk.get("usage") or usage
+                                    choices = chunk.get("choices") or [{}]
+                                    token = (choices[0].get("delta") or {}).get("content")
+                                except (ValueError, IndexError, TypeError, AttributeError) as exc:
+                                    raise LLMError("LLM returned an unexpected stream event") from exc
+                                if token:
+                                    received = True
+                                    chunks += 1
+                                    yield token
+                            # без usage число токенов ответа оценивается числом событий
+                            count_llm_tokens(
+                                usage.get("prompt_tokens", 0), usage.get("completion_tokens", chunks)
+                            )
+                            return
+                    finally:
+                        await resp.aclose()
+                except httpx.HTTPStatusError as exc:
+                    raise LLMError(f"LLM returned HTTP {exc.response.status_code}") from exc
+                except httpx.TransportError as exc:
+                    if received:
+                        raise LLMError(f"LLM stream interrupted: {exc!r}") from exc
+                    error = exc
+                if attempt >= self.max_retries:
+                    raise LLMError(f"LLM request failed after {attempt + 1} attempts: {error!r}")
+                delay = self._backoff(attempt, retry_after)
+                if loop.time() + delay >= expires:
+                    raise LLMError(f"LLM deadline exceeded after {attempt + 1} attempts: {error!r}")
+                logger.warning("LLM stream failed (%r), retry %d in %.2fs", error, attempt + 1, delay)
+                await asyncio.sleep(delay)
+                attempt += 1
+        finally:
+            self._semaphore.release()
+
+
+llm_client = AsyncLLMClient(
+    base_url=settings.TOGETHER_BASE_URL,
+    api_key=settings.TOGETHER_API_KEY,
+    model=settings.TOGETHER_MODEL,
+    timeout=settings.LLM_TIMEOUT_SECONDS,
+    connect_timeout=settings.LLM_CONNECT_TIMEOUT_SECONDS,
+    max_retries=settings.LLM_MAX_RETRIES,
+    max_concurrency=settings.LLM_MAX_CONCURRENCY,
+    pool_size=settings.LLM_POOL_SIZE,
+)
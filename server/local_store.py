@@ -0,0 +1,127 @@
+"""
+Локальное хранилище векторов базы знаний.
+
+Каталог хранилища содержит версии вида v<timestamp>/ и файл CURRENT с именем
+активной версии. Версия состоит из:
+    embeddings.npy — матрица float32 N×D с L2-нормированными строками;
+    chunks.json    — id, текст и метаданные фрагментов в том же порядке;
+    meta.json      — размерность, число фрагментов, модель эмбеддингов.
+
+Матрица открывается через np.load(mmap_mode="r"), поэтому несколько воркеров
+uvicorn делят одни и те же страницы в page cache, а поиск — это одно
+матрично-векторное умножение без сетевых запросов.
+"""
+import json
+import os
+import shutil
+import time
+from dataclasses import dataclass
+from typing import Optional
+
+import numpy as np
+
+SERVER_DIR = os.path.dirname(os.path.abspath(__file__))
+KEEP_VERSIONS = 2
+
+
+def resolve_store_dir(path: str) -> str:
+    return path if os.path.isabs(path) else os.path.join(SERVER_DIR, path)
+
+
+@dataclass
+class StoredChunk:
+    id: str
+    text: str
+    metadata: dict
+
+
+def current_version(store_dir: str) -> Optional[str]:
+    try:
+        with open(os.path.join(store_dir, "CURRENT"), encoding="utf-8") as f:
+            return f.read().strip() or None
+    except FileNotFoundError:
+        return None
+
+
+def write_store(
+    store_dir: str,
+    chunks: list[StoredChunk],
+    embeddings: np.ndarray,
+    embed_model_name: str,
+) -> str:
+    """Записывает новую версию и атомарно переключает на неё CURRENT."""
+    embeddings = np.asarray(embeddings, dtype=np.float32)
+    if len(chunks) != embeddings.shape[0]:
+        raise ValueError("chunks and embeddings must have the same length")
+    norms = np.linalg.norm(embeddings, axis=1, keepdims=True)
+    embeddings = embeddings / np.maximum(norms, 1e-12)
+
+    os.makedirs(store_dir, exist_ok=True)
+    version = f"v{time.time_ns()}"
+    version_dir = os.path.join(store_dir, version)
+    os.makedirs(version_dir)
+    np.save(os.path.join(version_dir, "embeddings.npy"), embeddings)
+    with open(os.path.join(version_dir, "chunks.json"), "w", encoding="utf-8") as f:
+        json.dump(
+            [{"id": c.id, "text": c.text, "metadata": c.metadata} for c in chunks],
+            f,
+            ensure_ascii=False,
+        )
+    with open(os.path.join(version_dir, "meta.json"), "w", encoding="utf-8") as f:
+        json.dump(
+            {
+                "count": len(chunks),
+                "dim": int(embeddings.shape[1]) if embeddings.ndim == 2 else 0,
+                "embed_model": embed_model_name,
+            },
+            f,
+        )
+
+    tmp = os.path.join(store_dir, "CURRENT.tmp")
+    with open(tmp, "w", encoding="utf-8") as f:
+        f.write(version)
+    os.replace(tmp, os.path.join(store_dir, "CURRENT"))
+    _prune_versions(store_dir, version)
+    return version
+
+
+def _prune_versions(store_dir: str, active: str) -> None:
+    # уже открытые mmap продолжают работать и после удаления файлов
+    versions = sorted(
+        name for name in os.listdir(store_dir)
+        if name.startswith("v") and os.path.isdir(os.path.join(store_dir, name))
+    )
+    for name in versions[:-KEEP_VERSIONS]:
+        if name != active:
+            shutil.rmtree(os.path.join(store_dir, name), ignore_errors=True)
+
+
+class LocalVectorStore:
+    """Только чтение: memory-mapped матрица эмбеддингов и тексты фрагментов."""
+
+    def __init__(self, store_dir: str):
+        self.store_dir = store_dir
+        self.version = current_version(store_dir)
+        if self.version is None:
+            raise FileNotFoundError(f"Local vector store not found in {store_dir}")
+        version_dir = os.path.join(store_dir, self.version)
+        self.embeddings = np.load(os.path.join(version_dir, "embeddings.npy"), mmap_mode="r")
+        with open(os.path.join(version_dir, "chunks.json"), encoding="utf-8") as f:
+            self.chunks = [StoredChunk(**item) for item in json.load(f)]
+        with open(os.path.join(version_dir, "meta.json"), encoding="utf-8") as f:
+            self.meta = json.load(f)
+
+    def __len__(self) -> int:
+        return len(self.chunks)
+
+    def search(self, query_embedding, top_k: int) -> list[tuple[int, float]]:
+        """Точный поиск по косинусной близости: (номер фрагмента, оценка)."""
+        if not self.chunks:
+            return []
+        query = np.asarray(query_embedding, dtype=np.float32)
+        query = query / max(float(np.linalg.norm(query)), 1e-12)
+        scores = self.embeddings @ query
+        top_k = min(top_k, scores.shape[0])
+        top = np.argpartition(-scores, top_k - 1)[:top_k]
+        top = top[np.argsort(-scores[top], kind="stable")]
+        return [(int(i), float(scores[i])) for i in top]
@@ -1,20 +1,84 @@
-from fastapi import FastAPI, Depends, HTTPException, Security
+import asyncio
+from contextlib import asynccontextmanager
+import startup
+from fastapi import FastAPI, Depends, HTTPException, Security, Header, Query, Request, Response
 from fastapi.security import OAuth2PasswordBearer, OAuth2PasswordRequestForm
 from sqlalchemy.ext.asyncio import AsyncSession
-from database import async_session
-from typing import List, AsyncGenerator
+from database import async_session, engine
+from typing import List, AsyncGenerator, Optional
 import crud
 import schemas
 import models
 from fastapi import status
 import auth
-from jose import JWTError, jwt
+from jose import JWTError
 from app_config import settings
 from pydantic import Extra
-from llama_index.core import Settings
-from LLM_model import RAGService
+import json
+import logging
+from datetime import datetime, timezone
+import anyio
+from fastapi.responses import JSONResponse, StreamingResponse
+from LLM_model import RAGService, embedding_resources, generation_flight, rag_manager, retrieval_flight
+from llm_client import llm_client, LLMError
+from embeddings import query_embedding_cache
+from answer_cache import answer_cache
+from jobs import DONE, FAILED, Job, JobRejected, job_queue
+from metrics import (
+    RequestTracingMiddleware,
+    configure_logging,
+    metrics_payload,
+    pool_stats,
+    stats_collector,
+    track_stage,
+)
+from timing import StageTimings
+from export import export_dialog, export_user_dialogs
+from history import history_manager
+from pagination import DEFAULT_PAGE_SIZE, MAX_PAGE_SIZE, PageOrder, decode_cursor, page
+
+
+startup.startup_timings.add("import", startup.startup_timings.total())
+if settings.PRELOAD_MODELS:
+    startup.preload_models()
+
+
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    # Один RAGService на процесс: модель, клиент индекса и прогрев — в фоне,
+    # чтобы эндпоинты без RAG отвечали сразу после старта
+    warm_up = asyncio.create_task(startup.warm_up())
+    job_queue.start()
+    yield
+    warm_up.cancel()
+    await job_queue.stop()
+    await llm_client.aclose()
+    await engine.dispose()
+
+
+configure_logging()
+
+app = FastAPI(debug=True, lifespan=lifespan)
+app.add_middleware(
+    RequestTracingMiddleware,
+    header=settings.REQUEST_ID_HEADER,
+    slow_seconds=settings.SLOW_REQUEST_SECONDS,
+)
+
+logger = logging.getLogger(__name__)
 
-app = FastAPI(debug=True)
+# пулы и кеши для /metrics; значения снимаются в момент опроса
+stats_collector.register("db_pool", pool_stats(engine))
+stats_collector.register("embed_cache", query_embedding_cache.stats)
+stats_collector.register("embed_batching", embedding_resources.batching_stats)
+stats_collector.register("answer_cache", answer_cache.stats)
+stats_collector.register("user_cache", auth.user_cache.stats)
+stats_collector.register("jobs", job_queue.stats)
+stats_collector.register("coalesce_retrieval", retrieval_flight.stats)
+stats_collector.register("coalesce_generation", generation_flight.stats)
+
+# интервал комментариев-пингов в /jobs/{job_id}/events, с
+JOB_EVENTS_PING_SECONDS = 15
 
 oauth2_scheme = OAuth2PasswordBearer(tokenUrl="/login")
 
@@ -24,29 +88,81 @@ async def get_db() -> AsyncGenerator[AsyncSession, None]:
         yield session
 
 
+def get_rag_service() -> RAGService:
+    try:
+        return rag_manager.get()
+    except RuntimeError:
+        raise HTTPException(503, "Knowledge base is not ready")
+
+
 async def get_current_user(
     token: str = Depends(oauth2_scheme),
     db: AsyncSession = Depends(get_db)
 ) -> models.User:
+    """
+    Пользователь из токена. user_id берётся из claim uid, сам пользователь —
+    из кеша, так что обычный запрос не делает к базе ни одного лишнего запроса.
+    """
     credentials_exception = HTTPException(
         status_code=401,
         detail="Could not validate credentials",
     )
-    try:
-        payload = jwt.decode(
-            token,
-            settings.SECRET_KEY,
-            algorithms=[settings.ALGORITHM]
-        )
-        email: str = payload.get("sub")
-        if not email:
+    with track_stage("auth"):
+        try:
+            payload = auth.decode_access_token(token)
+        except JWTError:
+            raise credentials_exception
+        user_id = payload.get("uid")
+        email = payload.get("sub")
+        if user_id is not None:
+            user = auth.user_cache.get(user_id)
+            if user is not None:
+                return user
+            user = await crud.get_user_by_id(db, user_id)
+        elif email:
+            # токены, выданные до появления uid, действуют до истечения срока
+            user = await crud.get_user_by_email(db, email)
+        else:
             raise credentials_exception
-    except JWTError:
-        raise credentials_exception
-    user = await crud.get_user_by_email(db, email)
-    if not user:
-        raise credentials_exception
-    return user
+        if not user or (email and user.email != email):
+            raise credentials_exception
+        db.expunge(user)
+        auth.user_cache.set(user)
+        return user
+
+
+@app.get("/health")
+async def health():
+    rag = rag_manager.status()
+    body = {
+        "status": "ok" if rag["warm"] else "starting",
+        "rag": rag,
+        "embed_cache": query_embedding_cache.stats(),
+        "embed_batching": embedding_resources.batching_stats(),
+        "answer_cache": answer_cache.stats(),
+        "jobs": job_queue.stats(),
+        "startup": startup.report(),
+    }
+    return JSONResponse(body, status_code=200 if rag["warm"] else 503)
+
+
+@app.get("/metrics", include_in_schema=False)
+async def metrics():
+    if not settings.METRICS_ENABLED:
+        raise HTTPException(404, "Not Found")
+    payload, content_type = metrics_payload()
+    return Response(payload, media_type=content_type)
+
+
+@app.post("/rag/reload")
+async def reload_rag(x_admin_token: Optional[str] = Header(None)):
+    if not settings.ADMIN_TOKEN or x_admin_token != settings.ADMIN_TOKEN:
+        raise HTTPException(403, "Forbidden")
+    try:
+        await rag_manager.rebuild()
+    except Exception as exc:
+        raise HTTPException(500, f"Rebuild failed: {exc!r}")
+    return rag_manager.status()
 
 
 @app.post("/register", response_model=schemas.UserResponse)
@@ -67,9 +183,9 @@ async def login(
     db: AsyncSession = Depends(get_db)
 ):
     user = await crud.get_user_by_name(db, form_data.username)
-    if not user or not auth.verify_password(form_data.password, user.password_hash):
+    if not user or not await auth.averify_password(form_data.password, user.password_hash):
         raise HTTPException(401, "Invalid credentials")
-    token = auth.create_access_token({"sub": user.email})
+    token = auth.create_access_token({"sub": user.email, "uid": user.user_id})
     return {"access_token": token, "token_type": "bearer"}
 
 
@@ -88,48 +204,260 @@ async def create_dialog(
 @app.post(
     "/dialogs/{dialog_id}/messages",
     response_model=schemas.MessageResponse,
+    responses={202: {"model": schemas.JobResponse}, 429: {"description": "Too Many Requests"}},
 )
 async def create_message_in_dialog(
     dialog_id: int,
     payload: schemas.MessageCreate,
+    request: Request,
+    response: Response,
+    mode: str = Query("sync", pattern="^(sync|async)$"),
     current_user: models.User = Security(get_current_user),
-    db: AsyncSession = Depends(get_db)
+    db: AsyncSession = Depends(get_db),
+    model: RAGService = Depends(get_rag_service)
 ):
+    """
+    Ответ бота на сообщение. С mode=async ход ставится в очередь (jobs.py):
+    сразу возвращается 202 с id задачи, а при переполненной очереди — 429.
+    """
     # 1. Проверка совпадения dialog_id
     if payload.dialog_id != dialog_id:
         raise HTTPException(400, "dialog_id mismatch")
+    if mode == "async":
+        return await submit_turn(db, model, dialog_id, current_user.user_id, payload.text)
+
+    # разбор по стадиям попадает в лог медленных запросов (metrics.py)
+    timings = request.state.timings = StageTimings()
+    bot_message = await answer_turn(db, model, dialog_id, current_user.user_id, payload.text, timings)
+    response.headers["Server-Timing"] = timings.server_timing()
+    return bot_message
+
+
+async def answer_turn(
+    db: AsyncSession,
+    model: RAGService,
+    dialog_id: int,
+    user_id: int,
+    text: str,
+    timings: StageTimings
+) -> models.Message:
+    # 2. Поиск по базе знаний не зависит от базы данных: запускаем его сразу,
+    # параллельно с проверкой диалога и чтением истории
+    retrieval = start_retrieval(model, text, timings)
+    try:
+        dialog, recent = await timings.measure(
+            "history", crud.load_turn(db, dialog_id, user_id, history_manager.max_messages)
+        )
+    except BaseException:
+        retrieval.cancel()
+        raise
+
+    # 3. Последние реплики в пределах бюджета токенов и краткое содержание старых;
+    # вопрос пока не сохранён и добавляется в историю как есть
+    pending = models.Message(dialog_id=dialog_id, type="user", text=text)
+    history = history_manager.select(dialog, recent + [pending])
+    try:
+        answer = await model.retrieve_and_generate(
+            user_input=text,
+            history=history.messages,
+            summary=history.summary,
+            hits=await retrieval,
+            timings=timings
+        )
+    except LLMError:
+        raise HTTPException(502, "LLM backend unavailable")
 
-    # 2. Проверка прав доступа к диалогу
+    # 4. Вопрос и ответ с источниками сохраняются вместе одной командой
+    _, bot_message = await timings.measure(
+        "persist", crud.save_turn(db, dialog_id, user_id, text, answer.text, answer.sources)
+    )
+    return bot_message
+
+
+async def submit_turn(db: AsyncSession, model: RAGService, dialog_id: int, user_id: int, text: str) -> JSONResponse:
+    # владелец проверяется сразу, чтобы 404/403 не приходили уже из задачи
     dialog = await crud.get_dialog_by_id(db, dialog_id)
     if not dialog:
         raise HTTPException(404, "Dialog not found")
-    if dialog.user_id != current_user.user_id:
+    if dialog.user_id != user_id:
         raise HTTPException(403, "Access denied")
 
-    # 3. Сохраняем сообщение пользователя
-    user_message = await crud.create_message(
-        db, 
-        msg_in=payload, 
-        is_bot=False
+    async def run(job: Job) -> dict:
+        timings = StageTimings()
+        timings.add("queue", job.started_at - job.created_at)
+        async with async_session() as session:
+            bot_message = await answer_turn(session, model, dialog_id, user_id, text, timings)
+            return schemas.MessageResponse.model_validate(bot_message, from_attributes=True).model_dump(mode="json")
+
+    try:
+        job = job_queue.submit(user_id, dialog_id, run)
+    except JobRejected as exc:
+        raise HTTPException(429, exc.detail, headers={"Retry-After": str(exc.retry_after)})
+    return JSONResponse(
+        job_response(job),
+        status_code=status.HTTP_202_ACCEPTED,
+        headers={"Location": f"/jobs/{job.id}"},
     )
 
-    model = RAGService()
-    bot_response_text = await model.retrieve_and_generate(
-        user_input=user_message.text,
-        history=await crud.get_messages_by_dialog(db, dialog_id)
+
+def job_response(job: Job) -> dict:
+    return schemas.JobResponse(
+        job_id=job.id,
+        dialog_id=job.dialog_id,
+        status=job.status,
+        created_at=datetime.fromtimestamp(job.created_at, timezone.utc),
+        started_at=datetime.fromtimestamp(job.started_at, timezone.utc) if job.started_at else None,
+        finished_at=datetime.fromtimestamp(job.finished_at, timezone.utc) if job.finished_at else None,
+        message=job.result,
+        error=job.error,
+    ).model_dump(mode="json")
+
+
+def get_job(job_id: str, user: models.User) -> Job:
+    job = job_queue.get(job_id)
+    # чужая задача неотличима от несуществующей
+    if job is None or job.user_id != user.user_id:
+        raise HTTPException(404, "Job not found")
+    return job
+
+
+@app.get("/jobs/{job_id}", response_model=schemas.JobResponse)
+async def read_job(
+    job_id: str,
+    current_user: models.User = Security(get_current_user)
+):
+    return job_response(get_job(job_id, current_user))
+
+
+@app.get("/jobs/{job_id}/events")
+async def stream_job(
+    job_id: str,
+    current_user: models.User = Security(get_current_user)
+):
+    """
+    Статус задачи как Server-Sent Events: status при каждой смене статуса,
+    в конце done (сообщение бота) или error. Пока ничего не меняется,
+    раз в JOB_EVENTS_PING_SECONDS приходит комментарий, чтобы прокси не
+    закрывали соединение.
+    """
+    job = get_job(job_id, current_user)
+
+    async def event_stream():
+        while True:
+            seen = job.status
+            if job.status == DONE:
+                yield sse_event(job.result, event="done")
+                return
+            if job.status == FAILED:
+                yield sse_event({"detail": job.error}, event="error")
+                return
+            yield sse_event(job_response(job), event="status")
+            while not await job.wait_changed(seen, JOB_EVENTS_PING_SECONDS):
+                yield ": ping\n\n"
+
+    return StreamingResponse(
+        event_stream(),
+        media_type="text/event-stream",
+        headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"},
     )
 
-    # 5. Сохраняем ответ бота
-    bot_message = await crud.create_message(
-        db,
-        msg_in=schemas.MessageCreate(
-            text=bot_response_text,
-            dialog_id=dialog_id
-        ),
-        is_bot=True
-    )   
 
-    return bot_message
+def start_retrieval(model: RAGService, text: str, timings: StageTimings) -> asyncio.Task:
+    return asyncio.create_task(timings.measure("retrieval", model.retrieve(text)))
+
+
+def sse_event(data: dict, event: Optional[str] = None) -> str:
+    head = f"event: {event}\n" if event else ""
+    return f"{head}data: {json.dumps(data, ensure_ascii=False, default=str)}\n\n"
+
+
+@app.post("/dialogs/{dialog_id}/messages/stream")
+async def stream_message_in_dialog(
+    dialog_id: int,
+    payload: schemas.MessageCreate,
+    request: Request,
+    current_user: models.User = Security(get_current_user),
+    db: AsyncSession = Depends(get_db),
+    model: RAGService = Depends(get_rag_service)
+):
+    """
+    Потоковый вариант POST /dialogs/{dialog_id}/messages (Server-Sent Events).
+
+    События: user_message (сохранённое сообщение пользователя), token (фрагмент
+    ответа), done (сохранённое сообщение бота) или error. Если клиент
+    отключился посреди генерации, уже полученная часть ответа всё равно
+    сохраняется, чтобы история диалога оставалась согласованной.
+    """
+    if payload.dialog_id != dialog_id:
+        raise HTTPException(400, "dialog_id mismatch")
+
+    timings = request.state.timings = StageTimings()
+    retrieval = start_retrieval(model, payload.text, timings)
+    try:
+        with timings.stage("history"):
+            dialog, recent = await crud.load_turn(db, dialog_id, current_user.user_id, history_manager.max_messages)
+            user_message = await crud.create_message(db, msg_in=payload, user_id=current_user.user_id, is_bot=False)
+    except BaseException:
+        retrieval.cancel()
+        raise
+    history = history_manager.select(dialog, recent + [user_message])
+    user_message_out = schemas.MessageResponse.model_validate(user_message, from_attributes=True).model_dump(mode="json")
+
+    sources: list[dict] = []
+
+    async def save_bot_message(text: str) -> models.Message:
+        # сессия запроса к этому моменту уже закрыта, открываем свою
+        async with async_session() as session:
+            return await crud.create_message(
+                session,
+                msg_in=schemas.MessageCreate(text=text, dialog_id=dialog_id),
+                user_id=current_user.user_id,
+                is_bot=True,
+                sources=sources
+            )
+
+    async def event_stream():
+        parts: list[str] = []
+        completed = False
+        bot_message = None
+        try:
+            yield sse_event(user_message_out, event="user_message")
+            async for token in model.stream_generate(
+                user_message.text, history.messages, history.summary, sources,
+                hits=await retrieval, timings=timings
+            ):
+                parts.append(token)
+                yield sse_event({"token": token}, event="token")
+            completed = True
+        except LLMError as exc:
+            logger.warning("Streaming generation failed: %r", exc)
+            yield sse_event({"detail": "LLM backend unavailable"}, event="error")
+        except Exception:
+            # поиск или генерация упали не по вине LLM: заголовки уже отправлены,
+            # поэтому вместо 500 клиент получает событие error
+            logger.exception("Streaming turn failed")
+            yield sse_event({"detail": "Internal error"}, event="error")
+        finally:
+            retrieval.cancel()
+            # полный и оборванный (клиент отключился, генерация упала) ответы
+            # сохраняются здесь одним путём, так что повторной записи не бывает
+            if completed or parts:
+                with anyio.CancelScope(shield=True):
+                    bot_message = await timings.measure("persist", save_bot_message("".join(parts)))
+        if completed:
+            yield sse_event(schemas.MessageResponse.model_validate(bot_message, from_attributes=True).model_dump(mode="json"), event="done")
+
+    return StreamingResponse(
+        event_stream(),
+        media_type="text/event-stream",
+        # к началу ответа известны только стадии до генерации; полный разбор —
+        # в civbot_stage_seconds и в логе медленных запросов
+        headers={
+            "Cache-Control": "no-cache",
+            "X-Accel-Buffering": "no",
+            "Server-Timing": timings.server_timing(),
+        },
+    )
 
 
 @app.get(
@@ -138,10 +466,16 @@ async def create_message_in_dialog(
 )
 async def read_messages_in_dialog(
     dialog_id: int,
+    response: Response,
+    limit: int = Query(DEFAULT_PAGE_SIZE, ge=1, le=MAX_PAGE_SIZE),
+    cursor: Optional[str] = None,
+    order: PageOrder = "asc",
     current_user: models.User = Security(get_current_user),
     db: AsyncSession = Depends(get_db)
 ):
-    return await crud.get_messages_by_dialog(db, dialog_id)
+    # следующая страница — с курсором из заголовка X-Next-Cursor
+    rows = await crud.get_messages_by_dialog(db, dialog_id, limit + 1, decode_cursor(cursor), order == "desc")
+    return page(rows, limit, response, lambda m: (m.created_at, m.message_id))
 
 
 @app.get(
@@ -149,10 +483,15 @@ async def read_messages_in_dialog(
     response_model=List[schemas.DialogResponse],
 )
 async def read_dialogs_for_user(
+    response: Response,
+    limit: int = Query(DEFAULT_PAGE_SIZE, ge=1, le=MAX_PAGE_SIZE),
+    cursor: Optional[str] = None,
+    order: PageOrder = "asc",
     current_user: models.User = Security(get_current_user),
     db: AsyncSession = Depends(get_db)
 ):
-    return await crud.get_dialogs_by_user(db, current_user.user_id)
+    rows = await crud.get_dialogs_by_user(db, current_user.user_id, limit + 1, decode_cursor(cursor), order == "desc")
+    return page(rows, limit, response, lambda d: (d.created_at, d.dialog_id))
 
 # Получить все сообщения пользователя
 
@@ -163,10 +502,41 @@ async def read_dialogs_for_user(
     tags=["messages"]
 )
 async def read_messages_for_current_user(
+    response: Response,
+    limit: int = Query(DEFAULT_PAGE_SIZE, ge=1, le=MAX_PAGE_SIZE),
+    cursor: Optional[str] = None,
+    order: PageOrder = "asc",
+    current_user: models.User = Security(get_current_user),
+    db: AsyncSession = Depends(get_db)
+):
+    rows = await crud.get_messages_by_user(db, current_user.user_id, limit + 1, decode_cursor(cursor), order == "desc")
+    return page(rows, limit, response, lambda m: (m.created_at, m.message_id))
+
+
+@app.get("/dialogs/{dialog_id}/export", tags=["export"])
+async def export_dialog_file(
+    dialog_id: int,
+    request: Request,
+    format: str = Query("txt", pattern="^(txt|html|jsonl)$"),
+    current_user: models.User = Security(get_current_user),
+    db: AsyncSession = Depends(get_db)
+):
+    dialog = await crud.get_dialog_by_id(db, dialog_id)
+    if not dialog:
+        raise HTTPException(404, "Dialog not found")
+    if dialog.user_id != current_user.user_id:
+        raise HTTPException(403, "Access denied")
+    return await export_dialog(request, db, dialog, format)
+
+
+@app.get("/users/me/export", tags=["export"])
+async def export_current_user_dialogs(
+    request: Request,
+    format: str = Query("txt", pattern="^(txt|html|jsonl)$"),
     current_user: models.User = Security(get_current_user),
     db: AsyncSession = Depends(get_db)
 ):
-    return await crud.get_messages_by_user(db, current_user.user_id)
+    return await export_user_dialogs(request, db, current_user, format)
 
 
 @app.put(
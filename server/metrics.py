@@ -0,0 +1,212 @@
+"""
+Метрики Prometheus и трассировка запросов.
+
+civbot_stage_seconds{stage} — длительности стадий: проверка токена (auth),
+эмбеддинг вопроса (embedding), поиск по индексу (vector_search), реранкинг
+(rerank) и стадии хода диалога из StageTimings (history, retrieval, cache,
+context, first_token, generation, persist; queue — ожидание фоновой задачи
+в очереди, jobs.py; coalesced — ожидание чужой одинаковой генерации).
+Запросы к базе попадают в civbot_db_query_seconds, HTTP-запросы целиком —
+в civbot_http_request_seconds.
+Размеры пула соединений и кешей снимаются в момент опроса /metrics.
+
+RequestTracingMiddleware присваивает запросу id (заголовок REQUEST_ID_HEADER),
+добавляет его в каждую запись лога и пишет в лог запросы дольше
+SLOW_REQUEST_SECONDS вместе с разбором по стадиям.
+
+civbot_coalesced_requests{call} считает запросы, объединённые с таким же
+одновременным запросом (singleflight.py): call — retrieval или generation.
+"""
+import logging
+import re
+import time
+import uuid
+from contextlib import contextmanager
+from contextvars import ContextVar
+from typing import Callable
+
+from prometheus_client import CONTENT_TYPE_LATEST, REGISTRY, Counter, Histogram, generate_latest
+from prometheus_client.core import GaugeMetricFamily
+from sqlalchemy import event
+
+from app_config import settings
+
+logger = logging.getLogger(__name__)
+
+LATENCY_BUCKETS = (
+    0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0,
+)
+
+STAGE_SECONDS = Histogram(
+    "civbot_stage_seconds", "Длительность стадии обработки запроса", ["stage"], buckets=LATENCY_BUCKETS
+)
+DB_QUERY_SECONDS = Histogram(
+    "civbot_db_query_seconds", "Длительность SQL-запроса", ["operation"], buckets=LATENCY_BUCKETS
+)
+HTTP_REQUEST_SECONDS = Histogram(
+    "civbot_http_request_seconds", "Длительность HTTP-запроса", ["method", "route", "status"],
+    buckets=LATENCY_BUCKETS,
+)
+LLM_TOKENS = Counter("civbot_llm_tokens", "Токены LLM", ["kind"])
+COALESCED_REQUESTS = Counter(
+    "civbot_coalesced_requests", "Запросы, получившие результат чужого одновременного вызова", ["call"]
+)
+
+request_id_var: ContextVar[str] = ContextVar("request_id", default="-")
+
+REQUEST_ID_PATTERN = re.compile(r"^[A-Za-z0-9._-]{1,64}$")
+LOG_FORMAT = "%(asctime)s %(levelname)s [%(request_id)s] %(name)s: %(message)s"
+
+
+def observe_stage(stage: str, seconds: float) -> None:
+    STAGE_SECONDS.labels(stage).observe(seconds)
+
+
+@contextmanager
+def track_stage(stage: str):
+    started = time.perf_counter()
+    try:
+        yield
+    finally:
+        observe_stage(stage, time.perf_counter() - started)
+
+
+def count_llm_tokens(prompt: int = 0, completion: int = 0) -> None:
+    if prompt:
+        LLM_TOKENS.labels("prompt").inc(prompt)
+    if completion:
+        LLM_TOKENS.labels("completion").inc(completion)
+
+
+class StatsCollector:
+    """
+    Отдаёт числовые поля stats() компонентов как gauge
+    civbot_component_stat{component, stat}; значения читаются при каждом опросе.
+    """
+
+    def __init__(self):
+        self._sources: dict[str, Callable[[], dict]] = {}
+
+    def register(self, component: str, stats: Callable[[], dict]) -> None:
+        self._sources[component] = stats
+
+    def collect(self):
+        family = GaugeMetricFamily(
+            "civbot_component_stat", "Состояние пулов и кешей", labels=["component", "stat"]
+        )
+        for component, stats in list(self._sources.items()):
+            try:
+                values = stats()
+            except Exception:
+                logger.warning("Stats of %s are unavailable", component, exc_info=True)
+                continue
+            for stat, value in values.items():
+                if isinstance(value, (int, float)) and not isinstance(value, bool):
+                    family.add_metric([component, stat], float(value))
+        yield family
+
+
+stats_collector = StatsCollector()
+REGISTRY.register(stats_collector)
+
+
+def pool_stats(engine) -> Callable[[], dict]:
+    def stats() -> dict:
+        pool = engine.sync_engine.pool
+        # у NullPool/StaticPool (SQLite) счётчиков нет
+        return {
+            name: getattr(pool, name)()
+            for name in ("size", "checkedin", "checkedout", "overflow")
+            if callable(getattr(pool, name, None))
+        }
+    return stats
+
+
+def instrument_engine(engine) -> None:
+    """Замеряет каждый SQL-запрос движка; operation — первое слово запроса."""
+    sync_engine = engine.sync_engine
+
+    @event.listens_for(sync_engine, "before_cursor_execute")
+    def before_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+        context._query_started = time.perf_counter()
+
+    @event.listens_for(sync_engine, "after_cursor_execute")
+    def after_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+        started = getattr(context, "_query_started", None)
+        if started is not None:
+            operation = statement.lstrip().split(None, 1)[0].upper() if statement.strip() else "OTHER"
+            DB_QUERY_SECONDS.labels(operation).observe(time.perf_counter() - started)
+
+
+def metrics_payload() -> tuple[bytes, str]:
+    return generate_latest(REGISTRY), CONTENT_TYPE_LATEST
+
+
+def configure_logging() -> None:
+    """Формат логов сервера с id запроса в каждой записи."""
+    factory = logging.getLogRecordFactory()
+
+    def record_factory(*args, **kwargs):
+        record = factory(*args, **kwargs)
+        record.request_id = request_id_var.get()
+        return record
+
+    logging.setLogRecordFactory(record_factory)
+    logging.basicConfig(level=settings.LOG_LEVEL, format=LOG_FORMAT)
+    # httpx пишет в INFO каждый запрос к LLM и Pinecone
+    logging.getLogger("httpx").setLevel(logging.WARNING)
+
+
+class RequestTracingMiddleware:
+    """
+    ASGI-middleware: id запроса, гистограмма HTTP-запросов и лог медленных.
+
+    Время считается до отправки последней части ответа, так что для потоковых
+    ответов в него входит вся генерация. Разбор по стадиям берётся из
+    request.state.timings, если обработчик его выставил.
+    """
+
+    def __init__(self, app, header: str = "X-Request-ID", slow_seconds: float = 2.0):
+        self.app = app
+        self.header = header.lower().encode("latin-1")
+        self.slow_seconds = slow_seconds
+
+    def _request_id(self, scope) -> str:
+        for name, value in scope.get("headers", []):
+            if name == self.header:
+                incoming = value.decode("latin-1")
+                if REQUEST_ID_PATTERN.match(incoming):
+                    return incoming
+        return uuid.uuid4().hex
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http":
+            await self.app(scope, receive, send)
+            return
+        request_id = self._request_id(scope)
+        token = request_id_var.set(request_id)
+        started = time.perf_counter()
+        status = 500
+
+        async def send_with_id(message):
+            nonlocal status
+            if message["type"] == "http.response.start":
+                status = message["status"]
+                message["headers"] = [*message.get("headers", []), (self.header, request_id.encode("latin-1"))]
+            await send(message)
+
+        try:
+            await self.app(scope, receive, send_with_id)
+        finally:
+            elapsed = time.perf_counter() - started
+            # шаблон пути, а не сам путь: иначе у метрики по метке на каждый id
+            route = getattr(scope.get("route"), "path", "unmatched")
+            HTTP_REQUEST_SECONDS.labels(scope["method"], route, str(status)).observe(elapsed)
+            if elapsed >= self.slow_seconds:
+                timings = scope.get("state", {}).get("timings")
+                logger.warning(
+                    "Slow request %s %s -> %s in %.3fs%s",
+                    scope["method"], scope["path"], status, elapsed,
+                    f" ({timings.server_timing()})" if timings is not None else "",
+                )
+            request_id_var.reset(token)
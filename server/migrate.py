@@ -0,0 +1,102 @@
+"""
+Применяет SQL-миграции из каталога migrations/ по порядку имён.
+
+Применённые версии записываются в таблицу schema_migrations, каждая миграция
+выполняется в своей транзакции. Начальные строки "-- migrate: ..." задают
+параметры файла:
+
+    -- migrate: no-transaction    autocommit по одной команде (например,
+                                  для CREATE INDEX CONCURRENTLY);
+    -- migrate: backend=pgvector  только при VECTOR_BACKEND=pgvector: схема
+                                  базы знаний требует расширения vector,
+                                  которого может не быть на сервере.
+
+Пропущенная по бэкенду миграция не записывается как применённая и
+выполнится, когда бэкенд сменят. Запуск: python migrate.py
+"""
+import os
+
+import psycopg2
+
+from app_config import settings
+
+MIGRATIONS_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), "migrations")
+OPTIONS_PREFIX = "-- migrate:"
+
+
+def pending_migrations(applied: set[str]) -> list[str]:
+    names = sorted(name for name in os.listdir(MIGRATIONS_DIR) if name.endswith(".sql"))
+    return [name for name in names if name[:-4] not in applied]
+
+
+def migration_options(sql: str) -> dict[str, str]:
+    """Параметры из начальных строк "-- migrate: ..."; флаг без значения — ""."""
+    options = {}
+    for line in sql.splitlines():
+        if not line.startswith(OPTIONS_PREFIX):
+            break
+        for option in line[len(OPTIONS_PREFIX):].split():
+            name, _, value = option.partition("=")
+            options[name] = value
+    return options
+
+
+def split_statements(sql: str) -> list[str]:
+    """Команды файла миграции: без комментариев, разделены ";" в конце строки."""
+    lines = [line for line in sql.splitlines() if not line.lstrip().startswith("--")]
+    statements, current = [], []
+    for line in lines:
+        current.append(line)
+        if line.rstrip().endswith(";"):
+            statements.append("\n".join(current).strip())
+            current = []
+    tail = "\n".join(current).strip()
+    return statements + ([tail] if tail else [])
+
+
+def run_without_transaction(conn, sql: str) -> None:
+    # несколько команд в одном запросе PostgreSQL выполняет как одну
+    # транзакцию, поэтому команды отправляются по одной
+    conn.autocommit = True
+    try:
+        with conn.cursor() as cur:
+            for statement in split_statements(sql):
+                cur.execute(statement)
+    finally:
+        conn.autocommit = False
+
+
+def migrate() -> None:
+    conn = psycopg2.connect(settings.DATABASE_URL)
+    try:
+        with conn, conn.cursor() as cur:
+            cur.execute(
+                "CREATE TABLE IF NOT EXISTS schema_migrations ("
+                " version TEXT PRIMARY KEY,"
+                " applied_at TIMESTAMPTZ NOT NULL DEFAULT now())"
+            )
+            cur.execute("SELECT version FROM schema_migrations")
+            applied = {row[0] for row in cur.fetchall()}
+
+        for name in pending_migrations(applied):
+            with open(os.path.join(MIGRATIONS_DIR, name), encoding="utf-8") as f:
+                sql = f.read()
+            options = migration_options(sql)
+            backend = options.get("backend")
+            if backend and backend != settings.VECTOR_BACKEND:
+                print(f"Пропущена миграция {name}: только для VECTOR_BACKEND={backend}")
+                continue
+            no_transaction = "no-transaction" in options
+            if no_transaction:
+                run_without_transaction(conn, sql)
+            with conn, conn.cursor() as cur:
+                if not no_transaction:
+                    cur.execute(sql)
+                cur.execute("INSERT INTO schema_migrations (version) VALUES (%s)", (name[:-4],))
+            print(f"Применена миграция {name}")
+    finally:
+        conn.close()
+
+
+if __name__ == "__main__":
+    migrate()
@@ -0,0 +1,15 @@
+-- migrate: backend=pgvector
+-- База знаний в PostgreSQL (VECTOR_BACKEND=pgvector).
+-- Размерность 312 соответствует cointegrated/rubert-tiny2.
+CREATE EXTENSION IF NOT EXISTS vector;
+
+CREATE TABLE IF NOT EXISTS kb_chunks (
+    chunk_id  TEXT PRIMARY KEY,
+    text      TEXT NOT NULL,
+    metadata  JSONB NOT NULL DEFAULT '{}'::jsonb,
+    embedding vector(312) NOT NULL
+);
+
+CREATE INDEX IF NOT EXISTS kb_chunks_embedding_hnsw
+    ON kb_chunks USING hnsw (embedding vector_cosine_ops)
+    WITH (m = 16, ef_construction = 64);
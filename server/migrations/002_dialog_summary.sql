@@ -0,0 +1,3 @@
+-- Краткое содержание старых реплик диалога (см. history.py).
+ALTER TABLE dialogs ADD COLUMN IF NOT EXISTS summary TEXT;
+ALTER TABLE dialogs ADD COLUMN IF NOT EXISTS summary_until_id INTEGER;
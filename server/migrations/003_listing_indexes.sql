@@ -0,0 +1,13 @@
+-- migrate: no-transaction
+-- Составные индексы под курсорную пагинацию списков (см. pagination.py)
+-- и выборку последних сообщений диалога для истории.
+-- CONCURRENTLY не блокирует запись в таблицы на время построения, но не
+-- работает внутри транзакции: migrate.py выполняет этот файл в autocommit.
+-- Если построение прервалось, индекс остаётся INVALID и IF NOT EXISTS его
+-- пропустит — такой индекс нужно удалить (DROP INDEX CONCURRENTLY) и
+-- запустить миграцию снова.
+CREATE INDEX CONCURRENTLY IF NOT EXISTS ix_messages_dialog_created
+    ON messages (dialog_id, created_at, message_id);
+
+CREATE INDEX CONCURRENTLY IF NOT EXISTS ix_dialogs_user_created
+    ON dialogs (user_id, created_at, dialog_id);
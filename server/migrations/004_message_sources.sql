@@ -0,0 +1,2 @@
+-- Источники ответа бота: фрагменты базы знаний, попавшие в контекст.
+ALTER TABLE messages ADD COLUMN IF NOT EXISTS sources JSONB;
@@ -0,0 +1,3 @@
+-- Время последней правки сообщения: по нему ETag экспорта замечает
+-- отредактированные сообщения (см. export.py).
+ALTER TABLE messages ADD COLUMN IF NOT EXISTS updated_at TIMESTAMP DEFAULT now();
@@ -0,0 +1,9 @@
+-- Владелец диалога в сообщениях: список всех сообщений пользователя
+-- (GET /users/me/messages) читается по индексу без соединения с dialogs.
+ALTER TABLE messages ADD COLUMN IF NOT EXISTS user_id INTEGER
+    REFERENCES users (user_id) ON DELETE CASCADE;
+
+UPDATE messages m
+SET user_id = d.user_id
+FROM dialogs d
+WHERE d.dialog_id = m.dialog_id AND m.user_id IS NULL;
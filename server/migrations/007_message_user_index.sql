@@ -0,0 +1,5 @@
+-- migrate: no-transaction
+-- Индекс под курсорную пагинацию сообщений пользователя (см. 006 и
+-- pagination.py); строится без блокировки записи, как и в 003.
+CREATE INDEX CONCURRENTLY IF NOT EXISTS ix_messages_user_created
+    ON messages (user_id, created_at, message_id);
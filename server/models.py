@@ -1,4 +1,5 @@
-from sqlalchemy import Column, Integer, String, Boolean, ForeignKey, Text, DateTime
+from sqlalchemy import JSON, Column, Integer, String, Boolean, ForeignKey, Text, DateTime, Index, event
+from sqlalchemy.dialects.postgresql import JSONB
 from sqlalchemy.sql import func
 from sqlalchemy.orm import relationship, declarative_base
 from database import Base
@@ -13,24 +14,54 @@ class User(Base):
     created_at = Column(DateTime, server_default=func.now())
 
 
+@event.listens_for(User, "after_update")
+@event.listens_for(User, "after_delete")
+def _invalidate_cached_user(mapper, connection, target):
+    # пользователь в кеше проверки токенов больше не актуален
+    from auth import user_cache
+
+    user_cache.invalidate(target.user_id)
+
+
 class Dialog(Base):
     __tablename__ = "dialogs"
     dialog_id = Column(Integer, primary_key=True)
     user_id = Column(Integer, ForeignKey("users.user_id", ondelete="CASCADE"))
     name = Column(String(255))
     created_at = Column(DateTime, server_default=func.now())
+    # краткое содержание реплик, вышедших из окна истории, до summary_until_id включительно
+    summary = Column(Text)
+    summary_until_id = Column(Integer)
     messages = relationship("Message", back_populates="dialog")
 
+    __table_args__ = (
+        # список диалогов пользователя с курсорной пагинацией (см. migrations/003)
+        Index("ix_dialogs_user_created", "user_id", "created_at", "dialog_id"),
+    )
+
 
 class Message(Base):
     __tablename__ = "messages"
     message_id = Column(Integer, primary_key=True)
     dialog_id = Column(Integer, ForeignKey("dialogs.dialog_id", ondelete="CASCADE"))
+    # владелец диалога, продублированный для списка всех сообщений пользователя
+    user_id = Column(Integer, ForeignKey("users.user_id", ondelete="CASCADE"))
     type = Column(String(50))
     text = Column(Text)
     created_at = Column(DateTime, server_default=func.now())
+    # время последней правки текста; входит в ETag экспорта (см. export.py)
+    updated_at = Column(DateTime, server_default=func.now(), onupdate=func.now())
+    # фрагменты базы знаний, на которых основан ответ бота: [{chunk_id, source}]
+    sources = Column(JSON().with_variant(JSONB, "postgresql"))
     dialog = relationship("Dialog", back_populates="messages")
 
+    __table_args__ = (
+        # история диалога и курсорная пагинация сообщений (см. migrations/003)
+        Index("ix_messages_dialog_created", "dialog_id", "created_at", "message_id"),
+        # все сообщения пользователя (см. migrations/007)
+        Index("ix_messages_user_created", "user_id", "created_at", "message_id"),
+    )
+
 
 class MessageUserReview(Base):
     __tablename__ = "message_user_reviews"
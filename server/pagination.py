@@ -0,0 +1,52 @@
+"""
+Курсорная (keyset) пагинация списков.
+
+Страницы упорядочены по (created_at, id); курсор — позиция последней
+отданной строки, следующая страница начинается строго после неё. В отличие
+от OFFSET, запрос следующей страницы читает по индексу только limit строк,
+сколько бы записей ни было раньше.
+
+order=desc отдаёт список от новых записей к старым (последние сообщения —
+первой страницей); курсор тогда ведёт к более ранним строкам. Курсор
+действителен только с тем же order, с которым получен.
+"""
+import base64
+import json
+from datetime import datetime
+from typing import Literal, Optional
+
+from fastapi import HTTPException, Response
+
+NEXT_CURSOR_HEADER = "X-Next-Cursor"
+DEFAULT_PAGE_SIZE = 50
+MAX_PAGE_SIZE = 200
+
+PageOrder = Literal["asc", "desc"]
+
+
+def encode_cursor(created_at: datetime, row_id: int) -> str:
+    raw = json.dumps([created_at.isoformat(), row_id]).encode("utf-8")
+    return base64.urlsafe_b64encode(raw).decode("ascii").rstrip("=")
+
+
+def decode_cursor(cursor: Optional[str]) -> Optional[tuple[datetime, int]]:
+    if not cursor:
+        return None
+    try:
+        raw = base64.urlsafe_b64decode(cursor + "=" * (-len(cursor) % 4))
+        created_at, row_id = json.loads(raw)
+        return datetime.fromisoformat(created_at), int(row_id)
+    except (ValueError, TypeError):
+        raise HTTPException(400, "Invalid cursor")
+
+
+def page(rows: list, limit: int, response: Response, key) -> list:
+    """
+    Обрезает выборку из limit + 1 строк до limit и выставляет X-Next-Cursor.
+
+    key(row) -> (created_at, id); заголовок есть, только если строки ещё остались.
+    """
+    if len(rows) > limit:
+        rows = rows[:limit]
+        response.headers[NEXT_CURSOR_HEADER] = encode_cursor(*key(rows[-1]))
+    return rows
@@ -0,0 +1,121 @@
+"""
+База знаний в PostgreSQL + pgvector (таблица kb_chunks, см. migrations/).
+
+Загрузка идёт через COPY во временную таблицу и один INSERT ... ON CONFLICT,
+поиск — через общий пул asyncpg приложения (database.engine) с HNSW-индексом
+и hnsw.ef_search из PGVECTOR_EF_SEARCH, выставляемым в транзакции запроса.
+"""
+import io
+import json
+from typing import Iterable
+
+import numpy as np
+import psycopg2
+from sqlalchemy import text
+from sqlalchemy.dialects.postgresql.psycopg2 import PGDialect_psycopg2
+
+from app_config import settings
+
+
+def vector_literal(vec) -> str:
+    return "[" + ",".join(f"{x:.7g}" for x in np.asarray(vec, dtype=np.float32)) + "]"
+
+
+def _copy_field(value: str) -> str:
+    # экранирование для текстового формата COPY
+    return (
+        value.replace("\\", "\\\\")
+        .replace("\t", "\\t")
+        .replace("\n", "\\n")
+        .replace("\r", "\\r")
+    )
+
+
+def connect():
+    return psycopg2.connect(settings.DATABASE_URL)
+
+
+def copy_upsert(conn, chunks: Iterable, embeddings) -> int:
+    """
+    Загружает фрагменты одной командой COPY и сливает их в kb_chunks.
+
+    chunks — объекты с полями id, text, metadata (например local_store.StoredChunk).
+    Транзакцией управляет вызывающий код.
+    """
+    buf = io.StringIO()
+    count = 0
+    for chunk, vec in zip(chunks, embeddings):
+        buf.write("\t".join((
+            _copy_field(chunk.id),
+            _copy_field(chunk.text),
+            _copy_field(json.dumps(chunk.metadata, ensure_ascii=False)),
+            vector_literal(vec),
+        )))
+        buf.write("\n")
+        count += 1
+    buf.seek(0)
+    with conn.cursor() as cur:
+        # в одной транзакции загрузка может идти несколькими пачками
+        cur.execute(
+            "CREATE TEMP TABLE IF NOT EXISTS kb_chunks_stage "
+            "(LIKE kb_chunks INCLUDING DEFAULTS) ON COMMIT DROP"
+        )
+        cur.execute("TRUNCATE kb_chunks_stage")
+        cur.copy_expert(
+            "COPY kb_chunks_stage (chunk_id, text, metadata, embedding) FROM STDIN",
+            buf,
+        )
+        cur.execute(
+            "INSERT INTO kb_chunks (chunk_id, text, metadata, embedding) "
+            "SELECT chunk_id, text, metadata, embedding FROM kb_chunks_stage "
+            "ON CONFLICT (chunk_id) DO UPDATE SET "
+            "text = EXCLUDED.text, metadata = EXCLUDED.metadata, embedding = EXCLUDED.embedding"
+        )
+    return count
+
+
+SEARCH_QUERY = text(
+    "SELECT chunk_id, text, metadata, "
+    "1 - (embedding <=> CAST(:q AS vector)) AS score "
+    "FROM kb_chunks ORDER BY embedding <=> CAST(:q AS vector) LIMIT :k"
+)
+# тот же запрос с параметрами в стиле psycopg2 — для search_sync
+SEARCH_SQL = str(SEARCH_QUERY.compile(dialect=PGDialect_psycopg2()))
+
+
+def _ef_search(top_k: int) -> str:
+    # при ef_search < top_k HNSW вернёт меньше top_k строк
+    return str(max(settings.PGVECTOR_EF_SEARCH, top_k))
+
+
+def search_sync(query_embedding, top_k: int) -> list:
+    """
+    Синхронный поиск для скриптов и бенчмарков: отдельное соединение psycopg2
+    на вызов, без пула приложения.
+    """
+    from psycopg2.extras import NamedTupleCursor
+
+    conn = connect()
+    try:
+        with conn, conn.cursor(cursor_factory=NamedTupleCursor) as cur:
+            cur.execute("SELECT set_config('hnsw.ef_search', %s, true)", (_ef_search(top_k),))
+            cur.execute(SEARCH_SQL, {"q": vector_literal(query_embedding), "k": top_k})
+            return cur.fetchall()
+    finally:
+        conn.close()
+
+
+async def search(engine, query_embedding, top_k: int) -> list:
+    """Ближайшие фрагменты по косинусному расстоянию через пул приложения."""
+    async with engine.connect() as conn:
+        async with conn.begin():
+            # set_config(..., true) действует только до конца транзакции
+            await conn.execute(
+                text("SELECT set_config('hnsw.ef_search', :ef, true)"),
+                {"ef": _ef_search(top_k)},
+            )
+            result = await conn.execute(
+                SEARCH_QUERY,
+                {"q": vector_literal(query_embedding), "k": top_k},
+            )
+            return result.all()
@@ -0,0 +1,136 @@
+import asyncio
+import re
+import threading
+from collections import OrderedDict
+from dataclasses import dataclass
+
+import numpy as np
+
+from app_config import settings
+
+
+@dataclass
+class ScoredFragment:
+    text: str
+    score: float
+
+
+class Reranker:
+    """Выбирает top_k фрагментов контекста, наиболее релевантных запросу."""
+
+    async def rerank(self, query: str, fragments: list[str], top_k: int) -> list[ScoredFragment]:
+        raise NotImplementedError
+
+
+class NoopReranker(Reranker):
+    """Оставляет порядок, в котором фрагменты вернул поиск."""
+
+    async def rerank(self, query: str, fragments: list[str], top_k: int) -> list[ScoredFragment]:
+        return [ScoredFragment(text, 0.0) for text in fragments[:top_k]]
+
+
+def top_k_by_score(fragments: list[str], scores: np.ndarray, top_k: int) -> list[ScoredFragment]:
+    # стабильная сортировка: при равных оценках сохраняется порядок поиска
+    order = np.argsort(-scores, kind="stable")[:top_k]
+    return [ScoredFragment(fragments[i], float(scores[i])) for i in order]
+
+
+class EmbeddingReranker(Reranker):
+    """
+    Косинусная близость запроса и фрагментов на эмбеддингах rubert-tiny2.
+
+    Эмбеддинги фрагментов кешируются: корпус небольшой, и после прогрева
+    ранжирование сводится к одному матричному умножению.
+    """
+
+    def __init__(self, embed_model, cache_size: int = 10000):
+        self.embed_model = embed_model
+        self.cache_size = cache_size
+        self._cache: OrderedDict[str, np.ndarray] = OrderedDict()
+        self._lock = threading.Lock()
+
+    def _fragment_matrix(self, fragments: list[str]) -> np.ndarray:
+        vectors: dict[str, np.ndarray] = {}
+        with self._lock:
+            for text in fragments:
+                if text in self._cache:
+                    self._cache.move_to_end(text)
+                    vectors[text] = self._cache[text]
+        missing = [text for text in dict.fromkeys(fragments) if text not in vectors]
+        if missing:
+            embedded = self.embed_model.get_text_embedding_batch(missing)
+            with self._lock:
+                for text, vec in zip(missing, embedded):
+                    vectors[text] = self._cache[text] = np.asarray(vec, dtype=np.float32)
+                while len(self._cache) > self.cache_size:
+                    self._cache.popitem(last=False)
+        return np.vstack([vectors[text] for text in fragments])
+
+    def score(self, query: str, fragments: list[str]) -> np.ndarray:
+        matrix = self._fragment_matrix(fragments)
+        query_vec = np.asarray(self.embed_model.get_query_embedding(query), dtype=np.float32)
+        norms = np.linalg.norm(matrix, axis=1) * np.linalg.norm(query_vec)
+        return matrix @ query_vec / np.maximum(norms, 1e-12)
+
+    async def rerank(self, query: str, fragments: list[str], top_k: int) -> list[ScoredFragment]:
+        if not fragments:
+            return []
+        scores = await asyncio.to_thread(self.score, query, fragments)
+        return top_k_by_score(fragments, scores, top_k)
+
+
+class CrossEncoderReranker(Reranker):
+    """Небольшой cross-encoder из sentence-transformers (опционально)."""
+
+    def __init__(self, model_name: str):
+        try:
+            from sentence_transformers import CrossEncoder
+        except ImportError as exc:
+            raise RuntimeError("RERANK_MODE=cross_encoder requires sentence-transformers") from exc
+        self.model = CrossEncoder(model_name, device="cpu")
+
+    async def rerank(self, query: str, fragments: list[str], top_k: int) -> list[ScoredFragment]:
+        if not fragments:
+            return []
+        pairs = [(query, text) for text in fragments]
+        scores = await asyncio.to_thread(self.model.predict, pairs)
+        return top_k_by_score(fragments, np.asarray(scores, dtype=np.float32), top_k)
+
+
+class LLMReranker(Reranker):
+    """Прежний способ: отдельный запрос к LLM с просьбой назвать номера фрагментов."""
+
+    def __init__(self, llm_client, system_prompt: str):
+        self.llm_client = llm_client
+        self.system_prompt = system_prompt
+
+    async def rerank(self, query: str, fragments: list[str], top_k: int) -> list[ScoredFragment]:
+        if not fragments:
+            return []
+        rerank_prompt = f"From the following context fragments, choose the {top_k} most relevant to the query:\n\n"
+        for i, frag in enumerate(fragments, 1):
+            rerank_prompt += f"{i}. {frag}\n"
+        rerank_prompt += f"\nQuery: {query}\nAnswer:"
+
+        sel = await self.llm_client.chat([
+            {"role": "system", "content": self.system_prompt},
+            {"role": "user",   "content": rerank_prompt},
+        ])
+        selected_idxs = [int(x) for x in re.findall(r"\b\d+\b", sel)]
+        selected = list(dict.fromkeys(i for i in selected_idxs if 1 <= i <= len(fragments)))[:top_k]
+        if not selected:
+            # модель ответила текстом без номеров: берём порядок поиска
+            selected = list(range(1, min(top_k, len(fragments)) + 1))
+        return [ScoredFragment(fragments[i - 1], 0.0) for i in selected]
+
+
+def build_reranker(mode: str, embed_model, llm_client, system_prompt: str) -> Reranker:
+    if mode == "embedding":
+        return EmbeddingReranker(embed_model)
+    if mode == "cross_encoder":
+        return CrossEncoderReranker(settings.RERANK_CROSS_ENCODER_MODEL)
+    if mode == "llm":
+        return LLMReranker(llm_client, system_prompt)
+    if mode == "none":
+        return NoopReranker()
+    raise ValueError(f"Unknown RERANK_MODE: {mode!r}")
@@ -0,0 +1,151 @@
+import asyncio
+import json
+from dataclasses import dataclass, field
+from typing import Optional
+
+import numpy as np
+
+from app_config import settings
+from metrics import track_stage
+
+
+@dataclass
+class RetrievedChunk:
+    id: str
+    text: str
+    score: float
+    metadata: dict = field(default_factory=dict)
+    embedding: Optional[np.ndarray] = None
+
+
+class Retriever:
+    """Поиск фрагментов базы знаний по запросу."""
+
+    embed_model = None
+
+    def search(self, query: str, query_embedding: list[float]) -> list[RetrievedChunk]:
+        raise NotImplementedError
+
+    def retrieve(self, query: str) -> list[RetrievedChunk]:
+        return self.search(query, self.embed_model.get_query_embedding(query))
+
+    async def aretrieve(self, query: str) -> list[RetrievedChunk]:
+        # эмбеддинг считается общим микробатчером, синхронный поиск — в пуле потоков
+        with track_stage("embedding"):
+            query_embedding = await self.embed_model.aget_query_embedding(query)
+        with track_stage("vector_search"):
+            return await asyncio.to_thread(self.search, query, query_embedding)
+
+
+class PineconeRetriever(Retriever):
+    def __init__(self, embed_model, top_k: int):
+        from pinecone import Pinecone
+        from llama_index.core import StorageContext, VectorStoreIndex
+        from llama_index.core.embeddings import MockEmbedding
+        from llama_index.vector_stores.pinecone import PineconeVectorStore
+
+        pinecone_client = Pinecone(api_key=settings.PINECONE_API_KEY)
+        pc_index = pinecone_client.Index(settings.PINECONE_INDEX_NAME)
+        store = PineconeVectorStore(pinecone_index=pc_index)
+        storage_context = StorageContext.from_defaults(vector_store=store)
+        self.embed_model = embed_model
+        # эмбеддинг запроса считаем сами (через кеш) и передаём в QueryBundle,
+        # поэтому индексу модель не нужна
+        self.index = VectorStoreIndex.from_vector_store(
+            vector_store=store,
+            storage_context=storage_context,
+            embed_model=MockEmbedding(embed_dim=1),
+        )
+        self.retriever = self.index.as_retriever(
+            similarity_top_k=top_k,
+            hybrid=True,
+            alpha=0.4,
+        )
+
+    def search(self, query: str, query_embedding: list[float]) -> list[RetrievedChunk]:
+        chunks = []
+        from llama_index.core.schema import QueryBundle
+
+        bundle = QueryBundle(query_str=query, embedding=query_embedding)
+        for hit in self.retriever.retrieve(bundle):
+            node = hit.node
+            text = node.get_content() if hasattr(node, "get_content") else str(node.text)
+            chunks.append(RetrievedChunk(
+                id=node.node_id,
+                text=text,
+                score=float(hit.score or 0.0),
+                metadata=dict(node.metadata or {}),
+            ))
+        return chunks
+
+
+class LocalRetriever(Retriever):
+    def __init__(self, embed_model, top_k: int, store_dir: str):
+        from local_store import LocalVectorStore, resolve_store_dir
+
+        self.embed_model = embed_model
+        self.top_k = top_k
+        self.store = LocalVectorStore(resolve_store_dir(store_dir))
+
+    def search(self, query: str, query_embedding: list[float]) -> list[RetrievedChunk]:
+        chunks = []
+        for i, score in self.store.search(query_embedding, self.top_k):
+            stored = self.store.chunks[i]
+            chunks.append(RetrievedChunk(
+                id=stored.id,
+                text=stored.text,
+                score=score,
+                metadata=stored.metadata,
+                embedding=self.store.embeddings[i],
+            ))
+        return chunks
+
+
+class PgVectorRetriever(Retriever):
+    """
+    pgvector в той же базе PostgreSQL. Сервер ищет через пул database.engine
+    (aretrieve), синхронный search для скриптов открывает своё соединение.
+    """
+
+    def __init__(self, embed_model, top_k: int):
+        from database import engine
+
+        self.embed_model = embed_model
+        self.top_k = top_k
+        self.engine = engine
+
+    def search(self, query: str, query_embedding: list[float]) -> list[RetrievedChunk]:
+        import pgvector_store
+
+        return self._chunks(pgvector_store.search_sync(query_embedding, self.top_k))
+
+    async def aretrieve(self, query: str) -> list[RetrievedChunk]:
+        import pgvector_store
+
+        with track_stage("embedding"):
+            query_embedding = await self.embed_model.aget_query_embedding(query)
+        with track_stage("vector_search"):
+            rows = await pgvector_store.search(self.engine, query_embedding, self.top_k)
+        return self._chunks(rows)
+
+    @staticmethod
+    def _chunks(rows) -> list[RetrievedChunk]:
+        return [
+            RetrievedChunk(
+                id=row.chunk_id,
+                text=row.text,
+                score=float(row.score),
+                metadata=row.metadata if isinstance(row.metadata, dict) else json.loads(row.metadata or "{}"),
+            )
+            for row in rows
+        ]
+
+
+def build_retriever(backend: str, embed_model, top_k: int) -> Retriever:
+    if backend == "pinecone":
+        return PineconeRetriever(embed_model, top_k)
+    if backend == "local":
+        return LocalRetriever(embed_model, top_k, settings.LOCAL_INDEX_DIR)
+    if backend == "pgvector":
+        return PgVectorRetriever(embed_model, top_k)
+    raise ValueError(f"Unknown VECTOR_BACKEND: {backend!r}")
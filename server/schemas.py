@@ -40,5 +40,17 @@ class MessageResponse(BaseModel):
     type: str
     text: str
     created_at: datetime
+    sources: Optional[list[dict]] = None
     class Config:
         orm_mode = True
+
+class JobResponse(BaseModel):
+    job_id: str
+    dialog_id: int
+    status: str
+    created_at: datetime
+    started_at: Optional[datetime] = None
+    finished_at: Optional[datetime] = None
+    # сообщение бота, когда status == "done"
+    message: Optional[MessageResponse] = None
+    error: Optional[str] = None
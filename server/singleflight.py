@@ -0,0 +1,63 @@
+"""
+Объединение одинаковых одновременных вызовов (single flight).
+
+Первый вызов с ключом запускает работу, остальные, пришедшие до её
+окончания, ждут тот же результат. Так популярный вопрос, который задают
+многие пользователи разом, проходит поиск и генерацию один раз, а не по
+разу на каждый запрос. Завершённый вызов сразу забывается: повторное
+использование готовых ответов — дело answer_cache.
+
+Работа выполняется отдельной задачей, поэтому отключившийся первый клиент
+не отменяет её для остальных; задача отменяется, только когда результата
+не ждёт никто.
+"""
+import asyncio
+from typing import Awaitable, Callable, Hashable, TypeVar
+
+from metrics import COALESCED_REQUESTS
+
+T = TypeVar("T")
+
+
+class _Call:
+    def __init__(self, task: asyncio.Task):
+        self.task = task
+        self.waiters = 0
+
+
+class SingleFlight:
+    def __init__(self, name: str, enabled: bool = True):
+        self.name = name
+        self.enabled = enabled
+        self._calls: dict[Hashable, _Call] = {}
+        self.calls = 0
+        self.coalesced = 0
+
+    async def do(self, key: Hashable, fn: Callable[[], Awaitable[T]]) -> tuple[T, bool]:
+        """Результат fn() и признак того, что он получен из чужого вызова."""
+        if not self.enabled:
+            return await fn(), False
+        call = self._calls.get(key)
+        shared = call is not None
+        if shared:
+            self.coalesced += 1
+            COALESCED_REQUESTS.labels(self.name).inc()
+        else:
+            call = self._calls[key] = _Call(asyncio.ensure_future(fn()))
+            call.task.add_done_callback(lambda _: self._forget(key, call))
+            self.calls += 1
+        call.waiters += 1
+        try:
+            return await asyncio.shield(call.task), shared
+        finally:
+            call.waiters -= 1
+            if not call.waiters and not call.task.done():
+                call.task.cancel()
+                self._forget(key, call)
+
+    def _forget(self, key: Hashable, call: _Call) -> None:
+        if self._calls.get(key) is call:
+            del self._calls[key]
+
+    def stats(self) -> dict:
+        return {"in_flight": len(self._calls), "calls": self.calls, "coalesced": self.coalesced}
@@ -0,0 +1,62 @@
+"""
+Загрузка тяжёлых ресурсов и отчёт о времени старта.
+
+Импорт приложения не загружает моделей и не ходит в сеть: модель эмбеддингов,
+токенизатор и RAGService поднимаются в фоне после старта (warm_up), поэтому
+/login, /register и история диалогов отвечают сразу, а чат до готовности базы
+знаний отдаёт 503.
+
+С PRELOAD_MODELS=true модель и токенизатор загружаются при импорте — под
+gunicorn с preload_app это происходит в мастере до fork, и воркеры делят веса
+copy-on-write (см. gunicorn.conf.py).
+"""
+import asyncio
+import logging
+import os
+
+from timing import StageTimings
+
+logger = logging.getLogger(__name__)
+
+# отсчёт от импорта приложения; total() в отчёте — время до готовности
+startup_timings = StageTimings(observe=False)
+state = {"preloaded": False, "ready_after": None}
+
+
+def preload_models() -> None:
+    from history import token_counter
+    from LLM_model import embedding_resources
+
+    with startup_timings.stage("embed_model"):
+        embedding_resources.load()
+    with startup_timings.stage("tokenizer"):
+        token_counter.load()
+    state["preloaded"] = True
+
+
+async def warm_up() -> None:
+    from history import token_counter
+    from LLM_model import embedding_resources, rag_manager
+
+    if not state["preloaded"]:
+        try:
+            with startup_timings.stage("tokenizer"):
+                await asyncio.to_thread(token_counter.load)
+            with startup_timings.stage("embed_model"):
+                await asyncio.to_thread(embedding_resources.load)
+        except Exception:
+            # rag_manager.start() повторит загрузку и сохранит ошибку для /health
+            logger.exception("Model preload failed")
+    with startup_timings.stage("rag"):
+        await rag_manager.start()
+    state["ready_after"] = startup_timings.total()
+    logger.info("Startup report: %s", report())
+
+
+def report() -> dict:
+    return {
+        "pid": os.getpid(),
+        "preloaded": state["preloaded"],
+        "stages": {name: round(seconds, 3) for name, seconds in startup_timings.stages.items()},
+        "ready_after": round(state["ready_after"], 3) if state["ready_after"] is not None else None,
+    }
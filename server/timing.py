@@ -0,0 +1,49 @@
+"""
+Замер стадий обработки запроса.
+
+Стадии могут выполняться параллельно, поэтому сумма стадий бывает больше
+общего времени: разница и есть выигрыш от конвейера. Итог отдаётся в
+заголовке Server-Timing (виден во вкладке Network браузера), каждая стадия
+также попадает в гистограмму civbot_stage_seconds.
+"""
+import time
+from contextlib import contextmanager
+from typing import Awaitable, TypeVar
+
+from metrics import observe_stage
+
+T = TypeVar("T")
+
+
+class StageTimings:
+    def __init__(self, observe: bool = True):
+        self.started = time.perf_counter()
+        self.stages: dict[str, float] = {}
+        # observe=False — только отчёт, без гистограммы (например, старт процесса)
+        self.observe = observe
+
+    def add(self, name: str, seconds: float) -> None:
+        self.stages[name] = self.stages.get(name, 0.0) + seconds
+        if self.observe:
+            observe_stage(name, seconds)
+
+    @contextmanager
+    def stage(self, name: str):
+        started = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.add(name, time.perf_counter() - started)
+
+    async def measure(self, name: str, awaitable: Awaitable[T]) -> T:
+        with self.stage(name):
+            return await awaitable
+
+    def total(self) -> float:
+        return time.perf_counter() - self.started
+
+    def as_dict(self) -> dict[str, float]:
+        return {**self.stages, "total": self.total()}
+
+    def server_timing(self) -> str:
+        return ", ".join(f"{name};dur={seconds * 1000:.1f}" for name, seconds in self.as_dict().items())